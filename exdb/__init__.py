@@ -7,15 +7,19 @@
 
 from os.path import dirname, exists, join, normpath
 from os import mkdir, makedirs
+import os
 import sys
 import subprocess
 import datetime
 import logging
 
 instancePath = None
+_refresh = None
+"""The (thread, stop event) pair of the background recompilation of :func:`refreshPreviews`
+while it may be running."""
 
 
-def init(path, repository=None, level=logging.INFO):
+def init(path, repository=None, level=logging.INFO, workers=None):
     """Initialize the exdb package with instance directory `path`.
     
     This function intelligently creates those parts of the instance directory that don't yet exist:
@@ -23,10 +27,16 @@ def init(path, repository=None, level=logging.INFO):
       initalized and populated with the initial directory structure. TeX templates are added and
       commited. If the `repository` argument is given, the repository is cloned from that URI
       instead.
-    - the directory for temporary preview images is created
-    - the database is created and populated
-    - preview images are generated
+    - the directory for temporary preview images is created, or cleaned up according to the
+      limits of the preview cache
+    - the database is created or migrated, and synchronized with the repository
+    - preview images are generated, using up to `workers` parallel compilations (defaults to
+      ``tex.WORKERS``)
+
+    A background recompilation of :func:`refreshPreviews` for the previous instance is stopped
+    first.
     """
+    sql.closeConnections()
     if path is None:
         return
     global instancePath
@@ -39,11 +49,14 @@ def init(path, repository=None, level=logging.INFO):
     previewPath = join(instancePath, "previews")
     if not exists(previewPath):
         mkdir(previewPath)
+    previewCache = cache.previewCache()
+    previewCache.removeOrphans()
+    previewCache.evict()
     if sql.initDatabase():
         logging.info('Initializing SQLite database')
-        populateDatabase()
-    for exercise in sql.exercises():
-        repo.compileSnippets(exercise, {}, init=True)
+    syncDatabase()
+    repo.compileBacklog(sql.iterExercises(), workers)
+    refreshPreviews(workers=workers)
   
 
 def version(packageName="exdb", packageDir=dirname(__file__)):
@@ -63,21 +76,149 @@ def version(packageName="exdb", packageDir=dirname(__file__)):
 def populateDatabase():
     """Populate the SQLite database with exercises from the XML files in the repository.
     
-    This assumes that the database does not exist or is empty; otherwise you will get consistency
-    problems.
+    This is the same as :func:`syncDatabase`, which also works on a non-empty database.
+    """
+    syncDatabase()
+
+
+def syncDatabase(connection=None, workers=None):
+    """Bring the database up to date with the exercise XML files and tag tree of the repository.
+
+    For every such file, the database records the size, modification time and SHA256 hash of the
+    version it was last synchronized with. Only files whose size or modification time differ are
+    hashed, and only files whose hash differs are parsed and stored with :func:`sql.addExercise`
+    or :func:`sql.updateExercise`; exercises whose XML file has disappeared are removed. Thus this
+    is cheap if nothing has changed, and repairs the database after the repository was changed
+    outside of exdb (e.g. by ``hg pull``). The XML files are parsed in parallel by up to *workers*
+    processes (see :func:`repo.parseExercises`), and new exercises are stored in bulk by
+    :func:`sql.addExercises`.
+
+    Returns a tuple containing the numbers of added, updated and removed exercises.
     """
-    import glob
-    from .exercise import Exercise
-    conn = sql.connect()
-    tags.initTagsTable(conn)
-    for xmlPath in sorted(glob.glob(join(repo.repoPath(), "exercises", "*", "*.xml"))):
-        logging.info("reading exercise {}".format(xmlPath))
-        exercise = Exercise.fromXMLFile(xmlPath)
-        #xml = open(xmlPath, "rb").read()
-        #exercise = Exercise.fromXMLString(xml)
-        sql.addExercise(exercise, connection=conn, deferCommit=True)
-    conn.commit()
-    conn.close()
+    root = repo.repoPath()
+    tagFile = "tagCategories.xml"
+    current = {}
+    for entry in os.scandir(join(root, "exercises")):
+        path = join("exercises", entry.name, entry.name + ".xml")
+        try:
+            current[path] = os.stat(join(root, path))
+        except OSError:
+            continue
+    updated = removed = 0
+    with sql.conditionalConnect(connection) as conn:
+        known = sql.repositoryFiles(conn)
+        states = []
+
+        def changed(path, stat):
+            """Check whether *path* changed since the last sync and store its new state."""
+            if path in known and known[path][:2] == (stat.st_size, stat.st_mtime_ns):
+                return False
+            state = repo.fileState(path)
+            states.append(state)
+            return path not in known or known[path][2] != state[3]
+
+        if exists(join(root, tagFile)):
+            tagsChanged = changed(tagFile, os.stat(join(root, tagFile)))
+        else:
+            tagsChanged = conn.execute("SELECT COUNT(*) FROM tags").fetchone()[0] == 0
+        if tagsChanged:
+            logging.info("reading tag tree")
+            tags.initTagsTable(conn)
+        inDatabase = {}
+        for creator, number in conn.execute("SELECT creator, number FROM exercises"):
+            identifier = "{}{}".format(creator, number)
+            inDatabase[join("exercises", identifier, identifier + ".xml")] = (creator, number)
+        paths = [path for path, stat in sorted(current.items())
+                 if changed(path, stat) or path not in inDatabase]
+
+        def newExercises():
+            nonlocal updated
+            exercises = repo.parseExercises([join(root, path) for path in paths], workers)
+            for path, exercise in zip(paths, exercises):
+                logging.info("reading exercise {}".format(path))
+                if path in inDatabase:
+                    sql.updateExercise(exercise, connection=conn, deferCommit=True)
+                    updated += 1
+                else:
+                    yield exercise
+
+        added = sql.addExercises(newExercises(), connection=conn, deferCommit=True,
+                                 deferIndexes=len(inDatabase) == 0)
+        for path, (creator, number) in inDatabase.items():
+            if path not in current:
+                logging.info("removing exercise {}{}".format(creator, number))
+                sql.removeExercise(creator, number, connection=conn, deferCommit=True)
+                removed += 1
+        sql.recordRepositoryFiles(states, [path for path in known
+                                           if path != tagFile and path not in current],
+                                  connection=conn, deferCommit=True)
+        conn.commit()
+    return added, updated, removed
+
+
+def recordSync(exercise=None, connection=None):
+    """Record that the database matches the repository files written for *exercise* (if given)
+    and the tag tree, so that :func:`syncDatabase` does not need to read them again.
+    """
+    paths = ["tagCategories.xml"]
+    if exercise is not None:
+        paths.append(os.path.relpath(repo.xmlPath(exercise), repo.repoPath()))
+    states = [repo.fileState(path) for path in paths if exists(join(repo.repoPath(), path))]
+    sql.recordRepositoryFiles(states, connection=connection)
+
+
+def refreshPreviews(background=True, workers=None):
+    """Bring all previews up to date with the current contents of the TeX templates.
+
+    Cached previews compiled with an outdated revision of template.tex or preamble.tex are
+    removed, and the official previews in the repository that were built from an outdated
+    revision are recompiled. If `background` is True, the recompilation runs in a daemon thread
+    which is returned (or None if nothing is to be done); otherwise, this function returns after
+    the recompilation has finished. A background recompilation works on the instance it was
+    started for: it is stopped by :func:`stopRefresh` before the instance changes, and replaces
+    the one of an earlier call.
+    """
+    import threading
+    global _refresh
+    stopRefresh()
+    previewCache = cache.previewCache()
+    if previewCache is None:
+        return None
+    revision = tex.templateRevision()
+    removed = previewCache.invalidate(revision)
+    if removed:
+        logging.info('Removed {} cached previews of outdated templates'.format(removed))
+    outdated = previewCache.outdatedOfficial(revision)
+    if len(outdated) == 0:
+        return None
+    logging.info('Rebuilding {} previews of outdated templates'.format(len(outdated)))
+    if not background:
+        repo.rebuildPreviews(outdated, workers)
+        return None
+    stop = threading.Event()
+    thread = threading.Thread(target=repo.rebuildPreviews, args=(outdated, workers, stop),
+                              name="exdb-preview-rebuild")
+    thread.daemon = True
+    _refresh = thread, stop
+    thread.start()
+    return thread
+
+
+def stopRefresh():
+    """Stop the background recompilation of :func:`refreshPreviews`, if any, and wait until it
+    has finished.
+
+    No further previews are installed; a compilation that is already running is abandoned.
+    This is called by :func:`sql.closeConnections`, and thus by :func:`init`.
+    """
+    import threading
+    global _refresh
+    if _refresh is None:
+        return
+    (thread, stop), _refresh = _refresh, None
+    stop.set()
+    if thread is not threading.current_thread():
+        thread.join()
 
 
 def addExercise(exercise, files, connection=None):
@@ -94,6 +235,7 @@ def addExercise(exercise, files, connection=None):
         sql.addExercise(exercise, connection=conn)
         tags.storeTree(tags.readTreeFromTable(conn)) 
     repo.addExercise(exercise, files)
+    recordSync(exercise, connection)
 
 
 def updateExercise(exercise, files, old, connection=None, user=None):
@@ -109,6 +251,7 @@ def updateExercise(exercise, files, old, connection=None, user=None):
         sql.updateExercise(exercise, connection=conn)
         tags.storeTree(tags.readTreeFromTable(conn))
     repo.updateExercise(exercise, files, old, user=user)
+    recordSync(exercise, connection)
 
 
 def removeExercise(creator, number, connection=None, user=None):
@@ -120,6 +263,7 @@ def removeExercise(creator, number, connection=None, user=None):
         sql.removeExercise(creator, number, connection=conn)
         tags.storeTree(tags.readTreeFromTable(conn))
     repo.removeExercise(creator, number, user)
+    recordSync(connection=connection)
 
 
 def updateTagTree(old, new, user, connection=None):
@@ -129,36 +273,30 @@ def updateTagTree(old, new, user, connection=None):
         return False
     oldTags = {}
     renames = {}
+    renameIds = {}
     deletes = set()
     newTagsIds = set([int(node.get("id")) for node in new.iter("tag")])
     for node in old.iter("tag"):
         id = int(node.get("id"))
         oldTags[id] = node.get("name")
         if id not in newTagsIds:
-            deletes.add(node.get("name"))
+            deletes.add(id)
     for node in new.iter("tag"):
         id = int(node.get("id"))
         if oldTags[id] != node.get("name"):
             renames[oldTags[id]] =  node.get("name")
+            renameIds[id] = node.get("name")
     with sql.conditionalConnect(connection) as conn:
         if len(renames) + len(deletes):
-            exercises = sql.exercises(connection=conn)
-            for exercise in exercises:
-                changed = False
-                tagsFiltered = [t for t in exercise.tags if t not in deletes]
-                if len(tagsFiltered) != len(exercise.tags):
-                    exercise.tags = tagsFiltered
-                    changed = True
-                for i in range(len(exercise.tags)):
-                    if exercise.tags[i] in renames:
-                        changed = True
-                        exercise.tags[i] = renames[exercise.tags[i]]
-                if changed:
-                    sql.updateExercise(exercise, connection=conn)
+            # tags are referenced by id, so only the XML files of affected exercises change
+            affected = sql.updateTags(renameIds, deletes, connection=conn)
+            if affected:
+                for exercise in sql.iterExercises(ids=affected, connection=conn):
                     repo.storeExerciseXML(exercise)
         tags.storeTree(new)
         tags.initTagsTable(conn)
     repo.updateTagTree(renames, user)
+    recordSync(connection=connection)
     return True
 
 
@@ -169,4 +307,4 @@ def uni(string):
     return string.decode('utf-8')
 
 
-from exdb import repo, sql, tags, tex
\ No newline at end of file
+from exdb import cache, repo, sql, tags, tex
\ No newline at end of file
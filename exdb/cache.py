@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Michael Helmling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+"""Bookkeeping for the preview images of an exdb instance.
+
+The *previews* directory of an instance contains one subdirectory per compiled preview, named by
+the SHA256 key computed in :func:`exdb.tex.makePreview`. This module maintains an index of those
+directories and of the official preview images inside the repository, stored in the SQLite file
+``previews/cache.sqlite``. Since the index only contains derived data, it is silently recreated
+if it is missing or has an unexpected format.
+
+The size of the preview directory is bounded by :data:`MAX_BYTES` and :data:`MAX_ENTRIES`; if
+either limit is exceeded, the least recently used previews are evicted.
+
+Failed compilations are cached as well, under the same key and together with their log, so that
+repeating an erroneous request fails immediately. Such negative entries expire after
+:data:`FAILURE_TTL` seconds, and at most :data:`MAX_FAILURES` of them are kept.
+"""
+
+from __future__ import unicode_literals
+
+import os, shutil, sqlite3, threading, time
+from os.path import join, exists, getmtime, isdir
+
+MAX_BYTES = 1024**3
+"""Default maximum total size in bytes of the cached previews."""
+MAX_ENTRIES = 20000
+"""Default maximum number of cached previews."""
+FAILURE_TTL = 24*3600
+"""Default lifetime in seconds of cached compilation failures."""
+MAX_FAILURES = 5000
+"""Default maximum number of cached compilation failures."""
+
+SCHEMAVERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS previews (
+    key TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idxPreviewTemplate ON previews (template);
+CREATE INDEX IF NOT EXISTS idxPreviewAccessed ON previews (accessed);
+
+CREATE TABLE IF NOT EXISTS official (
+    creator TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    textype TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    template TEXT NOT NULL,
+    PRIMARY KEY (creator, number, textype, lang)
+);
+CREATE INDEX IF NOT EXISTS idxOfficialTemplate ON official (template);
+
+CREATE TABLE IF NOT EXISTS failures (
+    key TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    created REAL NOT NULL,
+    msg TEXT NOT NULL,
+    log TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idxFailureCreated ON failures (created);
+"""
+
+
+class PreviewCache(object):
+    """Index of the preview directory *path*.
+
+    For every cached preview (identified by its key, i.e. its directory name) and every official
+    preview image in the repository (identified by creator, number, textype and lang), the index
+    records the revision of the TeX templates (see :func:`exdb.tex.templateRevision`) it was
+    compiled with. That allows to find and rebuild exactly the previews affected by a template
+    change.
+
+    Whenever a preview is added, the least recently accessed previews are evicted until the cache
+    holds at most *maxBytes* bytes in at most *maxEntries* previews (defaulting to
+    :data:`MAX_BYTES` and :data:`MAX_ENTRIES`, respectively).
+
+    Failures are kept for *failureTTL* seconds, and whenever one is added, the oldest ones are
+    evicted until at most *maxFailures* remain (defaulting to :data:`FAILURE_TTL` and
+    :data:`MAX_FAILURES`, respectively).
+
+    The methods are thread-safe; concurrent access from several processes is serialized by SQLite.
+    """
+
+    def __init__(self, path, maxBytes=None, maxEntries=None, maxFailures=None, failureTTL=None):
+        self.path = path
+        self.maxBytes = MAX_BYTES if maxBytes is None else maxBytes
+        self.maxEntries = MAX_ENTRIES if maxEntries is None else maxEntries
+        self.maxFailures = MAX_FAILURES if maxFailures is None else maxFailures
+        self.failureTTL = FAILURE_TTL if failureTTL is None else failureTTL
+        self.hits = self.misses = self.evictions = self.failureHits = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(join(path, "cache.sqlite"), timeout=30,
+                                     isolation_level=None, check_same_thread=False)
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMAVERSION:
+            tables = [row[0] for row in self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")]
+            for table in tables:
+                self._conn.execute("DROP TABLE {}".format(table))
+            self._conn.execute("PRAGMA user_version = {}".format(SCHEMAVERSION))
+        self._conn.executescript(SCHEMA)
+
+    def entryPath(self, key):
+        """Absolute path of the directory of the cached preview *key*."""
+        return join(self.path, key)
+
+    def imagePath(self, key):
+        """Absolute path of the preview image of the cached preview *key*."""
+        return join(self.entryPath(key), "preview.png")
+
+    def lookup(self, key):
+        """Return the image path of the cached preview *key*, or None if it is not cached.
+
+        A successful lookup counts as a hit and marks the preview as recently used; otherwise,
+        a miss is counted.
+        """
+        image = self.imagePath(key)
+        with self._lock:
+            if exists(image):
+                cursor = self._conn.execute("UPDATE previews SET accessed=? WHERE key=?",
+                                            (time.time(), key))
+                if cursor.rowcount:
+                    self.hits += 1
+                    return image
+            self.misses += 1
+            return None
+
+    def record(self, key, template):
+        """Add the preview compiled into the directory of *key* with template revision *template*.
+
+        Afterwards, other previews are evicted if the cache exceeds its limits. Files with other
+        hard links are not counted, since evicting the preview does not free their space.
+        """
+        size = 0
+        for dirpath, _, filenames in os.walk(self.entryPath(key)):
+            for name in filenames:
+                stat = os.lstat(join(dirpath, name))
+                if stat.st_nlink == 1:
+                    size += stat.st_size
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO previews"
+                               "(key, template, created, accessed, size) VALUES (?,?,?,?,?)",
+                               (key, template, now, now, size))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Evict least recently used previews until the cache satisfies its limits.
+
+        The preview *keep* is never evicted. Returns the number of evicted previews.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM previews").fetchone()
+            if entries <= self.maxEntries and size <= self.maxBytes:
+                return 0
+            victims = []
+            for key, entrySize in self._conn.execute("SELECT key, size FROM previews "
+                                                     "ORDER BY accessed ASC"):
+                if entries <= self.maxEntries and size <= self.maxBytes:
+                    break
+                if key == keep:
+                    continue
+                victims.append(key)
+                entries -= 1
+                size -= entrySize
+            self.evictions += len(victims)
+        for key in victims:
+            self.discard(key)
+        return len(victims)
+
+    def lookupFailure(self, key):
+        """Return the (msg, log) pair of the cached failure *key*, or None if there is none.
+
+        Expired failures are removed. A successful lookup counts as a failure hit.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM failures WHERE created < ?",
+                               (time.time() - self.failureTTL,))
+            row = self._conn.execute("SELECT msg, log FROM failures WHERE key=?",
+                                     (key,)).fetchone()
+            if row:
+                self.failureHits += 1
+                return tuple(row)
+            return None
+
+    def recordFailure(self, key, template, msg, log):
+        """Record that compiling *key* with template revision *template* failed with the
+        CompilationError attributes *msg* and *log*.
+
+        Afterwards, the oldest failures are evicted if there are more than *maxFailures*.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO failures(key, template, created, msg, log) "
+                               "VALUES (?,?,?,?,?)", (key, template, time.time(), msg, log))
+            self._conn.execute("DELETE FROM failures WHERE key NOT IN (SELECT key FROM failures "
+                               "ORDER BY created DESC LIMIT ?)", (self.maxFailures,))
+
+    def removeOrphans(self, minAge=3600):
+        """Remove preview directories that are not contained in the index.
+
+        Such directories are left over by older versions of exdb or by interrupted compilations.
+        To not interfere with running compilations, only directories that have not been modified
+        for *minAge* seconds are removed. Returns the number of removed directories.
+        """
+        with self._lock:
+            known = set(row[0] for row in self._conn.execute("SELECT key FROM previews"))
+        removed = 0
+        for name in os.listdir(self.path):
+            directory = self.entryPath(name)
+            if name not in known and isdir(directory) \
+                    and time.time() - getmtime(directory) > minAge:
+                shutil.rmtree(directory, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def stats(self):
+        """Return a dictionary with usage statistics of the cache.
+
+        The entries *hits*, *misses*, *evictions* and *failureHits* count the respective events
+        of this process since the cache object was created. *entries*, *bytes* and *failures*
+        describe the current contents of the cache, and *maxEntries*, *maxBytes* and
+        *maxFailures* its limits.
+        """
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM previews").fetchone()
+            failures = self._conn.execute("SELECT COUNT(*) FROM failures").fetchone()[0]
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    failureHits=self.failureHits, entries=entries, bytes=size, failures=failures,
+                    maxEntries=self.maxEntries, maxBytes=self.maxBytes,
+                    maxFailures=self.maxFailures)
+
+    def discard(self, key):
+        """Remove the cached preview *key* from the index and the file system."""
+        with self._lock:
+            self._conn.execute("DELETE FROM previews WHERE key=?", (key,))
+        shutil.rmtree(self.entryPath(key), ignore_errors=True)
+
+    def recordOfficial(self, snippets, template):
+        """Record that the official previews of *snippets* were built with *template*.
+
+        *snippets* is an iterable of (creator, number, textype, lang) tuples.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO official"
+                                   "(creator, number, textype, lang, template) VALUES (?,?,?,?,?)",
+                                   (tuple(snippet) + (template,) for snippet in snippets))
+            self._conn.execute("COMMIT")
+
+    def forgetOfficial(self, creator, number, textype=None, lang=None):
+        """Remove the official previews of an exercise, or of one of its snippets, from the index.
+        """
+        query = "DELETE FROM official WHERE creator=? AND number=?"
+        args = [creator, number]
+        if textype is not None:
+            query += " AND textype=? AND lang=?"
+            args.extend((textype, lang))
+        with self._lock:
+            self._conn.execute(query, args)
+
+    def officialSnippets(self):
+        """Return the set of (creator, number, textype, lang) tuples of all indexed official
+        previews.
+        """
+        with self._lock:
+            return set(tuple(row) for row in self._conn.execute(
+                "SELECT creator, number, textype, lang FROM official"))
+
+    def outdatedOfficial(self, template):
+        """Return a list of (creator, number, textype, lang) tuples identifying the official
+        previews that were built with a template revision other than *template*.
+        """
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute(
+                "SELECT creator, number, textype, lang FROM official WHERE template != ? "
+                "ORDER BY creator, number", (template,))]
+
+    def invalidate(self, template):
+        """Remove all cached previews and failures of a template revision other than *template*.
+
+        Returns the number of removed previews.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM failures WHERE template != ?", (template,))
+            keys = [row[0] for row in self._conn.execute(
+                "SELECT key FROM previews WHERE template != ?", (template,))]
+        for key in keys:
+            self.discard(key)
+        return len(keys)
+
+    def close(self):
+        self._conn.close()
+
+
+_instance = None
+_instanceLock = threading.Lock()
+
+
+def previewCache():
+    """Return the :class:`PreviewCache` of the current instance, or None if exdb is not
+    initialized with an instance directory.
+    """
+    import exdb
+    global _instance
+    if exdb.instancePath is None:
+        return None
+    path = join(exdb.instancePath, "previews")
+    if not exists(path):
+        return None
+    with _instanceLock:
+        if _instance is None or _instance.path != path:
+            if _instance is not None:
+                _instance.close()
+            _instance = PreviewCache(path)
+        return _instance
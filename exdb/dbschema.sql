@@ -3,36 +3,108 @@ CREATE TABLE IF NOT EXISTS exercises (
     creator TEXT NOT NULL,
     number INTEGER NOT NULL,
     description TEXT,
-    modified TIMESTAMP NOT NULL,
-    tex_exercise TEXDICT,
-    tex_solution TEXDICT
+    modified TIMESTAMP NOT NULL
 );
 CREATE INDEX IF NOT EXISTS idxDesc ON exercises (description);
+CREATE INDEX IF NOT EXISTS idxModified ON exercises (modified);
+CREATE UNIQUE INDEX IF NOT EXISTS idxIdentifier ON exercises (creator, number);
+
+CREATE TABLE IF NOT EXISTS exercise_numbers (
+    creator TEXT PRIMARY KEY,
+    number INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS tags_generation (
+    generation INTEGER NOT NULL
+);
+INSERT INTO tags_generation(generation) SELECT 0 WHERE NOT EXISTS (SELECT * FROM tags_generation);
+
+CREATE TABLE IF NOT EXISTS exercises_tex (
+    exercise INTEGER NOT NULL,
+    textype TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    code TEXT NOT NULL,
+    PRIMARY KEY (exercise, textype, lang),
+    FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idxTexLang ON exercises_tex (lang, textype);
 
 CREATE TABLE IF NOT EXISTS exercises_preambles (
     exercise INTEGER,
     preamble TEXT,
     FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
 );
+CREATE INDEX IF NOT EXISTS idxPreamblesExercise ON exercises_preambles (exercise);
 
 CREATE TABLE IF NOT EXISTS exercises_files (
-	exercise INTEGER,
-	filename TEXT,
-	FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
+    exercise INTEGER,
+    filename TEXT,
+    FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
 );
+CREATE INDEX IF NOT EXISTS idxFilesExercise ON exercises_files (exercise);
 
 CREATE TABLE IF NOT EXISTS tags (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
     is_tag BOOLEAN,
-    mat_path TEXT
+    mat_path TEXT,
+    position INTEGER
 );
 CREATE INDEX IF NOT EXISTS idxMatPath ON tags (mat_path);
 CREATE INDEX IF NOT EXISTS idxIsTag ON tags (is_tag);
 
+CREATE TABLE IF NOT EXISTS tags_closure (
+    ancestor INTEGER NOT NULL,
+    descendant INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor, descendant),
+    FOREIGN KEY(ancestor) REFERENCES tags(id) ON DELETE CASCADE,
+    FOREIGN KEY(descendant) REFERENCES tags(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idxClosureDescendant ON tags_closure (descendant, depth);
+
 CREATE TABLE IF NOT EXISTS exercises_tags (
-    exercise INTEGER,
-    tag TEXT,
-    FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
+    exercise INTEGER NOT NULL,
+    tag INTEGER NOT NULL,
+    FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE,
+    FOREIGN KEY(tag) REFERENCES tags(id)
+);
+CREATE INDEX IF NOT EXISTS idxExTags ON exercises_tags (tag);
+CREATE INDEX IF NOT EXISTS idxTagsExercise ON exercises_tags (exercise);
+
+CREATE TABLE IF NOT EXISTS repository_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS exercises_fts USING fts5(
+    description, exercise, solution,
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
 );
-CREATE INDEX IF NOT EXISTS idxExTags ON exercises_tags (tag);
\ No newline at end of file
+CREATE TRIGGER IF NOT EXISTS exercisesFtsInsert AFTER INSERT ON exercises BEGIN
+    INSERT INTO exercises_fts(rowid, description) VALUES (NEW.id, NEW.description);
+END;
+CREATE TRIGGER IF NOT EXISTS exercisesFtsUpdate AFTER UPDATE OF description ON exercises BEGIN
+    UPDATE exercises_fts SET description = NEW.description WHERE rowid = NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS exercisesFtsDelete AFTER DELETE ON exercises BEGIN
+    DELETE FROM exercises_fts WHERE rowid = OLD.id;
+END;
+CREATE TRIGGER IF NOT EXISTS exercisesTexFtsInsert AFTER INSERT ON exercises_tex BEGIN
+    UPDATE exercises_fts SET
+        exercise = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                    WHERE exercise = NEW.exercise AND textype = 'exercise'),
+        solution = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                    WHERE exercise = NEW.exercise AND textype = 'solution')
+        WHERE rowid = NEW.exercise;
+END;
+CREATE TRIGGER IF NOT EXISTS exercisesTexFtsDelete AFTER DELETE ON exercises_tex BEGIN
+    UPDATE exercises_fts SET
+        exercise = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                    WHERE exercise = OLD.exercise AND textype = 'exercise'),
+        solution = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                    WHERE exercise = OLD.exercise AND textype = 'solution')
+        WHERE rowid = OLD.exercise;
+END;
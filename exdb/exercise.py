@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 
 import datetime
 import json
+from collections.abc import MutableMapping
 from os.path import join, dirname
 
 from lxml import etree
@@ -30,12 +31,22 @@ class ExerciseEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime.datetime):
             return o.strftime(Exercise.DATEFMT)
+        if isinstance(o, Exercise):
+            return o.toDict()
         return json.JSONEncoder.default(self, o)
 
 
-class Exercise(dict):
-    """Class for exercises."""
-    
+class Exercise(MutableMapping):
+    """Class for exercises.
+
+    The :attr:`attributes` are stored in slots. For compatibility, an exercise is also a mutable
+    mapping of its attributes (as in ``exercise["tex_" + textype]``), which does not contain the
+    attributes that have been deleted or left out by a projected database query.
+    """
+
+    __slots__ = ("number", "creator", "description", "modified", "tex_preamble",
+                 "tex_exercise", "tex_solution", "data_files", "tags",
+                 "schemaversion", "loader", "langs")
     DATEFMT = "%Y-%m-%dT%H:%M:%S"
     parser = None
     attributes = ["number", "creator", "description", "modified", "tex_preamble",
@@ -57,18 +68,74 @@ class Exercise(dict):
             else:
                 raise ValueError("Unknown keyword arg '{}' for Exercise".format(key))
     
-    def __setattr__(self, attr, value):
-        if attr in self.attributes:
-            self[attr] = value
-            return self[attr]
-        else:
-            return dict.__setattr__(self, attr, value)
-        
     def __getattr__(self, attr):
-        if attr in self.attributes:
-            return self[attr]
-        else:
-            return dict.__getattr__(self, attr)
+        """Load the attribute *attr* if it was left out by a projected database query; see
+        :func:`exdb.sql.exercisePage`. Attributes the loader does not know (it raises a KeyError)
+        are missing, as without a loader.
+        """
+        if attr in Exercise.attributes:
+            try:
+                loader = object.__getattribute__(self, "loader")
+            except AttributeError:
+                pass
+            else:
+                try:
+                    return loader(attr)
+                except KeyError:
+                    pass
+        raise AttributeError("'Exercise' object has no attribute '{}'".format(attr))
+
+    def __getitem__(self, key):
+        if key not in Exercise.attributes:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in Exercise.attributes:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in Exercise.attributes:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key not in Exercise.attributes:
+            return False
+        try:
+            object.__getattribute__(self, key)
+        except AttributeError:
+            return False
+        return True
+
+    def __iter__(self):
+        return (attr for attr in Exercise.attributes if attr in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def languages(self):
+        """Return the sorted list of languages of the exercise TeX.
+
+        For exercises read from the database without their TeX code, the languages are known
+        without loading it.
+        """
+        if "tex_exercise" not in self:
+            try:
+                return self.langs
+            except AttributeError:
+                pass
+        return sorted(self.tex_exercise)
 
     def identifier(self):
         return "{}{}".format(self.creator, self.number)                
@@ -110,8 +177,18 @@ class Exercise(dict):
         return etree.tostring(self.toXMLRoot(), encoding="utf-8", xml_declaration=True,
                               pretty_print=True).decode('utf-8')
     
+    def toDict(self):
+        """Return a dict of the attributes contained in the mapping view of the exercise."""
+        values = {}
+        for attr in Exercise.attributes:
+            try:
+                values[attr] = object.__getattribute__(self, attr)
+            except AttributeError:  # deleted or not loaded; see __getattr__
+                pass
+        return values
+
     def toJSON(self):
-        return ExerciseEncoder().encode(self)
+        return ExerciseEncoder().encode(self.toDict())
     
     @staticmethod
     def initXSD():
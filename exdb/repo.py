@@ -7,7 +7,7 @@
 
 from __future__ import unicode_literals
 
-import io, os, subprocess, shutil, logging
+import asyncio, io, os, subprocess, shutil, logging
 from os.path import basename, dirname, join, exists, relpath
 
 
@@ -102,16 +102,14 @@ def initRepository(source=None):
 
 
 def loadFiles(creator, number, filenames):
-    """Load image files with names *filenames* for the specified exercise.
+    """Reference the image files with names *filenames* of the specified exercise.
     
-    Returns a list of (filename, data) tuples.
+    Returns a dict mapping filename to :class:`tex.FileReference` objects, which can be passed to
+    the compilation functions without reading the files into memory.
     """
+    from . import tex
     exPath = exercisePath(creator=creator, number=number)
-    files = {}
-    for name in filenames:
-        data = open(join(exPath, name), "rb").read()
-        files[name] = data
-    return files
+    return {name: tex.FileReference(join(exPath, name)) for name in filenames}
     
     
 def storeExerciseXML(exercise):
@@ -120,20 +118,79 @@ def storeExerciseXML(exercise):
         f.write(exercise.toXML())
 
 
+def fileState(path):
+    """Return a (path, size, mtime, hash) tuple describing the file *path* in the repository.
+
+    *path* is relative to the repository, *mtime* is given in nanoseconds and *hash* is the
+    SHA256 hex digest of the contents.
+    """
+    import hashlib
+    absPath = join(repoPath(), path)
+    stat = os.stat(absPath)
+    h = hashlib.sha256()
+    with open(absPath, "rb") as f:
+        for chunk in iter(lambda: f.read(2**16), b""):
+            h.update(chunk)
+    return path, stat.st_size, stat.st_mtime_ns, h.hexdigest()
+
+
 def loadFromXML(creator, number):
     from exdb.exercise import Exercise
     return Exercise.fromXMLFile(xmlPath(creator=creator, number=number))
 
 
-def compileSnippets(exercise, files, old=None, copy=False, init=False):
+PARALLEL_PARSE_MIN = 200
+"""Minimum number of XML files for which :func:`parseExercises` uses a process pool."""
+
+
+def parseExercises(paths, workers=None):
+    """Parse and validate the exercise XML files *paths*; generates the Exercise objects in order.
+
+    If there are at least :data:`PARALLEL_PARSE_MIN` files, they are parsed by a pool of *workers*
+    processes (defaulting to the number of CPUs), while the results are consumed.
+    """
+    from exdb.exercise import Exercise
+    workers = workers or os.cpu_count() or 1
+    if len(paths) < PARALLEL_PARSE_MIN or workers == 1:
+        for path in paths:
+            yield Exercise.fromXMLFile(path)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, min(64, len(paths) // (4*workers)))
+        for exercise in pool.map(Exercise.fromXMLFile, paths, chunksize=chunksize):
+            yield exercise
+
+
+def snippetTarget(exercise, textype, lang, output="preview"):
+    """Path of the official preview image of the *textype* snippet of *exercise* in *lang*.
+
+    *output* is the name of the image as configured in ``tex.OUTPUTS``; the main image is named
+    ``{textype}_{lang}.png``, all others ``{textype}_{lang}_{output}.png``.
+    """
+    if output == "preview":
+        return join(exercisePath(exercise), "{}_{}.png".format(textype, lang))
+    return join(exercisePath(exercise), "{}_{}_{}.png".format(textype, lang, output))
+
+
+def hasPreview(exercise, textype, lang):
+    """Return whether all official preview images of the given snippet exist."""
+    from . import tex
+    return all(exists(snippetTarget(exercise, textype, lang, output))
+               for output, _ in tex.OUTPUTS)
+
+
+def compileSnippets(exercise, files, old=None, copy=False, init=False, workers=None):
     """Compiles all TeX snippets of `exercise` or raises an error if this is not possible.
 
     Parameters
     ----------
     files : dict
-        Dictionary mapping file name to data of newly uploaded files.
+        Dictionary mapping file name to data (or a ``tex.FileReference``) of newly uploaded
+        files.
     copy : bool
-        If ``True``, successfully compiled previews are copied into the exercise directory in the
+        If ``True``, successfully compiled previews (including the additional images like
+        thumbnails, see ``tex.OUTPUTS``) are copied into the exercise directory in the
         repository, i.e., become the "official" previews.
     old: Exercise
         Previous version of the exercise object, if exists. Helps to only recompile parts that have
@@ -141,11 +198,18 @@ def compileSnippets(exercise, files, old=None, copy=False, init=False):
     init : bool
         Enables a special mode made for initializing the repository after e.g. cloning. It
         generates all previews which do not yet exist in the filesystem (implies ``copy=True``).
+    workers : int
+        Maximum number of snippets compiled in parallel (see :func:`tex.makePreviews`).
+
+    Unless *init* is set, the snippets are compiled with interactive priority, and a newer call
+    for the same exercise supersedes this one, which then raises a ``tex.CompilationCancelled``
+    error. Exercises without a number (not yet added) are never superseded.
 
     If compilation of a snippet fails, a tex.CompilationError exception is raised. Besides its
     normal attribute, the *successful* attribute contains the dictionary that would normally be
-    returned (containing links to all snippets compiled successfully so far), and the *textype*
-    and *lang* attributes of the exception tell which snippet failed.
+    returned (containing links to all snippets compiled successfully), and the *textype* and
+    *lang* attributes of the exception tell which snippet failed. If several snippets fail, the
+    error of the first one (exercise before solution) is raised.
 
     Returns
     ------
@@ -154,6 +218,61 @@ def compileSnippets(exercise, files, old=None, copy=False, init=False):
         ``previewtype`` is one of ``"preview"`` and ``"temp"`` and ``path`` is the absolute image
         path.
     """
+    from . import tex
+    ret, jobs = snippetJobs(exercise, files, old, init)
+    copy = copy or init
+    template = tex.templateRevision()
+    errors = {}
+    if init:
+        previews = tex.makePreviews(jobs, workers)
+    else:
+        # new exercises get their number only when added to the database, so they are not
+        # identified yet and must not supersede each other
+        tag = None if exercise.number is None else (exercise.creator, exercise.number)
+        previews = tex.makePreviews(jobs, workers, tex.PRIORITY_INTERACTIVE, tag)
+    for (textype, lang), result in previews:
+        if isinstance(result, tex.CompilationError):
+            errors[textype, lang] = result
+            continue
+        ret[textype, lang] = ("temp", result)
+        if copy:
+            installPreview(exercise, textype, lang, result, template)
+    raiseSnippetError(jobs, errors, ret)
+    return ret
+
+
+async def compileSnippetsAsync(exercise, files, old=None, copy=False, init=False):
+    """Coroutine version of :func:`compileSnippets`, with the same results and errors.
+
+    All snippets are compiled concurrently by :func:`tex.makePreviewAsync`.
+    """
+    from . import tex
+    ret, jobs = snippetJobs(exercise, files, old, init)
+    copy = copy or init
+    template = tex.templateRevision()
+    results = await asyncio.gather(*(tex.makePreviewAsync(*job[1:]) for job in jobs),
+                                   return_exceptions=True)
+    errors = {}
+    for ((textype, lang), _, _, _, _), result in zip(jobs, results):
+        if isinstance(result, tex.CompilationError):
+            errors[textype, lang] = result
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        ret[textype, lang] = ("temp", result)
+        if copy:
+            installPreview(exercise, textype, lang, result, template)
+    raiseSnippetError(jobs, errors, ret)
+    return ret
+
+
+def snippetJobs(exercise, files, old=None, init=False):
+    """Determine the snippets that :func:`compileSnippets` needs to compile.
+
+    Returns a tuple (*ret*, *jobs*), where *ret* maps the (textype, lang) tuples of unchanged
+    snippets to their official previews, and *jobs* is a list of :func:`tex.makePreviews` jobs
+    keyed by (textype, lang).
+    """
     if old:
         files = files.copy()
         files.update(loadFiles(exercise.creator, exercise.number,
@@ -168,38 +287,156 @@ def compileSnippets(exercise, files, old=None, copy=False, init=False):
     else:
         compileAll = True
     if init:
-        copy=True
         files = loadFiles(exercise.creator, exercise.number, exercise.data_files)
-    from . import tex
     ret = {}
+    jobs = []
     for textype in "exercise", "solution":
         dct = exercise["tex_" + textype]
         for lang, code in dct.items():
-            try:
-                target = join(exercisePath(exercise), "{}_{}.png".format(textype, lang))
-                if init and exists(target):
+            target = snippetTarget(exercise, textype, lang)
+            if init and hasPreview(exercise, textype, lang):
+                continue
+            if not compileAll and old and old["tex_" + textype].get(lang) == code:
+                ret[textype, lang] = ("preview", target)
+                continue
+            if init:
+                logging.info('Compiling initial TeX preview of {}/{}/{}'
+                             .format(exercise, textype, lang))
+            jobs.append(((textype, lang), code, lang, exercise.tex_preamble, files))
+    return ret, jobs
+
+
+def raiseSnippetError(jobs, errors, successful):
+    """Raise the error of the first of *jobs* contained in the dict *errors*, if any.
+
+    The error is annotated with the *textype*, *lang* and *successful* attributes documented in
+    :func:`compileSnippets`.
+    """
+    for snippet, _, _, _, _ in jobs:
+        if snippet in errors:
+            e = errors[snippet]
+            e.textype, e.lang = snippet
+            e.successful = successful
+            raise e
+
+
+def installPreview(exercise, textype, lang, image, template):
+    """Make the compiled preview *image* the official preview of the given snippet.
+
+    The temporary compilation directory of *image* is removed, and the preview is recorded in the
+    preview index as being built from template revision *template*.
+    """
+    from . import cache, tex
+    for output, _ in tex.OUTPUTS:
+        shutil.copy(join(dirname(image), output + ".png"),
+                    snippetTarget(exercise, textype, lang, output))
+    tex.releasePreview(image)
+    previewCache = cache.previewCache()
+    if previewCache:
+        previewCache.recordOfficial([(exercise.creator, exercise.number, textype, lang)], template)
+
+
+def installPreviews(jobs, workers=None, cancelled=None):
+    """Compile *jobs* as in :func:`tex.makePreviews` and install the results as official previews.
+
+    The keys of the jobs must be (exercise, textype, lang) tuples. Snippets that fail to compile
+    are logged and skipped. Once the :class:`threading.Event` *cancelled* is set, no further
+    previews are installed and the pending compilations are cancelled.
+    """
+    from . import tex
+    template = tex.templateRevision()
+    results = tex.makePreviews(jobs, workers)
+    try:
+        for (exercise, textype, lang), result in results:
+            if cancelled is not None and cancelled.is_set():
+                return
+            if isinstance(result, tex.CompilationError):
+                logging.error('Failed to compile TeX preview of {}/{}/{}:\n{}'
+                              .format(exercise, textype, lang, result.msg))
+                continue
+            installPreview(exercise, textype, lang, result, template)
+    finally:
+        results.close()
+
+
+def compileBacklog(exercises, workers=None):
+    """Generate all official previews of *exercises* that do not yet exist in the repository.
+
+    In contrast to calling :func:`compileSnippets` with ``init=True`` for each exercise, the
+    snippets of all exercises are compiled in a single pool of *workers* parallel compilations.
+    Snippets that fail to compile are logged and skipped.
+
+    Existing previews that are not yet contained in the preview index are recorded as being
+    built from the current templates.
+    """
+    from . import cache, tex
+    previewCache = cache.previewCache()
+    indexed = previewCache.officialSnippets() if previewCache else set()
+    unindexed = []
+
+    def jobs():
+        for exercise in exercises:
+            missing = []
+            for textype in "exercise", "solution":
+                for lang, code in exercise["tex_" + textype].items():
+                    if not hasPreview(exercise, textype, lang):
+                        missing.append((textype, lang, code))
+                    elif (exercise.creator, exercise.number, textype, lang) not in indexed:
+                        unindexed.append((exercise.creator, exercise.number, textype, lang))
+            if len(missing) == 0:
+                continue
+            files = loadFiles(exercise.creator, exercise.number, exercise.data_files)
+            for textype, lang, code in missing:
+                logging.info('Compiling initial TeX preview of {}/{}/{}'
+                             .format(exercise, textype, lang))
+                yield (exercise, textype, lang), code, lang, exercise.tex_preamble, files
+
+    installPreviews(jobs(), workers)
+    if previewCache and len(unindexed):
+        previewCache.recordOfficial(unindexed, tex.templateRevision())
+
+
+def rebuildPreviews(snippets, workers=None, cancelled=None):
+    """Recompile the official previews of *snippets*, which is an iterable of (creator, number,
+    textype, lang) tuples.
+
+    The exercises are read from the XML files in the repository. Snippets that no longer exist
+    are removed from the preview index; snippets that fail to compile are logged and skipped.
+    The rebuild stops when the :class:`threading.Event` *cancelled* is set (see
+    :func:`installPreviews`).
+    """
+    from itertools import groupby
+    from . import cache
+    previewCache = cache.previewCache()
+
+    def jobs():
+        for (creator, number), group in groupby(sorted(snippets), key=lambda s: s[:2]):
+            if cancelled is not None and cancelled.is_set():
+                return
+            if not exists(xmlPath(creator=creator, number=number)):
+                if previewCache:
+                    previewCache.forgetOfficial(creator, number)
+                continue
+            exercise = loadFromXML(creator, number)
+            files = loadFiles(creator, number, exercise.data_files)
+            for _, _, textype, lang in group:
+                if lang not in exercise["tex_" + textype]:
+                    if previewCache:
+                        previewCache.forgetOfficial(creator, number, textype, lang)
                     continue
-                if not compileAll and old:
-                    try:
-                        if old["tex_"+textype][lang] == code:
-                            ret[textype, lang] = ("preview", target)
-                            continue
-                    except KeyError:
-                        pass
-                if init:
-                    logging.info('Compiling initial TeX preview of {}/{}/{}'
-                                 .format(exercise, textype, lang))
-                imgpath = tex.makePreview(code, lang, exercise.tex_preamble, files)
-                ret[textype, lang] = ("temp", imgpath)
-                if copy:
-                    shutil.copy(imgpath, target)
-                    shutil.rmtree(dirname(imgpath))
-            except tex.CompilationError as e:
-                e.textype = textype
-                e.lang = lang
-                e.successful = ret
-                raise e
-    return ret
+                logging.info('Rebuilding TeX preview of {}/{}/{}'.format(exercise, textype, lang))
+                code = exercise["tex_" + textype][lang]
+                yield (exercise, textype, lang), code, lang, exercise.tex_preamble, files
+
+    installPreviews(jobs(), workers, cancelled)
+
+
+def forgetPreview(creator, number, textype=None, lang=None):
+    """Remove official previews of an exercise (or one snippet) from the preview index."""
+    from . import cache
+    previewCache = cache.previewCache()
+    if previewCache:
+        previewCache.forgetOfficial(creator, number, textype, lang)
 
 
 def addExercise(exercise, files):
@@ -223,7 +460,8 @@ def addExercise(exercise, files):
     try:
         pushIfRemote()
     finally:
-        compileSnippets(exercise, files, copy=True)
+        compileSnippets(exercise, loadFiles(exercise.creator, exercise.number, files),
+                        copy=True)
 
 
 def updateExercise(exercise, files, old, user=None):
@@ -241,7 +479,11 @@ def updateExercise(exercise, files, old, user=None):
         dct = old["tex_"+textype]
         for lang in dct:
             if lang not in exercise["tex_"+textype]:
-                os.remove(join(basePath, "{}_{}.png".format(textype, lang)))
+                from . import tex
+                for output, _ in tex.OUTPUTS:
+                    if exists(snippetTarget(exercise, textype, lang, output)):
+                        os.remove(snippetTarget(exercise, textype, lang, output))
+                forgetPreview(exercise.creator, exercise.number, textype, lang)
     # add newly uploaded files
     for fname, fdata in files.items():
         fPath = join(basePath, fname)
@@ -255,7 +497,8 @@ def updateExercise(exercise, files, old, user=None):
     try:
         pushIfRemote()
     finally:
-        compileSnippets(exercise, files, old, copy=True)
+        compileSnippets(exercise, loadFiles(exercise.creator, exercise.number, files), old,
+                        copy=True)
 
 
 def removeExercise(creator, number, user=None):
@@ -266,6 +509,7 @@ def removeExercise(creator, number, user=None):
     callHg("commit", "-u", user or creator, "-m", commitMessage)
     if exists(path):
         shutil.rmtree(path)
+    forgetPreview(creator, number)
     pushIfRemote()
 
 
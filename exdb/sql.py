@@ -5,16 +5,205 @@
 # it under the terms of the GNU General Public License version 3 as
 # published by the Free Software Foundation
 
-import json, sqlite3
+import base64, json, logging, sqlite3, threading
 import re
-from os.path import dirname, exists, join
-from itertools import product
-from collections import OrderedDict
+from os.path import dirname, join
+from urllib.parse import quote
+from itertools import islice
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
-from datetime import datetime
+from functools import partial, reduce
+from operator import or_
 
+from . import trace
 from .exercise import Exercise
 
+MIGRATIONS = [
+    # 1: state of the repository files at the last syncDatabase
+    """
+    CREATE TABLE IF NOT EXISTS repository_files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        hash TEXT NOT NULL
+    );
+    """,
+    # 2: full-text index of descriptions and TeX code, maintained by triggers
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS exercises_fts USING fts5(
+        description, exercise, solution,
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS exercisesFtsInsert AFTER INSERT ON exercises BEGIN
+        INSERT INTO exercises_fts(rowid, description, exercise, solution) VALUES (
+            NEW.id, NEW.description,
+            (SELECT group_concat(value, char(10)) FROM json_each(NEW.tex_exercise)),
+            (SELECT group_concat(value, char(10)) FROM json_each(NEW.tex_solution)));
+    END;
+    CREATE TRIGGER IF NOT EXISTS exercisesFtsUpdate
+    AFTER UPDATE OF description, tex_exercise, tex_solution ON exercises BEGIN
+        UPDATE exercises_fts SET description = NEW.description,
+            exercise = (SELECT group_concat(value, char(10)) FROM json_each(NEW.tex_exercise)),
+            solution = (SELECT group_concat(value, char(10)) FROM json_each(NEW.tex_solution))
+            WHERE rowid = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS exercisesFtsDelete AFTER DELETE ON exercises BEGIN
+        DELETE FROM exercises_fts WHERE rowid = OLD.id;
+    END;
+    INSERT INTO exercises_fts(rowid, description, exercise, solution)
+        SELECT id, description,
+            (SELECT group_concat(value, char(10)) FROM json_each(tex_exercise)),
+            (SELECT group_concat(value, char(10)) FROM json_each(tex_solution))
+        FROM exercises;
+    """,
+    # 3: one row per TeX snippet instead of the JSON columns tex_exercise and tex_solution
+    """
+    CREATE TABLE IF NOT EXISTS exercises_tex (
+        exercise INTEGER NOT NULL,
+        textype TEXT NOT NULL,
+        lang TEXT NOT NULL,
+        code TEXT NOT NULL,
+        PRIMARY KEY (exercise, textype, lang),
+        FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE
+    );
+    CREATE INDEX IF NOT EXISTS idxTexLang ON exercises_tex (lang, textype);
+    INSERT INTO exercises_tex(exercise, textype, lang, code)
+        SELECT exercises.id, 'exercise', key, value
+            FROM exercises, json_each(exercises.tex_exercise)
+        UNION ALL
+        SELECT exercises.id, 'solution', key, value
+            FROM exercises, json_each(exercises.tex_solution);
+    DROP TRIGGER exercisesFtsInsert;
+    DROP TRIGGER exercisesFtsUpdate;
+    CREATE TRIGGER exercisesFtsInsert AFTER INSERT ON exercises BEGIN
+        INSERT INTO exercises_fts(rowid, description) VALUES (NEW.id, NEW.description);
+    END;
+    CREATE TRIGGER exercisesFtsUpdate AFTER UPDATE OF description ON exercises BEGIN
+        UPDATE exercises_fts SET description = NEW.description WHERE rowid = NEW.id;
+    END;
+    CREATE TRIGGER exercisesTexFtsInsert AFTER INSERT ON exercises_tex BEGIN
+        UPDATE exercises_fts SET
+            exercise = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                        WHERE exercise = NEW.exercise AND textype = 'exercise'),
+            solution = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                        WHERE exercise = NEW.exercise AND textype = 'solution')
+            WHERE rowid = NEW.exercise;
+    END;
+    CREATE TRIGGER exercisesTexFtsDelete AFTER DELETE ON exercises_tex BEGIN
+        UPDATE exercises_fts SET
+            exercise = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                        WHERE exercise = OLD.exercise AND textype = 'exercise'),
+            solution = (SELECT group_concat(code, char(10)) FROM exercises_tex
+                        WHERE exercise = OLD.exercise AND textype = 'solution')
+            WHERE rowid = OLD.exercise;
+    END;
+    ALTER TABLE exercises DROP COLUMN tex_exercise;
+    ALTER TABLE exercises DROP COLUMN tex_solution;
+    """,
+    # 4: index for the default order of exercises()
+    """
+    CREATE INDEX IF NOT EXISTS idxModified ON exercises (modified);
+    """,
+    # 5: exercises reference their tags by id; tags keep their order in the tag tree
+    """
+    ALTER TABLE tags ADD COLUMN position INTEGER;
+    INSERT INTO tags(name, is_tag, mat_path)
+        SELECT DISTINCT tag, 1, COALESCE((SELECT '.' || id || '.' FROM tags WHERE NOT is_tag
+                                          AND mat_path = '.' AND name = 'uncategorized'), '.')
+        FROM exercises_tags WHERE tag NOT IN (SELECT name FROM tags WHERE is_tag);
+    UPDATE tags SET position = id;
+    CREATE TABLE exercises_tag_ids (
+        exercise INTEGER NOT NULL,
+        tag INTEGER NOT NULL,
+        FOREIGN KEY(exercise) REFERENCES exercises(id) ON DELETE CASCADE,
+        FOREIGN KEY(tag) REFERENCES tags(id)
+    );
+    INSERT INTO exercises_tag_ids(exercise, tag)
+        SELECT exercise, (SELECT MIN(id) FROM tags WHERE is_tag AND name = exercises_tags.tag)
+        FROM exercises_tags ORDER BY rowid;
+    DROP TABLE exercises_tags;
+    ALTER TABLE exercises_tag_ids RENAME TO exercises_tags;
+    CREATE INDEX idxExTags ON exercises_tags (tag);
+    """,
+    # 6: closure table of the tag hierarchy
+    """
+    CREATE TABLE IF NOT EXISTS tags_closure (
+        ancestor INTEGER NOT NULL,
+        descendant INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor, descendant),
+        FOREIGN KEY(ancestor) REFERENCES tags(id) ON DELETE CASCADE,
+        FOREIGN KEY(descendant) REFERENCES tags(id) ON DELETE CASCADE
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idxClosureDescendant ON tags_closure (descendant, depth);
+    INSERT INTO tags_closure(ancestor, descendant, depth)
+        SELECT a.id, d.id, length(d.mat_path) - length(replace(d.mat_path, '.', ''))
+                           - length(a.mat_path) + length(replace(a.mat_path, '.', ''))
+        FROM tags AS d JOIN tags AS a
+        ON a.id = d.id OR d.mat_path LIKE a.mat_path || a.id || '.%';
+    """,
+    # 7: unique exercise identifiers, allocated from a per-creator sequence; indexes on the
+    #    exercise columns of the child tables. Duplicates left over by racing writers keep their
+    #    rows but get new numbers following the highest number of their creator
+    """
+    CREATE TEMP TABLE duplicates AS
+        SELECT id, creator, number AS old, ROW_NUMBER() OVER (PARTITION BY creator ORDER BY id)
+            + (SELECT MAX(number) FROM exercises AS e WHERE e.creator = d.creator) AS number
+        FROM exercises AS d
+        WHERE id NOT IN (SELECT MIN(id) FROM exercises GROUP BY creator, number);
+    INSERT INTO migration_log(message)
+        SELECT printf('exercise %d duplicated the identifier %s%d and was renumbered to %s%d',
+                      id, creator, old, creator, number)
+        FROM duplicates ORDER BY id;
+    UPDATE exercises SET number = (SELECT number FROM duplicates WHERE id = exercises.id)
+        WHERE id IN (SELECT id FROM duplicates);
+    DROP TABLE duplicates;
+    CREATE UNIQUE INDEX IF NOT EXISTS idxIdentifier ON exercises (creator, number);
+    CREATE INDEX IF NOT EXISTS idxTagsExercise ON exercises_tags (exercise);
+    CREATE INDEX IF NOT EXISTS idxPreamblesExercise ON exercises_preambles (exercise);
+    CREATE INDEX IF NOT EXISTS idxFilesExercise ON exercises_files (exercise);
+    CREATE TABLE IF NOT EXISTS exercise_numbers (
+        creator TEXT PRIMARY KEY,
+        number INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    INSERT INTO exercise_numbers(creator, number)
+        SELECT creator, MAX(number) FROM exercises GROUP BY creator;
+    """,
+    # 8: counter of the changes of the exercise tags, which invalidate the tag index
+    """
+    CREATE TABLE IF NOT EXISTS tags_generation (
+        generation INTEGER NOT NULL
+    );
+    INSERT INTO tags_generation(generation)
+        SELECT 0 WHERE NOT EXISTS (SELECT * FROM tags_generation);
+    """,
+]
+"""SQL scripts upgrading the schema of existing databases, applied in order.
+
+The schema version of a database (``PRAGMA user_version``) is the number of migrations applied to
+it. New databases are created by dbschema.sql, which contains the schema resulting from all
+migrations, with the latest version. New schema changes must be appended to this list and made in
+dbschema.sql as well; existing entries must never be modified. Scripts report changes of existing
+data by inserting messages into the temporary table *migration_log*; :func:`migrate` logs them as
+warnings.
+"""
+
+
+BUSY_TIMEOUT = 30
+"""Time in seconds a connection waits for locks held by other connections before failing."""
+
+SQLITE_VERSION = (3, 35, 0)
+"""Minimum version of the SQLite library, which must also include the FTS5 and JSON1 extensions.
+
+Earlier versions lack ``ALTER TABLE ... DROP COLUMN``, used by the migrations, and ``RETURNING``
+clauses, used by :func:`allocateNumber`.
+"""
+
+_local = threading.local()
+_pooled = []
+_pooledLock = threading.Lock()
+_poolGeneration = 0
+
 
 def sqlPath():
     """Return the absolute path of the sqlite database."""
@@ -36,56 +225,192 @@ def icontains(base, search):
     return all(bit.lower() in base.lower() for bit in search.split())
 
 
-def dumpTexDict(code):
-    """Dump given lang-to-texcode dictionary (exercise or solution) to a JSON string."""
-    return json.dumps(code, ensure_ascii=False, sort_keys=True, indent=2)
+def connect(readonly=False, check_same_thread=True):
+    """Connect to the database and return the connection object.
+
+    If *readonly* is True, the database is opened in read-only mode. Locks held by other
+    connections are waited for up to :data:`BUSY_TIMEOUT` seconds. While tracing is enabled
+    (see :mod:`exdb.trace`), the connection reports its statements to the tracer.
+    """
+    traced = trace.tracer is not None
+    factory = trace.TracedConnection if traced else sqlite3.Connection
+    if readonly:
+        conn = sqlite3.connect("file:{}?mode=ro".format(quote(sqlPath())), uri=True,
+                               timeout=BUSY_TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=check_same_thread, factory=factory)
+    else:
+        conn = sqlite3.connect(sqlPath(), timeout=BUSY_TIMEOUT,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=check_same_thread, factory=factory)
+        # safe with the WAL journal set up by initDatabase
+        conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    for name, function in ("REGEXP", regexp), ("CONTAINS", icontains):
+        conn.create_function(name, 2, trace.timed(name, function) if traced else function)
+    conn.row_factory = sqlite3.Row
+    return conn
 
-sqlite3.register_adapter(dict, dumpTexDict)
-#sqlite3.register_adapter(datetime, lambda date: date.strftime(Exercise.DATEFMT))
 
+def pooledConnection(readonly=False):
+    """Return the calling thread's connection to the database, creating it if necessary.
 
-def parseTexDict(dump):
-    return json.loads(dump.decode('utf-8'))
+    Every thread has one read-write and one read-only connection, which are reused by all
+    functions of this module called without a connection. Since the database uses the WAL
+    journal, readers do not wait for writers. The connections of threads that have finished are
+    closed when a new one is created. When tracing is enabled or disabled (see :mod:`exdb.trace`),
+    a connection is replaced on its next use outside of a transaction. After
+    :func:`closeConnections`, every thread opens new connections.
+    """
+    path = sqlPath()
+    if getattr(_local, "generation", None) != _poolGeneration:
+        _local.__dict__.clear()  # closed by closeConnections
+        _local.generation = _poolGeneration
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn, tracer = connections.get((path, readonly), (None, None))
+    depths = _local.__dict__.setdefault("depths", {})
+    if conn is not None and tracer is not trace.tracer and not conn.in_transaction \
+            and not depths.get(conn):
+        with _pooledLock:
+            _pooled[:] = [entry for entry in _pooled if entry[1] is not conn]
+        depths.pop(conn, None)
+        conn.close()
+        conn = None
+    if conn is None:
+        conn = connect(readonly, check_same_thread=False)
+        connections[path, readonly] = conn, trace.tracer
+        with _pooledLock:
+            finished = [entry for entry in _pooled if not entry[0].is_alive()]
+            _pooled[:] = [entry for entry in _pooled if entry[0].is_alive()]
+            _pooled.append((threading.current_thread(), conn))
+        for _, other in finished:
+            other.close()
+    return conn
 
-sqlite3.register_converter("TEXDICT", parseTexDict)
-#sqlite3.register_converter("DATETIME", lambda s: datetime.strptime(s, Exercise.DATEFMT))
 
+def closeConnections():
+    """Close the pooled connections of all threads, e.g. before the database file is removed.
 
-def connect():
-    """Connect to the database and return the connection object."""
-    conn = sqlite3.connect(sqlPath(), detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.execute("PRAGMA foreign_keys = ON;")
-    conn.create_function("REGEXP", 2, regexp)
-    conn.create_function("CONTAINS", 2, icontains)
-    conn.row_factory = sqlite3.Row
-    return conn
+    The threads notice this by the pool generation and open new connections on their next use
+    of the pool. A background recompilation of previews is stopped first (see
+    :func:`exdb.stopRefresh`).
+    """
+    import exdb
+    global _poolGeneration
+    exdb.stopRefresh()
+    with _pooledLock:
+        connections = list(_pooled)
+        del _pooled[:]
+        _poolGeneration += 1
+    for _, conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    searchCache.reset()
+    resetTagIndex()
 
 
 @contextmanager
-def conditionalConnect(connection):
+def conditionalConnect(connection, readonly=False):
     """Context manager returning a SQLite connection.
     
-    Yields *connection* if it is not None; otherwise, a new connection is established. In the 
-    latter case, the connection is closed after exiting the with statement.
+    Yields *connection* if it is not None; otherwise, the calling thread's pooled connection
+    (read-only if *readonly* is set, see :func:`pooledConnection`) is used. In the latter case,
+    changes not committed within the outermost with statement are rolled back, as if a
+    connection of its own had been closed. While the with statement is executed, the connection
+    is :func:`open <connectionOpen>` in the calling thread.
     """
-    conn = connection or connect()    
-    yield conn
-    if not connection:
+    conn = connection or pooledConnection(readonly)
+    depths = _local.__dict__.setdefault("depths", {})
+    depth = depths.get(conn, 0)
+    depths[conn] = depth + 1
+    try:
+        yield conn
+    finally:
+        if depth:
+            depths[conn] = depth
+        else:
+            depths.pop(conn, None)
+        if not connection and depth == 0 and conn.in_transaction:
+            conn.rollback()
+
+
+def connectionOpen(conn):
+    """Return whether the calling thread is inside a :func:`conditionalConnect` statement
+    yielding *conn*.
+    """
+    return _local.__dict__.get("depths", {}).get(conn, 0) > 0
+
+
+def checkSQLite():
+    """Raise a RuntimeError if the SQLite library does not meet the requirements described in
+    :data:`SQLITE_VERSION`.
+    """
+    if sqlite3.sqlite_version_info < SQLITE_VERSION:
+        raise RuntimeError("exdb requires SQLite {} or later, but the installed version is {}"
+                           .format(".".join(map(str, SQLITE_VERSION)), sqlite3.sqlite_version))
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+        conn.execute("SELECT json_each.value FROM json_each('[1]')")
+    except sqlite3.OperationalError as e:
+        raise RuntimeError("exdb requires SQLite with the FTS5 and JSON1 extensions: {}"
+                           .format(e))
+    finally:
         conn.close()
 
 
 def initDatabase():
-    """Initialize the database. Returns whether or not the tables have been newly created."""
-    if exists(sqlPath()):
-        with connect() as db:
-            if db.execute("SELECT count(*) FROM sqlite_master "
-                          "WHERE type='table' AND name='exercises'").fetchone()[0]:
-                return False
-    with connect() as db:
-        with open(join(dirname(__file__), 'dbschema.sql'), "rt") as schema:
-            db.cursor().executescript(schema.read())
-    db.close()
-    return True
+    """Initialize the database and apply pending :data:`MIGRATIONS`.
+
+    Returns whether or not the tables have been newly created. Raises a RuntimeError before
+    touching the database if SQLite is too old (see :func:`checkSQLite`).
+    """
+    checkSQLite()
+    conn = connect()
+    try:
+        created = not conn.execute("SELECT count(*) FROM sqlite_master "
+                                   "WHERE type='table' AND name='exercises'").fetchone()[0]
+        if created:
+            with open(join(dirname(__file__), 'dbschema.sql'), "rt") as schema:
+                conn.executescript(schema.read())
+            conn.execute("PRAGMA user_version = {}".format(len(MIGRATIONS)))
+        conn.execute("PRAGMA journal_mode = WAL;")
+        migrate(conn)
+    finally:
+        conn.close()
+    return created
+
+
+def migrate(conn):
+    """Apply the :data:`MIGRATIONS` not yet applied to the database of *conn*.
+
+    Each migration runs in its own transaction together with the update of the schema version.
+    Returns the number of applied migrations.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS migration_log (message TEXT NOT NULL)")
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.executescript("BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;"
+                           .format(script, number))
+        for message, in conn.execute("SELECT message FROM migration_log ORDER BY rowid"):
+            logging.warning("Migration {}: {}".format(number, message))
+        conn.executescript("DELETE FROM migration_log")
+    conn.execute("DROP TABLE migration_log")
+    return max(len(MIGRATIONS) - version, 0)
+
+
+CLOSURE_FILL = """INSERT INTO tags_closure(ancestor, descendant, depth)
+    SELECT a.id, d.id, length(d.mat_path) - length(replace(d.mat_path, '.', ''))
+                       - length(a.mat_path) + length(replace(a.mat_path, '.', ''))
+    FROM tags AS d JOIN tags AS a ON a.id = d.id OR d.mat_path LIKE a.mat_path || a.id || '.%'"""
+"""Statement filling the empty *tags_closure* table from the materialized paths of the tags.
+
+The table contains a row for every category or tag (*descendant*) and each of its ancestors as
+well as itself (*ancestor*), together with their distance in the tree (*depth*).
+"""
 
 
 def tags(conn):
@@ -93,52 +418,272 @@ def tags(conn):
     return [r[0] for r in conn.execute("SELECT name FROM tags WHERE is_tag")]
         
 
-def addMissingTags(exid, cursor):
-    """Adds missing tags in exercise with id *exid* to the database (under 'uncategorized').
+def texRows(exid, exercise):
+    """Return the rows of the *exercises_tex* table for *exercise*, which has the id *exid*."""
+    return [(exid, textype, lang, code) for textype in ("exercise", "solution")
+            for lang, code in sorted(exercise["tex_" + textype].items())]
+
+
+def readTex(conn, where=""):
+    """Read the *exercises_tex* table, restricted by the SQL clause *where*.
+
+    Returns a dict mapping exercise ids to dicts with the keys "tex_exercise" and "tex_solution",
+    which map languages to TeX code.
+    """
+    tex = {}
+    for row in conn.execute("SELECT exercise, textype, lang, code FROM exercises_tex {} "
+                            "ORDER BY exercise, textype, lang".format(where)):
+        if row[0] not in tex:
+            tex[row[0]] = dict(tex_exercise={}, tex_solution={})
+        tex[row[0]]["tex_" + row[1]][row[2]] = row[3]
+    return tex
+
+
+def tagIdsByName(cursor):
+    """Return a dict mapping the names of all tags to their ids.
+
+    Of several tags with the same name, the one with the smallest id is used.
+    """
+    return dict(cursor.execute("SELECT name, MIN(id) FROM tags WHERE is_tag GROUP BY name"))
+
+
+def tagIds(names, cursor):
+    """Return a dict mapping the tag *names* to their ids (see :func:`tagIdsByName`).
+
+    Tags that do not exist yet are added to the database (under 'uncategorized').
     """
-    result = cursor.execute("SELECT tag FROM exercises_tags WHERE exercise = ? AND tag NOT IN "
-                            "(SELECT name FROM tags WHERE is_tag)", (exid,))
-    newTags = [row[0] for row in result]
+    ids = tagIdsByName(cursor)
+    newTags = [name for name in OrderedDict.fromkeys(names) if name not in ids]
     if len(newTags):
         uncatId = cursor.execute("SELECT id FROM tags "
                                  "WHERE NOT is_tag AND mat_path='.' AND name='uncategorized'"
                                  ).fetchone()[0]
-        cursor.executemany("INSERT INTO tags(name, is_tag, mat_path) "
-                           "VALUES (?,1,?)", product(newTags, [".{}.".format(uncatId)]))
+        position = cursor.execute("SELECT COALESCE(MAX(position), 0) FROM tags").fetchone()[0]
+        for position, name in enumerate(newTags, start=position + 1):
+            cursor.execute("INSERT INTO tags(name, is_tag, mat_path, position) VALUES (?,1,?,?)",
+                           (name, ".{}.".format(uncatId), position))
+            ids[name] = cursor.lastrowid
+            cursor.execute("INSERT INTO tags_closure(ancestor, descendant, depth) "
+                           "SELECT ancestor, ?, depth + 1 FROM tags_closure WHERE descendant=? "
+                           "UNION ALL SELECT ?, ?, 0", (ids[name], uncatId, ids[name], ids[name]))
+    return ids
+
+
+def allocateNumber(creator, cursor):
+    """Allocate and return the next number of an exercise of *creator*.
+
+    The numbers are taken from the per-creator sequence in the *exercise_numbers* table. Since
+    the allocation is a single write statement, it is atomic even with concurrent writers; the
+    number is never allocated again, even if the transaction is rolled back, or the exercise is
+    removed later.
+    """
+    return cursor.execute("INSERT INTO exercise_numbers(creator, number) VALUES (?, 1) "
+                          "ON CONFLICT(creator) DO UPDATE SET number = number + 1 "
+                          "RETURNING number", (creator,)).fetchall()[0][0]
+
+
+def reserveNumbers(identifiers, cursor):
+    """Advance the sequences of :func:`allocateNumber` past the numbers of the (creator, number)
+    pairs in *identifiers*, which are added to the database with given numbers.
+    """
+    cursor.executemany("INSERT INTO exercise_numbers(creator, number) VALUES (?, ?) "
+                       "ON CONFLICT(creator) DO UPDATE SET number = MAX(number, excluded.number)",
+                       identifiers)
+
+
+def commitWrite(conn, deferCommit, inTransaction=False, update=None):
+    """Commit the changes made by a write function of this module with *conn*, unless
+    *deferCommit* is set, and start a new generation of :data:`searchCache`.
+
+    *update* is a function applying the changes to a :class:`TagIndex`; it must be given by the
+    functions that change the tags or the set of exercises. Their changes start a new tags
+    generation of the database (see :func:`tagIndex`). If the changes are committed here, *conn*
+    was not *inTransaction* before they were made and the current index of :func:`tagIndex` is
+    that of the previous tags generation, the index is replaced by an updated copy. Otherwise,
+    it is rebuilt on next use.
+    """
+    global _tagIndex
+    generation = None
+    if update is not None:
+        # the write lock held from here on orders the generations of all writers
+        conn.execute("UPDATE tags_generation SET generation = generation + 1")
+        generation = conn.execute("SELECT generation FROM tags_generation").fetchone()[0]
+    if deferCommit:
+        searchCache.bump()
+        return
+    conn.commit()
+    searchCache.bump(sync=True)
+    if generation is None or inTransaction:
+        return
+    with _tagIndexLock:
+        if _tagIndex is not None and _tagIndex.generation == generation - 1:
+            index = _tagIndex.copy()
+            update(index)
+            index.generation = generation
+            _tagIndex = index
 
 
 def addExercise(exercise, connection=None, deferCommit=False):
-    """Adds the given exercise to the database."""
+    """Adds the given exercise to the database.
+
+    If the exercise does not have a number yet, it is set to the next one of its creator (see
+    :func:`allocateNumber`). Adding an exercise whose creator and number are already in use
+    raises a sqlite3.IntegrityError.
+    """
     with conditionalConnect(connection) as conn:
-        if exercise.number is None:
-            maxnr = conn.execute("SELECT MAX(number) FROM exercises WHERE creator=?",
-                                 (exercise.creator,)).fetchone()[0]
-            exercise.number = 1 if maxnr is None else maxnr + 1
+        inTransaction = conn.in_transaction
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO exercises(creator, number, description, modified, "
-                     "tex_exercise, tex_solution) VALUES (?,?,?,?,?,?)",
-                     [exercise.creator, exercise.number, exercise.description,
-                      exercise.modified, exercise.tex_exercise, exercise.tex_solution])
+        if exercise.number is None:
+            exercise.number = allocateNumber(exercise.creator, cursor)
+        else:
+            reserveNumbers([(exercise.creator, exercise.number)], cursor)
+        cursor.execute("INSERT INTO exercises(creator, number, description, modified) "
+                       "VALUES (?,?,?,?)",
+                       [exercise.creator, exercise.number, exercise.description,
+                        exercise.modified])
         exid = cursor.lastrowid
+        cursor.executemany("INSERT INTO exercises_tex(exercise, textype, lang, code) "
+                           "VALUES (?,?,?,?)", texRows(exid, exercise))
         cursor.executemany("INSERT INTO exercises_preambles(exercise, preamble) VALUES (?,?)",
                            [ (exid, preamble) for preamble in exercise.tex_preamble ])
         cursor.executemany("INSERT INTO exercises_files(exercise, filename) VALUES (?,?)",
                            [ (exid, filename) for filename in exercise.data_files ])
+        ids = tagIds(exercise.tags, cursor)
         cursor.executemany("INSERT INTO exercises_tags(exercise,tag) VALUES (?,?)",
-                           [ (exid,tag) for tag in exercise.tags ])
-        addMissingTags(exid, cursor)
-        if not deferCommit:
-            conn.commit()
+                           [ (exid, ids[tag]) for tag in exercise.tags ])
+        commitWrite(conn, deferCommit, inTransaction,
+                    lambda index: index.add(exid, [ids[tag] for tag in exercise.tags]))
+
+
+FTS_FILL = """INSERT INTO exercises_fts(rowid, description, exercise, solution)
+    SELECT id, description,
+        (SELECT group_concat(code, char(10)) FROM exercises_tex
+         WHERE exercise = id AND textype = 'exercise'),
+        (SELECT group_concat(code, char(10)) FROM exercises_tex
+         WHERE exercise = id AND textype = 'solution')
+    FROM exercises"""
+"""Statement adding exercises to the full-text index, like the triggers of the exercise tables."""
+
+BATCH_SIZE = 1000
+"""Number of exercises inserted per ``executemany`` batch by :func:`addExercises`."""
+
+
+def addExercises(exercises, connection=None, deferCommit=False, deferIndexes=False):
+    """Add all exercises of the iterable *exercises*, which must have numbers, to the database.
+
+    This is much faster than calling :func:`addExercise` for every exercise: the exercises are
+    consumed lazily and inserted in batches of :data:`BATCH_SIZE`, and the missing tags are added
+    once per batch. If *deferIndexes* is set, the indexes and triggers of the exercise tables are
+    dropped before and recreated after inserting, and the full-text index is filled in one go,
+    which pays off when loading a large number of exercises into an empty database. Returns the
+    number of added exercises.
+    """
+    tables = ("exercises", "exercises_tex", "exercises_preambles", "exercises_files",
+              "exercises_tags")
+    count = 0
+    added = []
+    with conditionalConnect(connection) as conn:
+        inTransaction = conn.in_transaction
+        cursor = conn.cursor()
+        deferred = []
+        if deferIndexes:
+            deferred = cursor.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN "
+                                      "('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN "
+                                      "({})".format(",".join("?"*len(tables))), tables).fetchall()
+            for type, name, _ in deferred:
+                cursor.execute("DROP {} {}".format(type.upper(), name))
+        nextId = max(cursor.execute("SELECT COALESCE(MAX(id), 0) FROM exercises").fetchone()[0],
+                     cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence "
+                                    "WHERE name='exercises'").fetchone()[0]) + 1
+        exercises = iter(exercises)
+        while True:
+            batch = list(islice(exercises, BATCH_SIZE))
+            if not batch:
+                break
+            ids = range(nextId, nextId + len(batch))
+            cursor.executemany("INSERT INTO exercises(id, creator, number, description, modified) "
+                               "VALUES (?,?,?,?,?)",
+                               [(id, ex.creator, ex.number, ex.description, ex.modified)
+                                for id, ex in zip(ids, batch)])
+            cursor.executemany("INSERT INTO exercises_tex(exercise, textype, lang, code) "
+                               "VALUES (?,?,?,?)",
+                               [row for id, ex in zip(ids, batch) for row in texRows(id, ex)])
+            cursor.executemany("INSERT INTO exercises_preambles(exercise, preamble) VALUES (?,?)",
+                               [(id, preamble) for id, ex in zip(ids, batch)
+                                for preamble in ex.tex_preamble])
+            cursor.executemany("INSERT INTO exercises_files(exercise, filename) VALUES (?,?)",
+                               [(id, filename) for id, ex in zip(ids, batch)
+                                for filename in ex.data_files])
+            tags = tagIds((tag for ex in batch for tag in ex.tags), cursor)
+            cursor.executemany("INSERT INTO exercises_tags(exercise, tag) VALUES (?,?)",
+                               [(id, tags[tag]) for id, ex in zip(ids, batch) for tag in ex.tags])
+            added.extend((id, [tags[tag] for tag in ex.tags]) for id, ex in zip(ids, batch))
+            numbers = {}
+            for ex in batch:
+                numbers[ex.creator] = max(numbers.get(ex.creator, ex.number), ex.number)
+            reserveNumbers(numbers.items(), cursor)
+            nextId += len(batch)
+            count += len(batch)
+        if deferIndexes:
+            cursor.execute(FTS_FILL + " WHERE id >= ?", (nextId - count,))
+        for _, _, sql in deferred:
+            cursor.execute(sql)
+
+        def update(index):
+            for id, tags in added:
+                index.add(id, tags)
+        commitWrite(conn, deferCommit, inTransaction, update)
+    return count
+
+
+def subtreeTags(conn, categories):
+    """Return the set of names of the tags contained in the *categories*, which are given by id.
+    """
+    return set(row[0] for row in conn.execute(
+        "SELECT name FROM tags JOIN tags_closure ON descendant = tags.id "
+        "WHERE is_tag AND ancestor IN ({})".format(", ".join(str(int(id)) for id in categories))))
+
+
+def updateTags(renames, deletes, connection=None, deferCommit=False):
+    """Rename and delete tags.
+
+    *renames* maps ids of tags to their new names, and the tags with the ids in *deletes* are
+    removed from all exercises. Returns the list of the ids of the affected exercises.
+    """
+    with conditionalConnect(connection) as conn:
+        inTransaction = conn.in_transaction
+        cursor = conn.cursor()
+        changed = ", ".join(str(id) for id in list(renames) + list(deletes))
+        affected = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT exercise FROM exercises_tags WHERE tag IN ({}) ORDER BY exercise"
+            .format(changed))] if changed else []
+        cursor.executemany("UPDATE tags SET name=? WHERE id=?",
+                           [(name, id) for id, name in renames.items()])
+        # a tag renamed to the name of another one is merged into it
+        byName = tagIdsByName(cursor)
+        merges = [(id, byName[name]) for id, name in renames.items() if byName[name] != id]
+        cursor.executemany("UPDATE exercises_tags SET tag=? WHERE tag=?",
+                           [(into, id) for id, into in merges])
+        cursor.executemany("DELETE FROM exercises_tags WHERE tag=?", [(id,) for id in deletes])
+
+        def update(index):
+            for id, into in merges:
+                index.merge(id, into)
+            for id in deletes:
+                index.delete(id)
+        commitWrite(conn, deferCommit, inTransaction, update)
+    return affected
 
 
 def removeUnreferencedTags(curs):
     """Removes from the tags table all tags that are not referenced in any exercise.""" 
-    curs.execute("DELETE FROM tags WHERE is_tag AND name NOT IN (SELECT tag FROM exercises_tags)")
+    curs.execute("DELETE FROM tags WHERE is_tag AND id NOT IN (SELECT tag FROM exercises_tags)")
 
 
-def updateExercise(exercise, connection=None):
+def updateExercise(exercise, connection=None, deferCommit=False):
     """Update the database with modified *exercise*."""
     with conditionalConnect(connection) as conn:
+        inTransaction = conn.in_transaction
         cursor = conn.cursor()
         id = cursor.execute("SELECT id FROM exercises WHERE creator=? AND number=?",
                             (exercise.creator, exercise.number)).fetchone()[0]
@@ -148,122 +693,735 @@ def updateExercise(exercise, connection=None):
         cursor.execute("DELETE FROM exercises_files WHERE exercise=?", (id,))
         cursor.executemany("INSERT INTO exercises_files(exercise, filename) VALUES (?,?)",
                            [ (id, filename) for filename in exercise.data_files ])
-        cursor.execute("UPDATE exercises "
-                       "SET description=?, modified=?, tex_exercise=?, tex_solution=? "
+        cursor.execute("UPDATE exercises SET description=?, modified=? "
                        "WHERE creator=? AND number=?",
-                       [exercise.description, exercise.modified, exercise.tex_exercise,
-                        exercise.tex_solution, exercise.creator, exercise.number])
-        cursor.execute("DELETE FROM exercises_tags WHERE exercise=?", (id,))
+                       [exercise.description, exercise.modified, exercise.creator,
+                        exercise.number])
+        cursor.execute("DELETE FROM exercises_tex WHERE exercise=?", (id,))
+        cursor.executemany("INSERT INTO exercises_tex(exercise, textype, lang, code) "
+                           "VALUES (?,?,?,?)", texRows(id, exercise))
+        old = [row[0] for row in cursor.execute("DELETE FROM exercises_tags WHERE exercise=? "
+                                                "RETURNING tag", (id,)).fetchall()]
+        ids = tagIds(exercise.tags, cursor)
         cursor.executemany("INSERT INTO exercises_tags(exercise,tag) VALUES(?,?)",
-                       [ (id, tag) for tag in exercise.tags])
+                           [ (id, ids[tag]) for tag in exercise.tags])
         removeUnreferencedTags(cursor)
-        addMissingTags(id, cursor)
-        conn.commit()
+
+        def update(index):
+            index.remove(id, old)
+            index.add(id, [ids[tag] for tag in exercise.tags])
+        commitWrite(conn, deferCommit, inTransaction, update)
 
 
-def removeExercise(creator, number, connection=None):
+def removeExercise(creator, number, connection=None, deferCommit=False):
     """Remove the exercise with the given creator and number."""
     with conditionalConnect(connection) as conn:
+        inTransaction = conn.in_transaction
         cursor = conn.cursor()
+        ids = [row[0] for row in cursor.execute(
+            "SELECT id FROM exercises WHERE creator=? AND number=?", (creator, number))]
+        removed = [(id, [row[0] for row in cursor.execute(
+                       "SELECT tag FROM exercises_tags WHERE exercise=?", (id,))]) for id in ids]
         cursor.execute('DELETE FROM exercises WHERE creator=? AND number=?', (creator, number))
         removeUnreferencedTags(cursor)
-        conn.commit()
 
+        def update(index):
+            for id, tags in removed:
+                index.remove(id, tags)
+        commitWrite(conn, deferCommit, inTransaction, update)
+
+
+def repositoryFiles(connection=None):
+    """Return a dict mapping repository paths to the (size, mtime, hash) tuples recorded by
+    :func:`recordRepositoryFiles`.
+    """
+    with conditionalConnect(connection, readonly=True) as conn:
+        return {row[0]: tuple(row[1:]) for row in
+                conn.execute("SELECT path, size, mtime, hash FROM repository_files")}
+
+
+def recordRepositoryFiles(states, removed=(), connection=None, deferCommit=False):
+    """Record the state of repository files the database content corresponds to.
 
-def exercises(ids=None, pagination=None, connection=None):
-    """Return the list of exercises with the given *ids*."""
+    *states* is an iterable of (path, size, mtime, hash) tuples, where *path* is relative to the
+    repository and *mtime* is given in nanoseconds. The records of the paths in *removed* are
+    deleted.
+    """
     with conditionalConnect(connection) as conn:
-        def readTable(name, where="", order="", multi=False):
-            dct = OrderedDict()
-            for row in conn.execute("SELECT * FROM {} {} {}".format(name, where, order)):
-                if multi:
-                    if row[0] in dct:
-                        dct[row[0]].append(row[1])
-                    else:
-                        dct[row[0]] = [ row[1] ]
-                else:  
-                    dct[row[0]] = row
-            return dct
-        if ids:
-            idList = ", ".join(str(id) for id in ids)
-            whereClause = "WHERE id IN ({})".format(idList)
-            whereClause2 = "WHERE exercise IN ({})".format(idList)
+        conn.executemany("INSERT OR REPLACE INTO repository_files(path, size, mtime, hash) "
+                         "VALUES (?,?,?,?)", states)
+        conn.executemany("DELETE FROM repository_files WHERE path=?",
+                         [(path,) for path in removed])
+        if not deferCommit:
+            conn.commit()
+
+
+ORDER_COLUMNS = ("modified", "creator", "number", "description", "id")
+"""Columns of the exercises table that exercise lists can be ordered by."""
+
+
+def encodeCursor(*state):
+    """Return an opaque page cursor (a URL-safe string) encoding the JSON-serializable *state*."""
+    return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+
+def decodeCursor(cursor, length):
+    """Return the state list encoded by :func:`encodeCursor` in *cursor*, which must contain
+    *length* items. Raises a ValueError if *cursor* is malformed.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, AttributeError):
+        state = None
+    if not isinstance(state, list) or len(state) != length:
+        raise ValueError("Invalid page cursor {!r}".format(cursor))
+    return state
+
+
+CHILD_FIELDS = ("tags", "tex_preamble", "data_files", "tex_exercise", "tex_solution")
+"""Exercise attributes stored outside of the exercises table, which can be left out of the
+projection of :func:`exercisePage`."""
+LISTING_FIELDS = ("tags",)
+"""Projection of :func:`exercisePage` for listings of exercises, which usually also show their
+:meth:`~exdb.exercise.Exercise.languages`."""
+
+
+TAG_NAMES = """SELECT exercise, name FROM exercises_tags JOIN tags ON tags.id = exercises_tags.tag
+"""
+"""Query of the (exercise, tag name) pairs, to be completed by a WHERE clause."""
+
+
+def readFields(conn, ids, fields):
+    """Read the *fields* (out of :data:`CHILD_FIELDS`) of the exercises with the given *ids*.
+
+    Returns a dict mapping each field to a dict that maps the ids of the exercises with a
+    non-empty value to that value.
+    """
+    idClause = "WHERE exercise IN ({})".format(", ".join(str(id) for id in ids))
+    values = {}
+    for field, table, query in (
+            ("tags", "exercises_tags", TAG_NAMES),
+            ("tex_preamble", "exercises_preambles", "SELECT exercise, preamble FROM {}"),
+            ("data_files", "exercises_files", "SELECT exercise, filename FROM {}")):
+        if field in fields:
+            values[field] = {}
+            for id, value in conn.execute("{} {} ORDER BY {}.rowid".format(
+                    query.format(table), idClause, table)):
+                values[field].setdefault(id, []).append(value)
+    texFields = [field for field in ("tex_exercise", "tex_solution") if field in fields]
+    if texFields:
+        tex = readTex(conn, "{} AND textype IN ({})".format(
+            idClause, ", ".join("'{}'".format(field[4:]) for field in texFields)))
+        for field in texFields:
+            values[field] = {id: texts[field] for id, texts in tex.items() if texts[field]}
+    return values
+
+
+class PageLoader(object):
+    """Loads the fields left out by the projection of a page of exercises on first access.
+
+    *exercises* maps the ids of the exercises on the page to the Exercise objects. When a
+    missing field of any of them is accessed, it is read for all exercises on the page at once:
+    from *connection*, the connection the page was read from, if it is still
+    :func:`open <connectionOpen>` (so that its uncommitted changes are seen), and from the
+    calling thread's pooled connection otherwise.
+    """
+
+    def __init__(self, exercises, connection=None):
+        self.exercises = exercises
+        self.connection = connection
+
+    def load(self, id, field):
+        connection = self.connection if connectionOpen(self.connection) else None
+        with conditionalConnect(connection, readonly=True) as conn:
+            values = readFields(conn, self.exercises, [field])[field]
+        for exid, exercise in self.exercises.items():
+            if field not in exercise:
+                exercise[field] = values.get(exid, {} if field in ("tex_exercise", "tex_solution")
+                                             else [])
+        return self.exercises[id][field]
+
+
+def exercisePage(ids=None, pagination=None, connection=None, fields=None):
+    """Return a page of the exercises with the given *ids* (all exercises if *ids* is empty).
+
+    The result is a tuple of the list of exercises and a cursor to the next page, which is None
+    on the last page. The dict *pagination* may contain:
+      - *orderby*: one of :data:`ORDER_COLUMNS` (default: "modified"); ties are ordered by id
+      - *descending*: whether to reverse the order
+      - *limit*: maximum number of exercises on the page (default: unlimited)
+      - *after*: a cursor returned for the previous page with the same *orderby* and
+        *descending* entries. Unlike *offset*, which is still supported, this does not scan the
+        exercises on the previous pages.
+    Tags, preambles, files and TeX code are only read for the exercises on the page. If
+    *fields* is given, only those of :data:`CHILD_FIELDS` contained in it are read right away
+    (e.g. :data:`LISTING_FIELDS`); the others are loaded on first access (see
+    :class:`PageLoader`) and are not contained in the exercises' JSON encoding before.
+    """
+    records, nextCursor = pageRecords(ids, pagination, connection, fields)
+    return buildExercises(records, connection), nextCursor
+
+
+def pageRecords(ids=None, pagination=None, connection=None, fields=None):
+    """Like :func:`exercisePage`, but return the page as a tuple of :class:`ExerciseRecord`
+    objects instead of exercises.
+    """
+    if pagination is None:
+        pagination = {}
+    orderby = pagination.get("orderby", "modified")
+    if orderby not in ORDER_COLUMNS:
+        raise ValueError("Cannot order exercises by {!r}".format(orderby))
+    descending = bool(pagination.get("descending"))
+    direction = "DESC" if descending else "ASC"
+    limit = pagination.get("limit", -1)
+    wheres, args = [], []
+    if ids:
+        wheres.append("id IN ({})".format(", ".join(str(id) for id in ids)))
+    if pagination.get("after"):
+        cursorOrder, cursorDescending, value, lastId = decodeCursor(pagination["after"], 4)
+        if (cursorOrder, cursorDescending) != (orderby, descending):
+            raise ValueError("Page cursor does not match the order of the request")
+        op = "<" if descending else ">"
+        # NULL values come first in ascending and last in descending order
+        if value is None:
+            condition = "{} IS NULL AND id {} ?".format(orderby, op)
+            if not descending:
+                condition += " OR {} IS NOT NULL".format(orderby)
+            args.append(lastId)
         else:
-            whereClause = whereClause2 = ""
-        if pagination is None:
-            pagination = {}
-        orderby = pagination.get("orderby", "modified")
-        direction = "DESC" if pagination.get("descending") else "ASC"
-        limit = pagination.get("limit", -1)
-        offset = pagination.get("offset", 0)
-        orderClause="ORDER BY {} {} LIMIT {} OFFSET {}".format(orderby, direction, limit, offset)
-        dbExercises = readTable("exercises", whereClause, orderClause)
-        exercises = []
-        dbTags = readTable("exercises_tags", whereClause2, multi=True)
-        dbPreambles = readTable("exercises_preambles", whereClause2, multi=True)
-        dbFilenames = readTable("exercises_files", whereClause2, multi=True)
-        for id, row in dbExercises.items():
-            exercise = Exercise(creator=row["creator"], number=row["number"],
-                                modified=row["modified"], description=row["description"],
-                                tex_exercise=row["tex_exercise"], tex_solution=row["tex_solution"])
-            if id in dbTags:
-                exercise.tags = dbTags[id]
-            if id in dbPreambles:
-                exercise.tex_preamble = dbPreambles[id]
-            if id in dbFilenames:
-                exercise.data_files = dbFilenames[id]
-            exercises.append(exercise)
-    return exercises
+            condition = "({}, id) {} (?, ?)".format(orderby, op)
+            if descending:
+                condition += " OR {} IS NULL".format(orderby)
+            args.extend((value, lastId))
+        wheres.append("({})".format(condition))
+    whereClause = "WHERE " + " AND ".join(wheres) if wheres else ""
+    # the unary + prevents conversion of the sort key, so that it can be stored in the cursor
+    with conditionalConnect(connection, readonly=True) as conn:
+        rows = conn.execute("SELECT id, creator, number, description, modified, "
+                            "+{0} AS sortkey FROM exercises {1} "
+                            "ORDER BY {0} {2}, id {2} LIMIT ? OFFSET ?".format(
+                                orderby, whereClause, direction),
+                            args + [limit + 1 if limit >= 0 else -1,
+                                    pagination.get("offset", 0)]).fetchall()
+        nextCursor = None
+        if 0 <= limit < len(rows):
+            rows = rows[:limit]
+            if rows:  # an empty page of limit 0 has no position to continue from
+                nextCursor = encodeCursor(orderby, descending, rows[-1]["sortkey"],
+                                          rows[-1]["id"])
+        return readExercises(conn, rows, fields), nextCursor
+
+
+class ExerciseRecord(namedtuple("ExerciseRecord", "id row values langs lazy")):
+    """Immutable snapshot of an exercise read by :func:`readExercises`, from which
+    :func:`buildExercises` creates Exercise objects.
+
+    *row* is the tuple of the *creator*, *number*, *description* and *modified* columns, and
+    *values* contains (field, value) pairs of the non-empty fields of :data:`CHILD_FIELDS` that
+    have been read, with their values converted to tuples. *lazy* are the fields left out by the
+    projection, and *langs* is the tuple of TeX languages if "tex_exercise" is one of them.
+    """
+
+
+def makeExercises(conn, rows, fields=None):
+    """Create the exercises of the given rows of the *exercises* table, projected to *fields*.
+
+    See :func:`readExercises` for the arguments.
+    """
+    return buildExercises(readExercises(conn, rows, fields), conn)
+
+
+def readExercises(conn, rows, fields=None):
+    """Return the tuple of :class:`ExerciseRecord` objects of the given rows of the *exercises*
+    table, projected to *fields*. Rows of the same exercise after the first are skipped.
+
+    The rows need to contain the *id*, *creator*, *number*, *description* and *modified*
+    columns. The fields of :data:`CHILD_FIELDS` are read for all exercises at once, with a fixed
+    number of queries; those not contained in *fields* (if given) are left out as described in
+    :func:`exercisePage`.
+    """
+    if not rows:
+        return ()
+    ids = [row["id"] for row in rows]
+    lazy = tuple(field for field in CHILD_FIELDS if fields is not None and field not in fields)
+    values = readFields(conn, ids, [field for field in CHILD_FIELDS if field not in lazy])
+    languages = {}
+    if "tex_exercise" in lazy:
+        for id, lang in conn.execute("SELECT exercise, lang FROM exercises_tex WHERE "
+                                     "exercise IN ({}) AND textype='exercise' ORDER BY lang"
+                                     .format(", ".join(map(str, ids)))):
+            languages.setdefault(id, []).append(lang)
+    records = OrderedDict()
+    for row in rows:
+        id = row["id"]
+        if id in records:
+            continue
+        frozen = tuple((field, tuple(dct[id].items() if field in ("tex_exercise", "tex_solution")
+                                     else dct[id]))
+                       for field, dct in values.items() if id in dct)
+        langs = tuple(languages.get(id, ())) if "tex_exercise" in lazy else None
+        records[id] = ExerciseRecord(id, (row["creator"], row["number"], row["description"],
+                                          row["modified"]), frozen, langs, lazy)
+    return tuple(records.values())
+
+
+def buildExercises(records, connection=None):
+    """Create new Exercise objects from the :class:`ExerciseRecord` objects in *records*, which
+    have been read from *connection*.
+
+    Fields left out of the records are loaded on first access by a :class:`PageLoader` shared by
+    the exercises.
+    """
+    exercises = OrderedDict()
+    loader = PageLoader(exercises, connection)
+    for record in records:
+        creator, number, description, modified = record.row
+        exercise = Exercise(creator=creator, number=number, description=description,
+                            modified=modified)
+        for field, value in record.values:
+            exercise[field] = (dict(value) if field in ("tex_exercise", "tex_solution")
+                               else list(value))
+        if record.lazy:
+            for field in record.lazy:
+                del exercise[field]
+            exercise.loader = partial(loader.load, record.id)
+            if record.langs is not None:
+                exercise.langs = list(record.langs)
+        exercises[record.id] = exercise
+    return list(exercises.values())
+
+
+def exercises(ids=None, pagination=None, connection=None, fields=None):
+    """Return the list of exercises with the given *ids*, paginated and projected to *fields* as
+    in :func:`exercisePage`.
+    """
+    return exercisePage(ids, pagination, connection, fields)[0]
+
+
+def iterExercises(ids=None, connection=None, chunkSize=BATCH_SIZE):
+    """Generate the exercises with the given *ids* (all exercises if *ids* is None) in the order
+    of their ids.
+
+    Unlike :func:`exercises`, this does not read all exercises at once, so that the memory usage
+    does not depend on their number: the exercises are read in chunks of *chunkSize* consecutive
+    ids, like by :func:`makeExercises`. Every chunk is read in a :func:`conditionalConnect` block
+    of its own, which is left before its exercises are generated, so that a suspended generator
+    does not keep a transaction open. Exercises changed while iterating thus appear in the state
+    they had when their chunk was read.
+    """
+    if ids is not None:
+        ids = sorted(set(int(id) for id in ids))
+    columns = "SELECT id, creator, number, description, modified FROM exercises "
+    lastId, position = -1, 0
+    while True:
+        with conditionalConnect(connection, readonly=True) as conn:
+            if ids is None:
+                rows = conn.execute(columns + "WHERE id > ? ORDER BY id LIMIT ?",
+                                    (lastId, chunkSize)).fetchall()
+                finished = len(rows) < chunkSize
+            else:
+                chunk = ids[position:position + chunkSize]
+                position += chunkSize
+                rows = conn.execute(columns + "WHERE id IN ({}) ORDER BY id".format(
+                    ", ".join(map(str, chunk)))).fetchall() if chunk else []
+                finished = position >= len(ids)
+            chunk = makeExercises(conn, rows)
+        for exercise in chunk:
+            yield exercise
+        if finished:
+            return
+        if rows:
+            lastId = rows[-1]["id"]
+
+
+def ftsQuery(search, columns=None):
+    """Translate the whitespace-separated terms of *search* into an FTS5 query.
+
+    The query matches exercises containing, for every term, a word starting with that term
+    (ignoring case and diacritics), in one of the *columns* of the *exercises_fts* table if given.
+    Returns None if *search* contains no searchable terms.
+    """
+    terms = ['"{}"*'.format(term.replace('"', '""')) for term in search.split()
+             if re.search(r"\w", term)]
+    if not terms:
+        return None
+    query = " AND ".join(terms)
+    if columns:
+        query = "{{{}}} : ({})".format(" ".join(columns), query)
+    return query
+
+
+SEARCH_CACHE_SIZE = 256
+"""Default maximum number of results kept by the :class:`SearchCache`."""
+
+
+class SearchCache(object):
+    """Bounded LRU cache of the results of :func:`searchPage`, keyed by the search arguments.
+
+    The cache is valid for one *generation* of the database and is cleared when that ends. This
+    happens on :meth:`bump`, which is called by the functions of this module that write
+    exercises and by :func:`exdb.tags.initTagsTable`, and when :meth:`generation` notices (via
+    ``PRAGMA data_version``) that any connection committed, including those of other processes.
+
+    The counters *hits* and *misses* are meant for monitoring; see :meth:`stats`.
+    """
+
+    def __init__(self, maxSize=None):
+        self.maxSize = SEARCH_CACHE_SIZE if maxSize is None else maxSize
+        self.hits = self.misses = 0
+        self._generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._watch = None
+
+    def bump(self, sync=False):
+        """Start a new generation, discarding all cached results, and return it.
+
+        If *sync* is set, the changes of the database up to now are attributed to the new
+        generation, such that :meth:`generation` does not start another one for them.
+        """
+        path = sqlPath() if sync else None
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            if sync and self._watch is not None and self._watch[0] == path:
+                self._watch[2] = self._watch[1].execute("PRAGMA data_version").fetchone()[0]
+            return self._generation
+
+    def generation(self):
+        """Return the current generation, starting a new one if the database has changed."""
+        path = sqlPath()
+        with self._lock:
+            if self._watch is None or self._watch[0] != path:
+                self._closeWatch()
+                self._watch = [path, connect(readonly=True, check_same_thread=False), None]
+            version = self._watch[1].execute("PRAGMA data_version").fetchone()[0]
+            if version != self._watch[2]:
+                self._watch[2] = version
+                self._generation += 1
+                self._entries.clear()
+            return self._generation
+
+    def lookup(self, key):
+        """Return the cached result for *key*, or None; counts a hit or a miss."""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def store(self, key, generation, result):
+        """Cache *result* for *key* if *generation* is still current.
+
+        Afterwards, the least recently used results are evicted until at most *maxSize* remain.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = result
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return a dictionary with the *hits* and *misses* since the last :meth:`reset`, and the
+        current number of cached *entries*, *maxSize* and *generation*.
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        maxSize=self.maxSize, generation=self._generation)
+
+    def reset(self):
+        """Clear the cache and its counters, e.g. when the instance changes."""
+        with self._lock:
+            self._closeWatch()
+            self._entries.clear()
+            self._generation += 1
+            self.hits = self.misses = 0
+
+    def _closeWatch(self):
+        if self._watch is not None:
+            self._watch[1].close()
+            self._watch = None
+
+
+searchCache = SearchCache()
+"""The :class:`SearchCache` used by :func:`searchPage`."""
+
+
+def bitmap(ids):
+    """Return the bitmap of the non-negative integers *ids*: an int with exactly these bits set."""
+    return reduce(or_, (1 << id for id in ids), 0)
+
+
+def bitmapIds(bitmap):
+    """Return the sorted list of the integers in *bitmap* (see :func:`bitmap`)."""
+    return [match.start() for match in re.finditer("1", format(bitmap, "b")[::-1])]
+
+
+class TagIndex(object):
+    """In-memory inverted index of the tags of the exercises in the database of *conn*.
+
+    For every tag id, the index holds the :func:`bitmap` of the ids of the exercises with that
+    tag, so that tag queries are answered by a few operations on integers instead of grouping
+    the rows of *exercises_tags*. See :func:`tagIndex` for an up-to-date index, which is kept up
+    to date by the write functions of this module with the methods :meth:`add`, :meth:`remove`,
+    :meth:`merge` and :meth:`delete`.
+    """
+
+    def __init__(self, conn):
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        self.bitmaps = {tag: bitmap(map(int, ids.split(","))) for tag, ids in cursor.execute(
+            "SELECT tag, group_concat(exercise) FROM exercises_tags GROUP BY tag")}
+        self.all = bitmap(row[0] for row in cursor.execute("SELECT id FROM exercises"))
+        self.generation = None
+
+    def copy(self):
+        """Return a copy of the index, which can be updated without affecting this one."""
+        index = object.__new__(type(self))
+        index.bitmaps = dict(self.bitmaps)
+        index.all = self.all
+        index.generation = self.generation
+        return index
+
+    def add(self, id, tags):
+        """Add the exercise *id* with the given tag ids to the index."""
+        bit = 1 << id
+        self.all |= bit
+        for tag in tags:
+            self.bitmaps[tag] = self.bitmaps.get(tag, 0) | bit
+
+    def remove(self, id, tags):
+        """Remove the exercise *id*, which has the given tag ids, from the index."""
+        mask = ~(1 << id)
+        self.all &= mask
+        for tag in tags:
+            if tag in self.bitmaps:
+                self.bitmaps[tag] &= mask
+                if not self.bitmaps[tag]:
+                    del self.bitmaps[tag]
+
+    def merge(self, tag, into):
+        """Merge the tag with id *tag* into the tag with id *into*."""
+        merged = self.bitmaps.pop(tag, 0) | self.bitmaps.get(into, 0)
+        if merged:
+            self.bitmaps[into] = merged
+
+    def delete(self, tag):
+        """Remove the tag with id *tag* from all exercises."""
+        self.bitmaps.pop(tag, None)
+
+    def query(self, allOf=(), anyOf=(), noneOf=()):
+        """Return the bitmap of the exercises that have all tags of *allOf*, at least one of
+        *anyOf* (if not empty) and none of *noneOf*, which are iterables of tag ids.
+        """
+        result = self.all
+        for tag in allOf:
+            result &= self.bitmaps.get(tag, 0)
+        if anyOf:
+            union = 0
+            for tag in anyOf:
+                union |= self.bitmaps.get(tag, 0)
+            result &= union
+        for tag in noneOf:
+            result &= ~self.bitmaps.get(tag, 0)
+        return result
+
+
+_tagIndex = None
+_tagIndexLock = threading.Lock()
+
+
+def resetTagIndex():
+    """Discard the index of :func:`tagIndex`, e.g. when another database is used."""
+    global _tagIndex
+    with _tagIndexLock:
+        _tagIndex = None
+
+
+def tagIndex(connection=None):
+    """Return a :class:`TagIndex` of the current state of the database.
+
+    The index is built on first use and belongs to a tags generation of the database, which is
+    counted in the *tags_generation* table by :func:`commitWrite` whenever the tags or the set of
+    exercises change, in this process or another one. The changes committed by the write
+    functions of this module are applied to the index by :func:`commitWrite`; if the database
+    has reached another tags generation otherwise, it is rebuilt. Other changes of the database
+    keep the index. If *connection* has uncommitted changes, a temporary index of its view of
+    the database is returned instead.
+    """
+    global _tagIndex
+    if connection is not None and connection.in_transaction:
+        return TagIndex(connection)
+    with conditionalConnect(connection, readonly=True) as conn:
+        generation = conn.execute("SELECT generation FROM tags_generation").fetchone()[0]
+        with _tagIndexLock:
+            if _tagIndex is None or _tagIndex.generation != generation:
+                # built after reading the generation, the index is at least as recent
+                _tagIndex = TagIndex(conn)
+                _tagIndex.generation = generation
+            return _tagIndex
+
+
+def searchKey(kwargs):
+    """Return a hashable key identifying the results of :func:`searchPage` for *kwargs*.
+
+    Arguments that do not change the results, like the order of *tags* or *langs*, or
+    whitespace in the full-text searches, are normalized.
+    """
+    return (tuple(sorted(kwargs.get("tags", []))),
+            tuple(sorted(tuple(cat) for cat in kwargs.get("cats", {}))),
+            " ".join(kwargs.get("description", "").split()),
+            " ".join(kwargs.get("text", "").split()),
+            tuple(sorted(kwargs.get("langs", []))),
+            tuple(sorted((kwargs.get("pagination") or {}).items())),
+            None if kwargs.get("fields") is None else tuple(sorted(kwargs["fields"])))
 
 
 def searchExercises(connection=None, **kwargs):
-    with conditionalConnect(connection) as conn:
+    """Search for exercises; returns a tuple of the number of matches and a list of exercises.
+
+    See :func:`searchPage` for the keyword arguments.
+    """
+    return searchPage(connection, **kwargs)[:2]
+
+
+def searchPage(connection=None, **kwargs):
+    """Search for exercises; returns a tuple of the number of matches, the list of exercises on
+    the requested page and a cursor to the next page (None on the last page).
+
+    The keyword arguments *tags*, *cats*, *description*, *text* and *langs* filter the
+    exercises. *description* and *text* are searched in the full-text index (see
+    :func:`ftsQuery`): the former in the descriptions only, the latter in the descriptions and
+    the TeX code of all languages; if they contain no searchable terms, they match no exercise.
+    *pagination* and *fields* are passed on to :func:`exercisePage`; if the *orderby* entry of
+    *pagination* is "rank", the exercises are ordered by relevance for the full-text search.
+
+    Results are cached in :data:`searchCache`, unless *connection* has uncommitted changes. The
+    cache holds immutable :class:`ExerciseRecord` objects, from which new exercises are created
+    for every call, so that callers may modify them.
+    """
+    if connection is not None and connection.in_transaction:
+        result = querySearch(connection, **kwargs)
+    else:
+        key = searchKey(kwargs)
+        generation = searchCache.generation()
+        result = searchCache.lookup(key)
+        if result is None:
+            result = querySearch(connection, **kwargs)
+            searchCache.store(key, generation, result)
+    count, records, nextCursor = result
+    return count, buildExercises(records, connection), nextCursor
+
+
+def querySearch(connection=None, **kwargs):
+    """Run the search of :func:`searchPage` in the database, bypassing the cache.
+
+    The exercises on the page are returned as a tuple of :class:`ExerciseRecord` objects.
+    """
+    with conditionalConnect(connection, readonly=True) as conn:
         args = []
         selects = []
-        if kwargs.get("tags", []):
-            tags = kwargs["tags"]
-            selects.append("SELECT exercise FROM exercises_tags\n" \
-                           "    WHERE {}\n" \
-                           "    GROUP BY exercise" \
-                           "    HAVING COUNT(*) = ?".format(" OR ".join(["tag=?"]*len(tags))))
-            args.extend(tags + [len(tags)])
-        for id, mat_path in kwargs.get("cats", {}):
-            selects.append("SELECT exercise FROM exercises_tags WHERE tag IN"
-                           "  (SELECT name FROM tags WHERE is_tag AND mat_path LIKE '{}{}.%')"
-                           "  GROUP BY exercise".format(mat_path, id))
-        if kwargs.get("description", "") != "" or len(kwargs.get("langs", [])):
+        matches = None
+        if kwargs.get("tags", []) or kwargs.get("cats", {}):
+            index = tagIndex(connection)
+            byName = tagIdsByName(conn)
+            matches = 0
+            if kwargs.get("tags", []):
+                if all(tag in byName for tag in kwargs["tags"]):
+                    matches |= index.query(allOf=[byName[tag] for tag in kwargs["tags"]])
+            categories = [int(id) for id, _ in kwargs.get("cats", {})]
+            if categories:
+                anyOf = [byName[name] for name in subtreeTags(conn, categories)]
+                if anyOf:
+                    matches |= index.query(anyOf=anyOf)
+        fts = []
+        if kwargs.get("description", "").split():
+            fts.append(ftsQuery(kwargs["description"], ["description"]))
+        if kwargs.get("text", "").split():
+            fts.append(ftsQuery(kwargs["text"]))
+        unsearchable = None in fts
+        fts = "" if unsearchable else " AND ".join("({})".format(query) for query in fts)
+        if unsearchable:
+            # a text filter without searchable terms matches no exercise
+            matches = matches or 0
+        elif fts or len(kwargs.get("langs", [])):
             exwheres = []
-            if kwargs.get("description", "") != "":
-                args.append(kwargs["description"])
-                exwheres.append('CONTAINS(description, ?)')
+            if fts:
+                args.append(fts)
+                exwheres.append("id IN (SELECT rowid FROM exercises_fts "
+                                "WHERE exercises_fts MATCH ?)")
             for lang in kwargs.get("langs", []):
-                exwheres.append("tex_exercise REGEXP '^  \"{}\": \"'".format(lang))
+                args.append(lang)
+                exwheres.append("id IN (SELECT exercise FROM exercises_tex "
+                                "WHERE lang=? AND textype='exercise')")
             selects.append('SELECT id FROM exercises WHERE {}'.format(" AND ".join(exwheres)))
-        if len(selects):
-            query = " UNION ".join(selects)
-            ids = [ row[0] for row in conn.execute(query, args) ]
+        if len(selects) or matches is not None:
+            ids = bitmapIds(matches or 0)
+            if len(selects):
+                query = " UNION ".join(selects)
+                ids = sorted(set(ids).union(row[0] for row in conn.execute(query, args)))
             count = len(ids)
             if not count:
-                return 0, []
+                return 0, (), None
         else:
             ids = None
             count = conn.execute("SELECT COUNT(*) FROM exercises").fetchone()[0]
-        return count, exercises(ids=ids, pagination=kwargs.get("pagination", {}), connection=conn)
+        pagination = kwargs.get("pagination", {})
+        fields = kwargs.get("fields")
+        if fts and pagination.get("orderby") == "rank":
+            found = set(ids)
+            ids = [row[0] for row in conn.execute("SELECT rowid FROM exercises_fts WHERE "
+                                                  "exercises_fts MATCH ? ORDER BY rank", (fts,))
+                   if row[0] in found]
+            ids += sorted(found.difference(ids))  # matched by tags or categories only
+            offset = pagination.get("offset", 0)
+            if pagination.get("after"):
+                order, offset = decodeCursor(pagination["after"], 2)
+                if order != "rank" or not isinstance(offset, int):
+                    raise ValueError("Page cursor does not match the order of the request")
+            limit = pagination.get("limit", -1)
+            nextCursor = None
+            if 0 < limit < len(ids) - offset:
+                nextCursor = encodeCursor("rank", offset + limit)
+            ids = ids[offset:] if limit < 0 else ids[offset:offset + limit]
+            if not ids:
+                return count, (), None
+            position = {id: i for i, id in enumerate(ids)}
+            records = pageRecords(ids=ids, connection=conn, fields=fields)[0]
+            return (count, tuple(sorted(records, key=lambda record: position[record.id])),
+                    nextCursor)
+        return (count,) + pageRecords(ids=ids, pagination=pagination, connection=conn,
+                                      fields=fields)
+
+
+def exercisesByIdentifiers(identifiers, connection=None, fields=None):
+    """Return the exercises identified by the (creator, number) pairs in *identifiers*.
+
+    The exercises are returned in the order of *identifiers*; unknown identifiers are skipped,
+    and repeated ones only yield one exercise. Independently of the number of exercises, they
+    are read with a fixed number of queries. *fields* works as in :func:`exercisePage`.
+    """
+    identifiers = json.dumps([[creator, int(number)] for creator, number in identifiers])
+    with conditionalConnect(connection, readonly=True) as conn:
+        # one lookup in the unique (creator, number) index per identifier
+        rows = conn.execute("SELECT ex.id, creator, number, description, modified "
+                            "FROM json_each(?) AS ident CROSS JOIN exercises AS ex "
+                            "ON creator = json_extract(ident.value, '$[0]') "
+                            "AND number = json_extract(ident.value, '$[1]') "
+                            "ORDER BY ident.key", (identifiers,)).fetchall()
+        return makeExercises(conn, rows, fields)
 
 
 def exercise(creator, number, connection=None):
-    """Return the exercise with given *creator* and *number*."""
-    with conditionalConnect(connection) as conn:
-        ex = conn.execute("SELECT * FROM exercises WHERE creator=? AND number=?",
-                          (creator, number)).fetchone()
-        tags = [row[0] for row in conn.execute("SELECT tag FROM exercises_tags "
-                                               "WHERE exercise=?", (ex["id"],))]
-        preambles = [row[0] for row in conn.execute("SELECT preamble FROM exercises_preambles "
-                                                    "WHERE exercise=?", (ex["id"],))]
-        files = [row[0] for row in conn.execute("SELECT filename FROM exercises_files "
-                                                "WHERE exercise=?", (ex["id"],))] 
-        exercise = Exercise(creator=ex["creator"], number=ex["number"], modified=ex["modified"],
-                            description=ex["description"], tex_exercise=ex["tex_exercise"],
-                            tex_solution=ex["tex_solution"], tags=tags, tex_preamble=preambles,
-                            data_files=files)
-    return exercise
+    """Return the exercise with given *creator* and *number*.
+
+    Raises KeyError if there is no such exercise.
+    """
+    exercises = exercisesByIdentifiers([(creator, number)], connection)
+    if not exercises:
+        raise KeyError("No exercise {}{} in the database".format(creator, number))
+    return exercises[0]
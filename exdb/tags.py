@@ -22,9 +22,16 @@ def initTagsTable(conn):
     
     If the file does not exist, a barebone tree containing only the "uncategorized"
     category is created and used instead. Returns the root of the XML tree.
+
+    Existing tags keep their ids, by which they are referenced from the exercises. Tags that are
+    not in the tree any more are deleted, or moved to the "uncategorized" category if an exercise
+    still has them.
     """
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM tags;")
+    known = {}
+    for id, name in cursor.execute("SELECT id, name FROM tags WHERE is_tag ORDER BY id"):
+        known.setdefault(name, []).append(id)
+    cursor.execute("DELETE FROM tags WHERE NOT is_tag;")
     import exdb
     from exdb.repo import repoPath
 
@@ -37,16 +44,33 @@ def initTagsTable(conn):
     if uncat is None:
         uncat = E.category(name='uncategorized')
         tree.append(uncat)        
-    for node in tree.iterdescendants():
+    position = 0
+    for position, node in enumerate(tree.iterdescendants(), start=1):
         parents = list(reversed([el.get("id") for el in node.iterancestors()][:-1]))
         matpath = '.'.join(map(str, parents)) + '.'
         if matpath[0] != '.':
             matpath = "." + matpath
-        cursor.execute("INSERT INTO tags(name, is_tag, mat_path) VALUES (?, ?, ?)",
-                     (node.get("name"), node.tag == "tag", matpath))
-        node.set("id", str(cursor.lastrowid))
+        if node.tag == "tag" and known.get(node.get("name")):
+            id = known[node.get("name")].pop(0)
+            cursor.execute("UPDATE tags SET mat_path=?, position=? WHERE id=?",
+                           (matpath, position, id))
+        else:
+            cursor.execute("INSERT INTO tags(name, is_tag, mat_path, position) VALUES (?, ?, ?, ?)",
+                           (node.get("name"), node.tag == "tag", matpath, position))
+            id = cursor.lastrowid
+        node.set("id", str(id))
         node.set("matpath", matpath)
+    removed = [id for ids in known.values() for id in ids]
+    cursor.executemany("DELETE FROM tags WHERE id=? AND id NOT IN (SELECT tag FROM exercises_tags)",
+                       [(id,) for id in removed])
+    cursor.executemany("UPDATE tags SET mat_path=?, position=? WHERE id=?",
+                       [(".{}.".format(uncat.get("id")), position + i, id)
+                        for i, id in enumerate(removed, start=1)])
+    from exdb import sql
+    cursor.execute("DELETE FROM tags_closure")
+    cursor.execute(sql.CLOSURE_FILL)
     conn.commit()
+    sql.searchCache.bump()
     return tree
 
 
@@ -58,20 +82,21 @@ def initialTree():
 def readTreeFromTable(conn):
     """Parse the *tags* SQLite table into an XML tree and return its root.
     
-    The nodes will contain *id* and *mat_path* attributes as used in the DB table.
+    The nodes will contain *id* and *mat_path* attributes as used in the DB table. The parents
+    are looked up in the *tags_closure* table.
     """
     root = E.categories()
-    for row in conn.execute("SELECT id, name, is_tag, mat_path FROM tags ORDER BY id ASC"):
-        parents = row[3][1:-1].split(".")
-        if len(parents) > 0 and len(parents[0]) > 0:
-            parent = root.xpath("/".join("category[@id='{}']".format(cat) for cat in parents))[0]
-        else:
-            parent = root
+    nodes = OrderedDict()
+    for row in conn.execute("SELECT id, name, is_tag, mat_path, ancestor FROM tags "
+                            "LEFT JOIN tags_closure ON descendant = id AND depth = 1 "
+                            "ORDER BY position ASC"):
         element = etree.Element("tag" if row[2] else "category",
                                 id=str(row[0]),
                                 name=row[1],
                                 mat_path=row[3])
-        parent.append(element)
+        nodes[row[0]] = element, row[4]
+    for element, parent in nodes.values():
+        (nodes[parent][0] if parent in nodes else root).append(element)
     return root
 
 
@@ -7,12 +7,52 @@
 
 from __future__ import unicode_literals
 
-import io, os, shutil, subprocess, tempfile
-from os.path import join, dirname
+import io, os, re, shutil, subprocess, tempfile, threading, logging, time
+import asyncio, heapq, importlib.util, itertools, weakref
+from os.path import join, dirname, exists
+from itertools import groupby, islice
+from contextlib import contextmanager
+from concurrent.futures import Future, CancelledError, wait, FIRST_COMPLETED
 import hashlib
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 COMPILER = "pdflatex"
 COMPILE_ARGS = ["-interaction=nonstopmode", "-no-shell-escape", "-file-line-error"]
+WORKERS = os.cpu_count() or 1
+"""Default number of parallel compilations in :func:`makePreviews`."""
+BATCH = True
+"""Whether :func:`makePreviews` typesets the snippets of an exercise in a single document."""
+FORMATS = True
+"""Whether to compile from precompiled formats of the preamble (see :func:`makeFormat`)."""
+MAX_FORMATS = 32
+"""Maximum number of precompiled formats kept in the instance's *formats* directory."""
+FORMAT_RETRY = 24*60*60
+"""Time in seconds after which building a format that failed to compile is tried again."""
+OUTPUTS = [("preview", 200), ("thumbnail", 40)]
+"""Images created for every preview as (name, dpi) pairs.
+
+Each image is stored as ``{name}.png`` in the preview directory. The first entry must be named
+"preview"; its path is the one returned by :func:`makePreview`.
+"""
+RASTERIZER = None
+"""Name of the :class:`Rasterizer` to use, or None to use the first available one."""
+TIMEOUT = 120
+"""Wall-clock limit in seconds for compiling one preview (including format and images), or None.
+"""
+MEMORY_LIMIT = 2*1024**3
+"""Limit in bytes of the address space of every compiler and rasterizer process, or None."""
+PRIORITY_INTERACTIVE = 0
+"""Priority of :class:`Scheduler` tasks a user is waiting for."""
+PRIORITY_BULK = 1
+"""Priority of background :class:`Scheduler` tasks, like the initial compilation of a repository.
+"""
+
+_keyLocks = {}
+_keyLocksLock = threading.Lock()
+_inflight = weakref.WeakKeyDictionary()
 
 
 class CompilationError(Exception):
@@ -25,88 +65,1117 @@ class CompilationError(Exception):
         return "{}\n{}".format(self.msg, self.log)
 
 
+class CompilationTimeout(CompilationError):
+    """Error indicating that a compilation exceeded its wall-clock limit (see :data:`TIMEOUT`)."""
+
+
+class CompilationCancelled(CompilationError):
+    """Error indicating that a compilation was cancelled, e.g. because it was superseded."""
+
+
+def keyLockObject(key):
+    """Return the lock serializing all compilations into the preview directory named *key*."""
+    with _keyLocksLock:
+        return _keyLocks.setdefault(key, threading.Lock())
+
+
+@contextmanager
+def keyLock(key):
+    """Context manager holding the :func:`keyLockObject` of *key*."""
+    with keyLockObject(key):
+        yield
+
+
+# The compilation pipeline is implemented by generator functions ("steps") that do not block
+# themselves, but yield requests for all potentially long-running operations (subprocesses, lock
+# acquisition, expensive function calls) and receive the results. They are driven either
+# synchronously by runSteps or asynchronously by runStepsAsync, so that the blocking and the
+# asyncio API share the same code. Sub-steps are composed with "yield from". Requests are executed
+# with the remaining time of the step's wall-clock limit (or None) and, in the synchronous case, an
+# optional threading.Event signalling cancellation.
+
+POLL_INTERVAL = 0.2
+"""Interval in seconds in which running processes check for cancellation."""
+
+
+def memoryLimiter():
+    """Return the ``preexec_fn`` applying :data:`MEMORY_LIMIT` to children of :class:`Command`,
+    or None if there is no limit.
+
+    The limit is applied before the child executes its program. It is computed beforehand, so
+    that the child only calls ``setrlimit`` between fork and exec.
+    """
+    if not resource or not MEMORY_LIMIT:
+        return None
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limits = (MEMORY_LIMIT if hard == resource.RLIM_INFINITY else min(MEMORY_LIMIT, hard), hard)
+    return lambda: resource.setrlimit(resource.RLIMIT_AS, limits)
+
+
+class Command(object):
+    """Request to run the subprocess *args* in directory *cwd*.
+
+    The result is a :class:`subprocess.CompletedProcess` with stdout and stderr combined.
+    """
+
+    def __init__(self, args, cwd):
+        self.args = args
+        self.cwd = cwd
+
+    def timedOut(self, timeout, output):
+        return CompilationTimeout("{} timed out after {:.0f} seconds".format(self.args[0], timeout),
+                                  output.decode(errors="replace"))
+
+    def run(self, timeout=None, cancelled=None):
+        proc = subprocess.Popen(self.args, cwd=self.cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, preexec_fn=memoryLimiter())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if cancelled is not None:
+                wait = POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL)
+            try:
+                output, _ = proc.communicate(timeout=wait)
+                return subprocess.CompletedProcess(self.args, proc.returncode, output)
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled.is_set():
+                    proc.kill()
+                    output, _ = proc.communicate()
+                    raise CompilationCancelled("compilation cancelled",
+                                               output.decode(errors="replace"))
+                if deadline is not None and time.monotonic() >= deadline:
+                    proc.kill()
+                    raise self.timedOut(timeout, proc.communicate()[0])
+
+    async def runAsync(self, timeout=None):
+        proc = await asyncio.create_subprocess_exec(*self.args, cwd=self.cwd,
+                                                    stdout=subprocess.PIPE,
+                                                    stderr=subprocess.STDOUT,
+                                                    preexec_fn=memoryLimiter())
+        communicate = asyncio.ensure_future(proc.communicate())
+        try:
+            output, _ = await asyncio.wait_for(asyncio.shield(communicate), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            raise self.timedOut(timeout, (await communicate)[0])
+        except BaseException:
+            proc.kill()
+            await communicate
+            raise
+        return subprocess.CompletedProcess(self.args, proc.returncode, output)
+
+
+class Call(object):
+    """Request to call *func* with *args*, which may take a while; the result is its return value.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def run(self, timeout=None, cancelled=None):
+        return self.func(*self.args)
+
+    async def runAsync(self, timeout=None):
+        return await asyncio.get_event_loop().run_in_executor(None, self.func, *self.args)
+
+
+class Acquire(object):
+    """Request to acquire the :class:`threading.Lock` *lock*. The step has to release it."""
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def run(self, timeout=None, cancelled=None):
+        if not self.lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise CompilationTimeout("timed out waiting for a concurrent compilation", "")
+
+    async def runAsync(self, timeout=None):
+        future = asyncio.get_event_loop().run_in_executor(None, self.lock.acquire)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException as e:
+            future.add_done_callback(lambda f: self.lock.release())
+            if isinstance(e, asyncio.TimeoutError):
+                raise CompilationTimeout("timed out waiting for a concurrent compilation", "")
+            raise
+
+
+def runSteps(steps, timeout=None, cancelled=None):
+    """Drive the step generator *steps* synchronously and return its result.
+
+    If the steps take longer than *timeout* seconds, a :class:`CompilationTimeout` is raised
+    inside them. If the :class:`threading.Event` *cancelled* is set, a
+    :class:`CompilationCancelled` error is raised inside them.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    method, value = steps.send, None
+    while True:
+        try:
+            request = method(value)
+        except StopIteration as stop:
+            return stop.value
+        remaining = None if deadline is None else deadline - time.monotonic()
+        try:
+            if cancelled is not None and cancelled.is_set():
+                raise CompilationCancelled("compilation cancelled", "")
+            if remaining is not None and remaining <= 0:
+                raise CompilationTimeout("compilation timed out after {:.0f} seconds"
+                                         .format(timeout), "")
+            method, value = steps.send, request.run(remaining, cancelled)
+        except BaseException as e:
+            method, value = steps.throw, e
+
+
+async def runStepsAsync(steps, timeout=None):
+    """Drive the step generator *steps* on the running asyncio event loop; return its result.
+
+    *timeout* is handled as in :func:`runSteps`; cancellation uses the usual asyncio mechanism.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    method, value = steps.send, None
+    while True:
+        try:
+            request = method(value)
+        except StopIteration as stop:
+            return stop.value
+        remaining = None if deadline is None else deadline - time.monotonic()
+        try:
+            if remaining is not None and remaining <= 0:
+                raise CompilationTimeout("compilation timed out after {:.0f} seconds"
+                                         .format(timeout), "")
+            method, value = steps.send, await request.runAsync(remaining)
+        except BaseException as e:
+            method, value = steps.throw, e
+
+
+def checkCommand(result):
+    """Raise a :class:`CompilationError` if the :class:`Command` *result* indicates failure."""
+    try:
+        result.check_returncode()
+    except subprocess.CalledProcessError as e:
+        raise CompilationError(str(e), e.output.decode())
+
+
+class FileReference(object):
+    """Data file passed by its *path* instead of its contents in the *files* argument of
+    :func:`makePreview` and related functions.
+
+    The file is hashed and copied into the compile directory by streaming it, so its contents
+    are never held in memory. It is not linked, since the compile directory becomes a cached
+    preview, which must not change when the file is rewritten in place (as by
+    :func:`exdb.repo.updateExercise`). The file must not be modified while previews referencing
+    it are compiled.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._digest = None
+
+    def digest(self):
+        """Return the SHA256 digest of the file contents."""
+        if self._digest is None:
+            h = hashlib.sha256()
+            with open(self.path, "rb") as f:
+                for chunk in iter(lambda: f.read(2**16), b""):
+                    h.update(chunk)
+            self._digest = h.digest()
+        return self._digest
+
+    def stage(self, target):
+        """Make the file available under the path *target*."""
+        shutil.copyfile(self.path, target)
+
+    def __eq__(self, other):
+        return isinstance(other, FileReference) and self.path == other.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return "FileReference({!r})".format(self.path)
+
+
+def fileDigest(data):
+    """Return the SHA256 digest of a data file given by its contents or a :class:`FileReference`.
+    """
+    if isinstance(data, FileReference):
+        return data.digest()
+    return hashlib.sha256(data).digest()
+
+
+def templateDir():
+    """The directory containing template.tex and preamble.tex.
+
+    This is the template directory of the repository if exdb is initialized, and the package
+    directory (containing the default templates) otherwise.
+    """
+    try:
+        from exdb import repo
+        return repo.templatePath()
+    except:
+        return dirname(__file__)
+
+
+def templateRevision():
+    """Return a SHA256 hex digest of the current contents of template.tex and preamble.tex."""
+    h = hashlib.sha256()
+    for name in "template.tex", "preamble.tex":
+        with open(join(templateDir(), name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def previewKey(texcode, lang, preambles, files, template):
+    """Compute the SHA256 key of a preview; *template* is the :func:`templateRevision`.
+
+    Besides the arguments of :func:`makePreview`, the key depends on the compiler and on the
+    rasterizer configuration.
+    """
+    h = hashlib.sha256()
+    for line in preambles:
+        h.update(line.encode('utf-8'))
+    for fname, fdata in files.items():
+        h.update(fname.encode('utf-8'))
+        h.update(fileDigest(fdata))
+    h.update(lang.encode('utf-8'))
+    h.update(COMPILER.encode('utf-8'))
+    h.update(template.encode('utf-8'))
+    h.update(rasterizer().name.encode('utf-8'))
+    h.update(repr(OUTPUTS).encode('utf-8'))
+    h.update(texcode.encode('utf-8'))
+    return h.hexdigest()
+
+
 def makePreview(texcode, lang="DE", preambles=None, files=None):
     """Create a preview image for the given tex code.
 
     If exdb is initialized with an instance dir, the preview is generated inside the preview
-    directory in a subdirectory determined by the SHA256 sum of the parameters. Thus, this can
-    quickly return a previously computed preview for the same data.
+    directory in a subdirectory determined by the SHA256 sum of the parameters and the contents
+    of the TeX templates. Thus, this can quickly return a previously computed preview for the
+    same data.
     
-    If the compilation succeeds, the absolute path of the preview image is returned. The caller
-    should remove its parent directory (containing all tex output files) as soon as it is not
-    needed anymore.
+    If the compilation succeeds, the absolute path of the preview image is returned. The other
+    images configured in :data:`OUTPUTS` (like thumbnails) are placed in the same directory. The
+    caller should remove that directory (containing all tex output files) using
+    :func:`releasePreview` as soon as it is not needed anymore.
     
-    Otherwise, a CompilationError is raised, containing the TeX log in its *log* attribute. If 
-    conversion to png fails, a ConversionError is raised. In both error cases, the compile
-    directory is deleted before raising the exception.
+    Otherwise, a CompilationError is raised, containing the TeX log in its *log* attribute. The
+    same happens if the conversion to png fails, or if the compilation exceeds the time limit
+    :data:`TIMEOUT` (:class:`CompilationTimeout`). In these error cases, the compile directory is
+    deleted before raising the exception. Compilation errors (but not timeouts) are cached as
+    well, so an identical request raises the same error again without compiling (see
+    :mod:`exdb.cache`).
+    """
+    return runSteps(previewSteps(texcode, lang, preambles, files), TIMEOUT)
+
+
+async def makePreviewAsync(texcode, lang="DE", preambles=None, files=None):
+    """Coroutine version of :func:`makePreview`, with the same results and errors.
+
+    The compiler and rasterizer processes are run with :func:`asyncio.create_subprocess_exec`,
+    so the event loop is not blocked. Concurrent calls for the same preview key share a single
+    compilation.
     """
     if preambles is None:
         preambles = []
     if files is None:
         files = {}
-    # create directory for the files
-    import exdb
-    if exdb.instancePath:
-        previewPath = join(exdb.instancePath, "previews")
-        h = hashlib.sha256()
-        for line in preambles:
-            h.update(line.encode('utf-8'))
-        for fname, fdata in files.items():
-            h.update(fname.encode('utf-8'))
-            h.update(fdata)
-        h.update(lang.encode('utf-8'))
-        h.update(COMPILER.encode('utf-8'))
-        h.update(texcode.encode('utf-8'))
-        tmpdir = join(previewPath, h.hexdigest())
-        if os.path.exists(tmpdir):
-            image = os.path.join(tmpdir, "preview.png")
-            if os.path.exists(image):
-                return image
-        else:
+    from exdb import cache
+    if cache.previewCache() is None:
+        return await runStepsAsync(previewSteps(texcode, lang, preambles, files), TIMEOUT)
+    template = templateRevision()
+    key = previewKey(texcode, lang, preambles, files, template)
+    loop = asyncio.get_event_loop()
+    inflight = _inflight.setdefault(loop, {})
+    if key not in inflight:
+        steps = previewSteps(texcode, lang, preambles, files, key, template)
+        inflight[key] = loop.create_task(runStepsAsync(steps, TIMEOUT))
+        inflight[key].add_done_callback(lambda task: inflight.pop(key, None))
+    try:
+        return await asyncio.shield(inflight[key])
+    except CompilationError as e:
+        # every caller gets its own exception object, since callers attach data to it
+        raise type(e)(e.msg, e.log)
+
+
+def previewSteps(texcode, lang, preambles, files, key=None, template=None):
+    """Steps implementing :func:`makePreview`.
+
+    *key* and *template* may be given if the :func:`previewKey` and :func:`templateRevision` are
+    already known.
+    """
+    if preambles is None:
+        preambles = []
+    if files is None:
+        files = {}
+    from exdb import cache
+    previewCache = cache.previewCache()
+    if not previewCache:
+        return (yield from compileSteps(tempfile.mkdtemp(), texcode, lang, preambles, files))
+    if template is None:
+        template = templateRevision()
+    if key is None:
+        key = previewKey(texcode, lang, preambles, files, template)
+    lock = keyLockObject(key)
+    yield Acquire(lock)
+    try:
+        image = previewCache.lookup(key)
+        if image:
+            return image
+        failure = previewCache.lookupFailure(key)
+        if failure:
+            raise CompilationError(*failure)
+        tmpdir = previewCache.entryPath(key)
+        if not os.path.exists(tmpdir):
             os.mkdir(tmpdir)
+        try:
+            image = yield from compileSteps(tmpdir, texcode, lang, preambles, files)
+        except CompilationError as e:
+            # timeouts and cancellations are not cached since they depend on the system load
+            if type(e) is CompilationError:
+                previewCache.recordFailure(key, template, e.msg, e.log)
+            raise
+        previewCache.record(key, template)
+        return image
+    finally:
+        lock.release()
+
+
+def releasePreview(image):
+    """Delete the directory containing the preview *image* returned by :func:`makePreview`."""
+    from exdb import cache
+    previewCache = cache.previewCache()
+    directory = dirname(image)
+    if previewCache and dirname(directory) == previewCache.path:
+        previewCache.discard(os.path.basename(directory))
     else:
-        tmpdir = tempfile.mkdtemp()
-    
-    # write image files
+        shutil.rmtree(directory)
+
+
+def templateLines(lang):
+    """Return the lines of template.tex, adapted to language *lang*."""
+    with io.open(join(templateDir(), "template.tex"), "rt", encoding="utf-8") as t:
+        lines = t.readlines()
+    # replace language in the template if it's not german
+    if lang != "DE":
+        lines[0] = lines[0].replace("ngerman]", "english]")
+    return lines
+
+
+def formatKey(header, preambles):
+    """Compute the SHA256 key of the format dumped from template *header* and *preambles*."""
+    h = hashlib.sha256()
+    h.update(COMPILER.encode('utf-8'))
+    for line in header:
+        h.update(line.encode('utf-8'))
+    with open(join(templateDir(), "preamble.tex"), "rb") as f:
+        h.update(f.read())
+    for line in preambles:
+        h.update(line.encode('utf-8'))
+    return h.hexdigest()
+
+
+def makeFormat(header, preambles):
+    """Return the path of a precompiled LaTeX format for the given preamble.
+
+    *header* is the list of lines of template.tex preceding ``\\begin{document}``, and
+    *preambles* the extra preamble lines of the exercise. The format is dumped by ``COMPILER
+    -ini`` and stored in the *formats* directory of the instance under a name determined by
+    :func:`formatKey`, so it is rebuilt automatically if any of the inputs changes. Only the
+    :data:`MAX_FORMATS` most recently used formats are kept.
+
+    Returns None if formats are disabled (see :data:`FORMATS`), exdb is not initialized, or the
+    format can not be built.
+    """
+    return runSteps(formatSteps(header, preambles))
+
+
+def formatSteps(header, preambles):
+    """Steps implementing :func:`makeFormat`."""
+    import exdb
+    if not FORMATS or not exdb.instancePath:
+        return None
+    formatDir = join(exdb.instancePath, "formats")
+    if not exists(formatDir):
+        os.makedirs(formatDir)
+    key = formatKey(header, preambles)
+    fmt = join(formatDir, key + ".fmt")
+    lock = keyLockObject("fmt:" + key)
+    yield Acquire(lock)
+    try:
+        if exists(fmt):
+            os.utime(fmt, None)
+            return fmt
+        if formatFailed(fmt):
+            return None
+        buildDir = tempfile.mkdtemp(dir=formatDir)
+        try:
+            with io.open(join(buildDir, "format.tex"), "wt", encoding="utf-8") as f:
+                f.writelines(header)
+                f.write("\\dump\n")
+            with io.open(join(buildDir, "extra_preamble.tex"), "wt", encoding="utf-8") as f:
+                for line in preambles:
+                    f.write(line + '\n')
+            shutil.copy(join(templateDir(), "preamble.tex"), buildDir)
+            result = yield Command([COMPILER, "-ini", "-jobname=exdbformat"] + COMPILE_ARGS +
+                                   ["&" + COMPILER, "format.tex"], buildDir)
+            result.check_returncode()
+            os.rename(join(buildDir, "exdbformat.fmt"), fmt)
+        except subprocess.CalledProcessError as e:
+            logging.warning("Could not build precompiled format {}: {}".format(key, e))
+            discardFormat(fmt)
+            return None
+        except OSError as e:  # e.g. missing compiler or full disk, which may be temporary
+            logging.warning("Could not build precompiled format {}: {}".format(key, e))
+            return None
+        finally:
+            shutil.rmtree(buildDir)
+    finally:
+        lock.release()
+    formats = sorted((f for f in os.listdir(formatDir) if f.endswith(".fmt")),
+                     key=lambda f: os.path.getmtime(join(formatDir, f)), reverse=True)
+    for old in formats[MAX_FORMATS:]:
+        try:
+            os.remove(join(formatDir, old))
+        except OSError:
+            pass
+    return fmt
+
+
+def discardFormat(fmt):
+    """Remove the format file *fmt* and mark it as unusable, so that it is not rebuilt for
+    :data:`FORMAT_RETRY` seconds.
+    """
+    if exists(fmt):
+        os.remove(fmt)
+    open(fmt[:-len(".fmt")] + ".failed", "w").close()
+
+
+def formatFailed(fmt):
+    """Return whether the format file *fmt* has been marked as unusable by :func:`discardFormat`
+    less than :data:`FORMAT_RETRY` seconds ago. Older marks are removed.
+    """
+    marker = fmt[:-len(".fmt")] + ".failed"
+    try:
+        if time.time() - os.path.getmtime(marker) < FORMAT_RETRY:
+            return True
+        os.remove(marker)
+    except OSError:  # no marker
+        pass
+    return False
+
+
+def writeSources(tmpdir, preambles, files):
+    """Write the data *files*, the extra *preambles* and preamble.tex into *tmpdir*."""
+    # write or link image files
     for filename, data in files.items():
+        if isinstance(data, FileReference):
+            data.stage(join(tmpdir, filename))
+            continue
         with io.open(join(tmpdir, filename), "wb") as f:
             f.write(data)
-    # write *texcode* to exercise.tex
-    with io.open(join(tmpdir, "exercise.tex"), "wt", encoding='utf-8') as f:
-        f.write(texcode)
     # create extra_preambles.tex from *preambles*
     with io.open(join(tmpdir, "extra_preamble.tex"), "wt", encoding='utf-8') as f:
         for line in preambles:
             f.write(line + '\n')
-    # compute templateDir
-    try:
-        from exdb import repo
-        templateDir = repo.templatePath()
-    except:
-        templateDir = dirname(__file__)
-    template, preamble = [join(templateDir, tex) for tex in ("template.tex", "preamble.tex")]
-    # replace language in the template if it's not german
-    if lang != "DE":
-        with open(template) as t:
-            templateTex = t.readlines()
-        templateTex[0] = templateTex[0].replace("ngerman]", "english]")
-        with open(join(tmpdir, "template.tex"), "wt") as newTemplate:
-            newTemplate.writelines(templateTex)
-    else:
-        shutil.copy(template, tmpdir) 
-    shutil.copy(preamble, tmpdir)
+    shutil.copy(join(templateDir(), "preamble.tex"), tmpdir)
+
+
+def typeset(tmpdir, template, preambles):
+    """Typeset the document with lines *template* in *tmpdir*, producing template.pdf.
+
+    If possible, the compilation starts from a precompiled format of the preamble (see
+    :func:`makeFormat`). If that fails but a full compilation succeeds, the format is assumed to
+    be broken and discarded. Raises a :class:`CompilationError` if the compilation fails.
+    """
+    runSteps(typesetSteps(tmpdir, template, preambles))
+
+
+def typesetSteps(tmpdir, template, preambles):
+    """Steps implementing :func:`typeset`."""
+    with io.open(join(tmpdir, "template.tex"), "wt", encoding="utf-8") as f:
+        f.writelines(template)
+    begin = [i for i, line in enumerate(template) if line.startswith("\\begin{document}")]
+    fmt = (yield from formatSteps(template[:begin[0]], preambles)) if begin else None
+    if fmt:
+        with io.open(join(tmpdir, "body.tex"), "wt", encoding="utf-8") as f:
+            f.writelines(template[begin[0]:])
+        fmtLink = join(tmpdir, "exdbformat.fmt")
+        try:
+            os.link(fmt, fmtLink)
+        except OSError:
+            shutil.copy(fmt, fmtLink)
+        try:
+            result = yield Command([COMPILER, "-fmt=exdbformat", "-jobname=template"] +
+                                   COMPILE_ARGS + ["body.tex"], tmpdir)
+        finally:
+            os.remove(fmtLink)
+        if result.returncode == 0:
+            return
+    checkCommand((yield Command([COMPILER] + COMPILE_ARGS + ["template.tex"], tmpdir)))
+    if fmt:
+        logging.warning("Discarding precompiled format {} which failed to compile {}"
+                        .format(fmt, tmpdir))
+        discardFormat(fmt)
+
+
+class Rasterizer(object):
+    """Base class of backends converting the PDF output of the compiler to PNG images."""
+
+    name = None
+    executable = None
+
+    def available(self):
+        """Return whether the backend can be used on this system."""
+        return shutil.which(self.executable) is not None
+
+    def steps(self, tmpdir, outputs):
+        """Steps converting all pages of template.pdf in *tmpdir* to PNG images.
+
+        For each (name, dpi) pair in *outputs* and each page, an image ``{name}-{page}.png``
+        (with zero-based page number) of resolution *dpi* has to be created in *tmpdir*. Raises
+        a :class:`CompilationError` if the conversion fails.
+        """
+        raise NotImplementedError()
+
+    def call(self, args, tmpdir):
+        """Steps running the converter with *args*."""
+        try:
+            (yield Command(args, tmpdir)).check_returncode()
+        except subprocess.CalledProcessError as e:
+            raise CompilationError("could not convert pdf to png", e.output.decode())
+
+
+class ImageMagickRasterizer(Rasterizer):
+    """Rasterizer using ImageMagick's *convert*. All outputs are created in a single run, by
+    rendering at the highest resolution and scaling down from there.
+    """
+
+    name = "imagemagick"
+    executable = "convert"
+
+    def steps(self, tmpdir, outputs):
+        outputs = sorted(outputs, key=lambda output: output[1], reverse=True)
+        args = [self.executable, "-density", str(outputs[0][1]), "template.pdf"]
+        for i, (name, dpi) in enumerate(outputs):
+            if i > 0:
+                args += ["-resize", "{:.4f}%".format(100.0*dpi/outputs[i-1][1])]
+            if i < len(outputs) - 1:
+                args.append("-write")
+            args.append("{}-%d.png".format(name))
+        yield from self.call(args, tmpdir)
+
+
+class PopplerRasterizer(Rasterizer):
+    """Rasterizer using poppler's *pdftoppm*, which is much faster than ImageMagick.
+
+    Since *pdftoppm* renders a single resolution per run, it is run once for every output.
+    """
+
+    name = "poppler"
+    executable = "pdftoppm"
+
+    def steps(self, tmpdir, outputs):
+        # Rendering once at the highest resolution and scaling down is deliberately not done:
+        # pdftoppm cannot scale images, and doing it with ImageMagick or PIL would add the
+        # dependency this backend avoids. Runs at the low resolutions of the smaller outputs are
+        # cheap compared to the preview itself.
+        for name, dpi in outputs:
+            prefix = "pdftoppm-" + name
+            yield from self.call([self.executable, "-png", "-r", str(dpi), "template.pdf",
+                                  prefix], tmpdir)
+            # pdftoppm numbers pages from 1, zero-padded to the number of digits of the last page
+            for filename in os.listdir(tmpdir):
+                match = re.match(re.escape(prefix) + r"-(\d+)\.png$", filename)
+                if match:
+                    os.rename(join(tmpdir, filename),
+                              join(tmpdir, "{}-{}.png".format(name, int(match.group(1)) - 1)))
+
+
+class MuPDFRasterizer(Rasterizer):
+    """In-process rasterizer using the PyMuPDF bindings, if installed."""
+
+    name = "mupdf"
+
+    def available(self):
+        return importlib.util.find_spec("fitz") is not None
+
+    def steps(self, tmpdir, outputs):
+        yield Call(self.render, tmpdir, outputs)
+
+    def render(self, tmpdir, outputs):
+        import fitz
+        try:
+            doc = fitz.open(join(tmpdir, "template.pdf"))
+            for page in doc:
+                for name, dpi in outputs:
+                    pixmap = page.get_pixmap(matrix=fitz.Matrix(dpi/72.0, dpi/72.0))
+                    pixmap.save(join(tmpdir, "{}-{}.png".format(name, page.number)))
+            doc.close()
+        except RuntimeError as e:
+            raise CompilationError("could not convert pdf to png", str(e))
+
 
-    # call the compiler
+RASTERIZERS = [MuPDFRasterizer(), PopplerRasterizer(), ImageMagickRasterizer()]
+"""Available :class:`Rasterizer` backends, in order of preference."""
+
+
+_rasterizer = None
+
+
+def rasterizer():
+    """Return the :class:`Rasterizer` selected by :data:`RASTERIZER`.
+
+    If :data:`RASTERIZER` is None, the first available backend of :data:`RASTERIZERS` is used,
+    falling back to ImageMagick. The backend is looked up once and cached until
+    :data:`RASTERIZER` changes.
+    """
+    global _rasterizer
+    if _rasterizer is None or _rasterizer[0] != RASTERIZER:
+        _rasterizer = RASTERIZER, findRasterizer()
+    return _rasterizer[1]
+
+
+def findRasterizer():
+    """Look up the :class:`Rasterizer` selected by :data:`RASTERIZER`; see :func:`rasterizer`."""
+    for backend in RASTERIZERS:
+        if backend.name == RASTERIZER or RASTERIZER is None and backend.available():
+            return backend
+    if RASTERIZER is None:
+        return RASTERIZERS[-1]
+    raise ValueError("Unknown rasterizer '{}'".format(RASTERIZER))
+
+
+def rasterize(tmpdir, pages=None):
+    """Convert template.pdf in *tmpdir* to PNG images as configured by :data:`OUTPUTS`.
+
+    If *pages* is None, the PDF must have a single page which is converted to ``{name}.png``.
+    Otherwise, the PDF must have *pages* pages, which are converted to ``{name}-{page}.png``.
+    Raises a :class:`CompilationError` if the conversion fails or the number of pages differs.
+    """
+    runSteps(rasterizeSteps(tmpdir, pages))
+
+
+def rasterizeSteps(tmpdir, pages=None):
+    """Steps implementing :func:`rasterize`."""
+    yield from rasterizer().steps(tmpdir, OUTPUTS)
+    for name, _ in OUTPUTS:
+        count = pages or 1
+        if not all(exists(join(tmpdir, "{}-{}.png".format(name, page))) for page in range(count)) \
+                or exists(join(tmpdir, "{}-{}.png".format(name, count))):
+            raise CompilationError("could not convert pdf to png",
+                                   "expected {} page(s) in template.pdf".format(count))
+        if pages is None:
+            os.rename(join(tmpdir, "{}-0.png".format(name)), join(tmpdir, name + ".png"))
+
+
+def compilePreview(tmpdir, texcode, lang, preambles, files):
+    """Compile *texcode* inside the existing directory *tmpdir* and return the preview path.
+
+    This is the uncached part of :func:`makePreview`, which see for the meaning of the arguments
+    and the error handling.
+    """
+    return runSteps(compileSteps(tmpdir, texcode, lang, preambles, files))
+
+
+def compileSteps(tmpdir, texcode, lang, preambles, files):
+    """Steps implementing :func:`compilePreview`."""
+    writeSources(tmpdir, preambles, files)
+    # write *texcode* to exercise.tex
+    with io.open(join(tmpdir, "exercise.tex"), "wt", encoding='utf-8') as f:
+        f.write(texcode)
     try:
-        subprocess.check_output([COMPILER] + COMPILE_ARGS + ["template.tex"],
-                                 cwd=tmpdir, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
+        yield from typesetSteps(tmpdir, templateLines(lang), preambles)
+        yield from rasterizeSteps(tmpdir)
+    except BaseException:
         shutil.rmtree(tmpdir)
-        raise CompilationError(str(e), e.output.decode())
+        raise
+    return join(tmpdir, "preview.png")
+
+
+def batchTemplate(lang, count):
+    """Return the lines of a template typesetting snippet0.tex, ..., snippet{*count*-1}.tex on
+    separate pages, or None if template.tex does not have the expected structure.
+
+    The template is derived from template.tex by passing the *multi* option to the standalone
+    class and replacing the line ``\\input{exercise}`` by one page environment per snippet.
+    """
+    lines = templateLines(lang)
+    begin = [i for i, line in enumerate(lines) if line.startswith("\\begin{document}")]
+    inputs = [i for i, line in enumerate(lines) if line.strip() == "\\input{exercise}"]
+    if not (lines[0].startswith("\\documentclass[") and "{standalone}" in lines[0]) \
+            or len(begin) != 1 or len(inputs) != 1:
+        return None
+    lines[0] = lines[0].replace("[", "[multi=exdbsnippet,", 1)
+    pages = ["\\begin{{exdbsnippet}}\\input{{snippet{}}}\\end{{exdbsnippet}}\n".format(i)
+             for i in range(count)]
+    return (lines[:begin[0]] + ["\\newenvironment{exdbsnippet}{}{}\n"] +
+            lines[begin[0]:inputs[0]] + pages + lines[inputs[0]+1:])
+
+
+def compileBatch(tmpdir, codes, lang, preambles, files):
+    """Typeset the TeX snippets *codes* as pages of a single document in *tmpdir*.
+
+    Returns whether the batch could be compiled as a whole; in that case, the images of page
+    *i* are named ``{name}-{i}.png`` (see :func:`rasterize`).
+    """
+    return runSteps(compileBatchSteps(tmpdir, codes, lang, preambles, files))
+
+
+def compileBatchSteps(tmpdir, codes, lang, preambles, files):
+    """Steps implementing :func:`compileBatch`. Timeouts and cancellation are raised, not
+    reported as failure of the batch.
+    """
+    template = batchTemplate(lang, len(codes))
+    if template is None:
+        return False
+    writeSources(tmpdir, preambles, files)
+    for i, code in enumerate(codes):
+        with io.open(join(tmpdir, "snippet{}.tex".format(i)), "wt", encoding='utf-8') as f:
+            f.write(code)
     try:
-        subprocess.check_call(["convert", "-density", "200", "template.pdf", "preview.png"],
-                              cwd=tmpdir)
-    except subprocess.CalledProcessError as e:
-        shutil.rmtree(tmpdir)
-        raise CompilationError("could not convert pdf to png", e.message)
-    return join(tmpdir, "preview.png")
\ No newline at end of file
+        yield from typesetSteps(tmpdir, template, preambles)
+        yield from rasterizeSteps(tmpdir, len(codes))
+    except (CompilationTimeout, CompilationCancelled):
+        raise
+    except CompilationError:
+        return False
+    return True
+
+
+def storePreview(tmpdir, page, key, template):
+    """Move the images of *page* of a batch compiled in *tmpdir* to their own preview directory.
+
+    If exdb is initialized, the directory is the cache entry of *key* compiled with template
+    revision *template*; otherwise, a temporary directory is used. Returns the path of the main
+    preview image.
+    """
+    from exdb import cache
+    previewCache = cache.previewCache()
+
+    def move(target):
+        for name, _ in OUTPUTS:
+            shutil.move(join(tmpdir, "{}-{}.png".format(name, page)), join(target, name + ".png"))
+        return join(target, "preview.png")
+
+    if previewCache is None:
+        return move(tempfile.mkdtemp())
+    with keyLock(key):
+        if not exists(previewCache.imagePath(key)):
+            if not exists(previewCache.entryPath(key)):
+                os.mkdir(previewCache.entryPath(key))
+            move(previewCache.entryPath(key))
+            previewCache.record(key, template)
+        return previewCache.imagePath(key)
+
+
+def makeBatchPreview(snippets, preambles=None, files=None):
+    """Create preview images for several TeX snippets sharing *preambles* and *files*.
+
+    *snippets* is a list of (texcode, lang) tuples, e.g. the exercise and solution texts of one
+    exercise. All snippets of the same language that are not cached yet are typeset as pages of
+    a single document, whose pages are rasterized in one pass; this saves a lot of process
+    spawns and package loading compared to separate :func:`makePreview` calls. The resulting
+    images are stored and cached exactly as if they were created by :func:`makePreview`.
+
+    If a batch fails to compile, its snippets are compiled separately, so that errors are
+    attributed to the right snippet. Returns a list containing, for each snippet, either the
+    image path or the :class:`CompilationError` raised for it. The time limit is :data:`TIMEOUT`
+    per snippet.
+    """
+    timeout = TIMEOUT and TIMEOUT*len(snippets)
+    return runSteps(batchSteps(snippets, preambles, files), timeout)
+
+
+def batchSteps(snippets, preambles=None, files=None):
+    """Steps implementing :func:`makeBatchPreview`."""
+    if preambles is None:
+        preambles = []
+    if files is None:
+        files = {}
+    from exdb import cache
+    previewCache = cache.previewCache()
+    template = templateRevision() if previewCache else None
+    results = [None]*len(snippets)
+    keys = [None]*len(snippets)
+    batches = {}
+    for i, (texcode, lang) in enumerate(snippets):
+        if previewCache:
+            keys[i] = previewKey(texcode, lang, preambles, files, template)
+            results[i] = previewCache.lookup(keys[i])
+            failure = results[i] is None and previewCache.lookupFailure(keys[i])
+            if failure:
+                results[i] = CompilationError(*failure)
+        if results[i] is None:
+            batches.setdefault(lang, []).append(i)
+    for lang, indices in batches.items():
+        if len(indices) > 1:
+            tmpdir = tempfile.mkdtemp(dir=previewCache.path if previewCache else None)
+            try:
+                if (yield from compileBatchSteps(tmpdir, [snippets[i][0] for i in indices], lang,
+                                                 preambles, files)):
+                    for page, i in enumerate(indices):
+                        results[i] = storePreview(tmpdir, page, keys[i], template)
+                    continue
+            except CompilationError as e:
+                for i in indices:
+                    results[i] = e
+                continue
+            finally:
+                shutil.rmtree(tmpdir)
+        for i in indices:
+            try:
+                results[i] = yield from previewSteps(snippets[i][0], lang, preambles, files,
+                                                     keys[i], template)
+            except CompilationError as e:
+                results[i] = e
+    return results
+
+
+def runJobs(jobs, cancelled=None):
+    """Compile the :func:`makePreviews` *jobs*, which share preambles and files, in one batch.
+
+    Returns a list of (key, result) pairs. The batch is aborted if the :class:`threading.Event`
+    *cancelled* is set.
+    """
+    timeout = TIMEOUT and TIMEOUT*len(jobs)
+    if len(jobs) == 1:
+        key, texcode, lang, preambles, files = jobs[0]
+        try:
+            return [(key, runSteps(previewSteps(texcode, lang, preambles, files), timeout,
+                                   cancelled))]
+        except CompilationError as e:
+            return [(key, e)]
+    results = runSteps(batchSteps([(texcode, lang) for _, texcode, lang, _, _ in jobs],
+                                  jobs[0][3], jobs[0][4]), timeout, cancelled)
+    return [(job[0], result) for job, result in zip(jobs, results)]
+
+
+class SchedulerTask(object):
+    """A list of :func:`makePreviews` *jobs* queued in a :class:`Scheduler`."""
+
+    def __init__(self, jobs, priority, tag):
+        self.jobs = jobs
+        self.priority = priority
+        self.tag = tag
+        self.future = Future()
+        self.cancelled = threading.Event()
+
+
+class SchedulerSession(object):
+    """Tasks submitted together to a :class:`Scheduler`, like those of a :func:`makePreviews`
+    call, which do not supersede each other. Once superseded, a session stays so.
+    """
+
+    def __init__(self):
+        self.superseded = False
+        self.ended = False
+        self.tags = set()
+
+
+class Scheduler(object):
+    """Pool of worker threads running compile tasks in the order of their priority.
+
+    Tasks are compiled by :func:`runJobs`; a task of :data:`PRIORITY_INTERACTIVE` is started
+    before all waiting tasks of :data:`PRIORITY_BULK`, tasks of equal priority in the order of
+    submission. Up to *workers* (default: :data:`WORKERS`) tasks run in parallel. Every task is
+    subject to :data:`TIMEOUT` and :data:`MEMORY_LIMIT`.
+
+    A task may be submitted with a *tag* identifying its subject, like the snippets of an
+    exercise being edited. A new task with the same tag supersedes the old ones (except those of
+    the same *session*, like the other tasks of one :func:`makePreviews` call), which are removed
+    from the queue or, if it is already running, aborted with :class:`CompilationCancelled`.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or WORKERS
+        self.submitted = self.completed = self.cancelled = self.timeouts = 0
+        self.running = self.maxQueueDepth = 0
+        self._queue = []
+        self._counter = itertools.count()
+        self._tags = {}
+        self._threads = []
+        self._condition = threading.Condition()
+
+    def reserve(self, workers):
+        """Allow at least *workers* tasks to run in parallel."""
+        with self._condition:
+            self.workers = max(self.workers, workers)
+
+    def submit(self, jobs, priority=PRIORITY_BULK, tag=None, session=None):
+        """Queue the :func:`makePreviews` *jobs*, to be compiled together.
+
+        The task supersedes the tasks with the same *tag*, unless they have been submitted in the
+        same :class:`SchedulerSession` *session*; if the latter has been superseded, the task is
+        cancelled right away. Sessions are ended by :meth:`endSession`.
+
+        Returns a :class:`concurrent.futures.Future` resolving to the list of (key, result)
+        pairs returned by :func:`runJobs`. The future is cancelled if the task is superseded
+        before it starts.
+        """
+        task = SchedulerTask(jobs, priority, tag)
+        with self._condition:
+            if tag is not None:
+                if session is not None and session.superseded:
+                    task.future.cancel()
+                    self.cancelled += 1
+                    return task.future
+                owner, tasks = self._tags.get(tag, (None, []))
+                if session is None or owner is not session:
+                    for old in tasks:
+                        self._cancel(old)
+                    if owner is not None:
+                        owner.superseded = True
+                    tasks = []
+                tasks.append(task)
+                self._tags[tag] = session, tasks
+                if session is not None:
+                    session.tags.add(tag)
+            heapq.heappush(self._queue, (priority, next(self._counter), task))
+            self.submitted += 1
+            self.maxQueueDepth = max(self.maxQueueDepth, len(self._queue))
+            if len(self._threads) < min(self.workers, self.running + len(self._queue)):
+                thread = threading.Thread(target=self._work, name="exdb-compile")
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._condition.notify()
+        return task.future
+
+    def _cancel(self, task):
+        for i, (_, _, queued) in enumerate(self._queue):
+            if queued is task:
+                del self._queue[i]
+                heapq.heapify(self._queue)
+                task.future.cancel()
+                break
+        else:
+            task.cancelled.set()
+        self.cancelled += 1
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, _, task = heapq.heappop(self._queue)
+                if not task.future.set_running_or_notify_cancel():
+                    self._untag(task)
+                    continue  # cancelled by the submitter
+                self.running += 1
+            try:
+                results = runJobs(task.jobs, task.cancelled)
+            except BaseException as e:
+                task.future.set_exception(e)
+            else:
+                task.future.set_result(results)
+                if any(isinstance(result, CompilationTimeout) for _, result in results):
+                    with self._condition:
+                        self.timeouts += 1
+            finally:
+                with self._condition:
+                    self.running -= 1
+                    self.completed += 1
+                    self._untag(task)
+
+    def endSession(self, session):
+        """Forget the tags of *session*, after all of its tasks have been submitted."""
+        with self._condition:
+            session.ended = True
+            for tag in session.tags:
+                owner, tasks = self._tags.get(tag, (None, None))
+                if owner is session and not tasks:
+                    del self._tags[tag]
+
+    def _untag(self, task):
+        if task.tag is not None:
+            owner, tasks = self._tags.get(task.tag, (None, []))
+            if task in tasks:
+                tasks.remove(task)
+                if not tasks and (owner is None or owner.ended):
+                    del self._tags[task.tag]
+
+    def stats(self):
+        """Return a dictionary with metrics of the scheduler.
+
+        *queueDepth* is the number of waiting tasks, *queued* maps each priority to its number
+        of waiting tasks, and *maxQueueDepth* is the largest queue depth seen so far. *running*
+        counts the tasks being compiled, and *submitted*, *completed*, *cancelled* and
+        *timeouts* the respective events since the scheduler was created.
+        """
+        with self._condition:
+            queued = {}
+            for priority, _, _ in self._queue:
+                queued[priority] = queued.get(priority, 0) + 1
+            return dict(queueDepth=len(self._queue), queued=queued,
+                        maxQueueDepth=self.maxQueueDepth, running=self.running,
+                        workers=self.workers, submitted=self.submitted,
+                        completed=self.completed, cancelled=self.cancelled,
+                        timeouts=self.timeouts)
+
+
+_scheduler = None
+_schedulerLock = threading.Lock()
+
+
+def scheduler():
+    """Return the process-wide :class:`Scheduler`."""
+    global _scheduler
+    with _schedulerLock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def makePreviews(jobs, workers=None, priority=PRIORITY_BULK, tag=None):
+    """Compile several previews in parallel on the :func:`scheduler`.
+
+    *jobs* is an iterable of (key, texcode, lang, preambles, files) tuples; *key* is an arbitrary
+    object identifying the job, the remaining entries are passed to :func:`makePreview`. The
+    iterable is consumed lazily, so it may be a generator producing a large backlog. If
+    :data:`BATCH` is set, consecutive jobs with equal preambles and files (like the snippets of
+    one exercise) are compiled together by :func:`makeBatchPreview`.
+
+    Generates (key, result) pairs in the order in which the compilations finish. *result* is the
+    image path if the compilation succeeded, and the raised :class:`CompilationError` otherwise.
+    At most *workers* (default: :data:`WORKERS`) compilations of this call run in parallel; the
+    tasks are scheduled with the given *priority*. If *tag* is given, the tasks supersede those
+    of earlier calls with the same tag, whatever their jobs, which then yield
+    :class:`CompilationCancelled` errors.
+    """
+    workers = workers or WORKERS
+    pool = scheduler()
+    pool.reserve(workers)
+    if BATCH:
+        tasks = (list(group) for _, group in groupby(jobs, key=lambda job: (job[3], job[4])))
+    else:
+        tasks = ([job] for job in jobs)
+    pending = {}
+    session = SchedulerSession()
+
+    def submit(count):
+        for task in islice(tasks, count):
+            pending[pool.submit(task, priority, tag, session)] = task
+
+    try:
+        submit(workers)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    results = future.result()
+                except CancelledError:
+                    results = [(job[0], CompilationCancelled("compilation superseded", ""))
+                               for job in task]
+                for key, result in results:
+                    yield key, result
+            submit(len(done))
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.endSession(session)
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Michael Helmling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+"""Instrumentation of the SQLite connections opened by :func:`exdb.sql.connect`.
+
+Tracing is disabled by default, in which case the connections are plain :class:`sqlite3.Connection`
+objects and there is no overhead at all. After :func:`enable`, newly opened connections (and
+the pooled connections of :mod:`exdb.sql`, which are replaced on their next use) report every
+statement to the active :class:`Tracer` as a :class:`Statement` record, which contains its
+latency, the number of rows it returned, the exdb API function that issued it and the time spent
+in the Python functions (REGEXP, CONTAINS) it called.
+
+The records are passed to *sinks*, which are arbitrary callables; this module provides the
+:class:`LoggingSink` for a slow-query log and the in-memory :class:`Histogram`. Statements taking
+at least the tracer's *threshold* are marked as slow, and their query plan is captured with
+``EXPLAIN QUERY PLAN`` if requested.
+"""
+
+from __future__ import unicode_literals
+
+import bisect, logging, sqlite3, sys, threading, time
+from collections import namedtuple
+
+tracer = None
+"""The active :class:`Tracer`, or None if tracing is disabled."""
+
+_local = threading.local()
+
+
+class Statement(namedtuple("Statement", "sql seconds rows caller functions slow plan")):
+    """Record of an executed SQL statement.
+
+    *seconds* is the time spent executing the statement and fetching its rows, which are counted
+    in *rows* (for statements not returning rows, this is the number of modified rows).
+    *caller* is the qualified name of the outermost function of the exdb package that was
+    executing (see :func:`caller`), and *functions* maps the names of the Python functions called
+    by SQLite to (number of calls, seconds) pairs. *slow* tells whether the statement took at
+    least the tracer's threshold; in that case, *plan* may contain the lines of its query plan.
+    """
+
+    def __str__(self):
+        text = "{:.3f} ms, {} rows, {}: {}".format(self.seconds*1000, self.rows, self.caller,
+                                                    " ".join(self.sql.split()))
+        for name, (calls, seconds) in sorted(self.functions.items()):
+            text += "; {} {:.3f} ms ({} calls)".format(name, seconds*1000, calls)
+        if self.plan:
+            text += "\n" + "\n".join("  " + line for line in self.plan)
+        return text
+
+
+def caller():
+    """Return the qualified name of the outermost function of the exdb package on the stack.
+
+    Functions of this module are not taken into account. Returns None if there is none.
+    """
+    name = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if (module == "exdb" or module.startswith("exdb.")) and module != __name__:
+            name = "{}.{}".format(module, frame.f_code.co_name)
+        frame = frame.f_back
+    return name
+
+
+def timed(name, function):
+    """Wrap the Python *function* registered with SQLite under *name*, such that its calls are
+    accounted to the statement calling it.
+    """
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            functions = getattr(_local, "functions", None)
+            if functions is not None:
+                calls, seconds = functions.get(name, (0, 0))
+                functions[name] = calls + 1, seconds + time.perf_counter() - start
+    return wrapper
+
+
+class Tracer(object):
+    """Passes records of the executed statements to the *sinks*.
+
+    Statements taking at least *threshold* seconds (if not None) are marked as slow. If *explain*
+    is set, the query plans of slow statements are captured. Exceptions raised by sinks are
+    logged and otherwise ignored.
+    """
+
+    def __init__(self, sinks, threshold=None, explain=False):
+        self.sinks = list(sinks)
+        self.threshold = threshold
+        self.explain = explain
+
+    def record(self, conn, sql, parameters, seconds, rows, caller, functions):
+        """Create the :class:`Statement` record of a statement executed by *conn* and pass it to
+        the sinks. *parameters* is None if the statement cannot be explained.
+        """
+        slow = self.threshold is not None and seconds >= self.threshold
+        plan = None
+        if slow and self.explain and parameters is not None:
+            try:
+                plan = [row[3] for row in sqlite3.Connection.execute(
+                    conn, "EXPLAIN QUERY PLAN " + sql, parameters)]
+            except sqlite3.Error:
+                pass
+        statement = Statement(sql, seconds, rows, caller, functions, slow, plan)
+        for sink in self.sinks:
+            try:
+                sink(statement)
+            except Exception:
+                logging.exception("Tracing sink {!r} failed".format(sink))
+
+
+def enable(*sinks, threshold=None, explain=False):
+    """Enable tracing with a new :class:`Tracer` and return it.
+
+    See :class:`Tracer` for the arguments. Connections opened before are not traced.
+    """
+    global tracer
+    tracer = Tracer(sinks, threshold, explain)
+    return tracer
+
+
+def disable():
+    """Disable tracing. Traced connections still open stop reporting their statements."""
+    global tracer
+    tracer = None
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose statements are executed by :class:`TracedCursor` objects."""
+
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self, factory or TracedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor reporting its statements to the active :data:`tracer`.
+
+    A statement is reported once all of its rows have been fetched, or when the cursor is
+    reused, closed or garbage collected.
+    """
+
+    sql = None
+
+    def _start(self, sql, parameters):
+        self.finish()
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0
+        self.rows = 0
+        self.functions = {}
+        self.caller = caller()
+
+    def _run(self, method, *args):
+        outer = getattr(_local, "functions", None)
+        _local.functions = self.functions
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        except BaseException:
+            self.seconds += time.perf_counter() - start
+            self.finish()
+            raise
+        finally:
+            if self.sql is not None:
+                self.seconds += time.perf_counter() - start
+            _local.functions = outer
+
+    def finish(self):
+        """Report the current statement, if it has not been reported yet."""
+        sql, self.sql = self.sql, None
+        if sql is not None and tracer is not None:
+            tracer.record(self.connection, sql, self.parameters, self.seconds,
+                          self.rows if self.description else max(self.rowcount, 0),
+                          self.caller, self.functions)
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        self._run(sqlite3.Cursor.execute, sql, parameters)
+        if self.description is None:
+            self.finish()
+        return self
+
+    def executemany(self, sql, parameters):
+        self._start(sql, None)
+        self._run(sqlite3.Cursor.executemany, sql, parameters)
+        self.finish()
+        return self
+
+    def executescript(self, script):
+        self._start(script, None)
+        self._run(sqlite3.Cursor.executescript, script)
+        self.finish()
+        return self
+
+    def __next__(self):
+        try:
+            row = self._run(sqlite3.Cursor.__next__)
+        except StopIteration:
+            self.finish()
+            raise
+        self.rows += 1
+        return row
+
+    def fetchone(self):
+        row = self._run(sqlite3.Cursor.fetchone)
+        if row is None:
+            self.finish()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._run(sqlite3.Cursor.fetchmany, size)
+        self.rows += len(rows)
+        if len(rows) < size:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._run(sqlite3.Cursor.fetchall)
+        self.rows += len(rows)
+        self.finish()
+        return rows
+
+    def close(self):
+        self.finish()
+        sqlite3.Cursor.close(self)
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+
+class LoggingSink(object):
+    """Sink logging the statements at *level* to *logger* (the root logger by default).
+
+    If *slowOnly* is set, only slow statements are logged, which makes a slow-query log.
+    """
+
+    def __init__(self, logger=None, level=logging.WARNING, slowOnly=True):
+        self.logger = logger or logging.getLogger()
+        self.level = level
+        self.slowOnly = slowOnly
+
+    def __call__(self, statement):
+        if statement.slow or not self.slowOnly:
+            self.logger.log(self.level, "SQL statement: %s", statement)
+
+
+class Histogram(object):
+    """In-memory sink aggregating the statements by caller and SQL text.
+
+    The latencies are counted in buckets bounded by :attr:`BOUNDS` (in seconds). The calls of
+    Python functions are aggregated by function name in the *functions* dict.
+    """
+
+    BOUNDS = (0.0001, 0.001, 0.01, 0.1, 1)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, statement):
+        with self._lock:
+            entry = self.statements.get((statement.caller, statement.sql))
+            if entry is None:
+                entry = self.statements[statement.caller, statement.sql] = dict(
+                    caller=statement.caller, sql=statement.sql, count=0, seconds=0, max=0,
+                    rows=0, slow=0, buckets=[0]*(len(self.BOUNDS) + 1))
+            entry["count"] += 1
+            entry["seconds"] += statement.seconds
+            entry["max"] = max(entry["max"], statement.seconds)
+            entry["rows"] += statement.rows
+            entry["slow"] += statement.slow
+            entry["buckets"][bisect.bisect(self.BOUNDS, statement.seconds)] += 1
+            for name, (calls, seconds) in statement.functions.items():
+                totalCalls, totalSeconds = self.functions.get(name, (0, 0))
+                self.functions[name] = totalCalls + calls, totalSeconds + seconds
+
+    def stats(self):
+        """Return the list of the aggregated entries, sorted by decreasing total time.
+
+        Each entry is a dict with the *caller* and *sql* of the statements, their *count*, total
+        number of *rows* and of *slow* executions, total and *max* *seconds*, and the list of
+        *buckets* counts.
+        """
+        with self._lock:
+            entries = [dict(entry, buckets=list(entry["buckets"]))
+                       for entry in self.statements.values()]
+        return sorted(entries, key=lambda entry: entry["seconds"], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.functions = {}
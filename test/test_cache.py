@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Michael Helmling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+"""Test the bookkeeping of the preview cache."""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from os.path import exists, join
+
+from exdb.cache import PreviewCache
+
+
+class PreviewCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = PreviewCache(self.tmpdir, maxBytes=1000, maxEntries=3)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def addEntry(self, key, size=100):
+        os.mkdir(self.cache.entryPath(key))
+        with open(self.cache.imagePath(key), "wb") as f:
+            f.write(b"x" * size)
+        self.cache.record(key, "template")
+
+    def test_lru(self):
+        for key in "abc":
+            self.addEntry(key)
+        self.assertEqual(self.cache.lookup("a"), self.cache.imagePath("a"))
+        self.assertIsNone(self.cache.lookup("x"))
+        self.addEntry("d")
+        self.assertFalse(exists(self.cache.entryPath("b")))
+        self.assertIsNone(self.cache.lookup("b"))
+        self.addEntry("e", size=850)
+        for key in "ac":
+            self.assertFalse(exists(self.cache.entryPath(key)))
+        for key in "de":
+            self.assertTrue(exists(self.cache.imagePath(key)))
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["evictions"], 3)
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["bytes"], 950)
+
+    def test_linkedFiles(self):
+        self.addEntry("a")
+        shared = join(self.tmpdir, "shared.dat")
+        with open(shared, "wb") as f:
+            f.write(b"x" * 500)
+        os.link(shared, join(self.cache.entryPath("a"), "shared.dat"))
+        self.cache.record("a", "template")
+        self.assertEqual(self.cache.stats()["bytes"], 100)
+
+    def test_invalidate(self):
+        self.addEntry("a")
+        self.cache.record("a", "old")
+        self.addEntry("b")
+        self.assertEqual(self.cache.invalidate("template"), 1)
+        self.assertFalse(exists(self.cache.entryPath("a")))
+        self.assertTrue(exists(self.cache.entryPath("b")))
+
+    def test_orphans(self):
+        self.addEntry("a")
+        os.mkdir(join(self.tmpdir, "orphan"))
+        self.assertEqual(self.cache.removeOrphans(minAge=3600), 0)
+        self.assertEqual(self.cache.removeOrphans(minAge=-1), 1)
+        self.assertTrue(exists(self.cache.entryPath("a")))
+
+    def test_failures(self):
+        self.cache.maxFailures = 2
+        for key in "abc":
+            self.cache.recordFailure(key, "template", "failed", "log of " + key)
+            time.sleep(0.01)
+        self.assertIsNone(self.cache.lookupFailure("a"))
+        self.assertEqual(self.cache.lookupFailure("c"), ("failed", "log of c"))
+        self.cache.failureTTL = 0
+        self.assertIsNone(self.cache.lookupFailure("c"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["failureHits"], stats["failures"]), (1, 0))
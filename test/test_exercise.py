@@ -84,4 +84,55 @@ class JSONExportTest(unittest.TestCase):
                 self.assertEqual(jsonDecoded[attrib], value)
         for attrib in jsonDecoded:
             assert attrib in exercise
-        
\ No newline at end of file
+        
+
+class MappingTest(unittest.TestCase):
+
+    def test_mapping(self):
+        exercise = Exercise.fromXMLString(validXML.encode("utf-8"))
+        self.assertFalse(hasattr(exercise, "__dict__"))
+        self.assertIs(exercise["tags"], exercise.tags)
+        exercise["description"] = "changed"
+        self.assertEqual(exercise.description, "changed")
+        self.assertEqual(list(exercise), Exercise.attributes)
+        self.assertRaises(KeyError, exercise.__getitem__, "schemaversion")
+        self.assertRaises(KeyError, exercise.__setitem__, "unknown", 1)
+        self.assertNotIn("schemaversion", exercise)
+        del exercise["tex_solution"]
+        self.assertNotIn("tex_solution", exercise)
+        self.assertIsNone(exercise.get("tex_solution"))
+        self.assertRaises(AttributeError, getattr, exercise, "tex_solution")
+        self.assertNotIn("tex_solution", json.loads(exercise.toJSON()))
+        self.assertEqual(len(exercise), len(Exercise.attributes) - 1)
+        self.assertNotEqual(exercise, Exercise.fromXMLString(validXML.encode("utf-8")))
+
+    def test_loader(self):
+        exercise = Exercise(creator="jemand", number=1, tags=["a"])
+        del exercise["tags"]
+
+        def load(field):
+            exercise[field] = ["b"]
+            return exercise[field]
+        exercise.loader = load
+        self.assertNotIn("tags", exercise)
+        self.assertEqual(exercise.tags, ["b"])
+        self.assertIn("tags", exercise)
+
+    def test_loaderMiss(self):
+        import copy, pickle
+        exercise = Exercise(creator="jemand", number=1)
+        del exercise["tags"]
+        exercise.loader = {}.__getitem__
+        self.assertFalse(hasattr(exercise, "tags"))
+        self.assertIsNone(getattr(exercise, "tags", None))
+        self.assertIsNone(exercise.get("tags"))
+        self.assertRaises(AttributeError, getattr, exercise, "unknown")
+        self.assertNotIn("tags", copy.copy(exercise))
+        self.assertNotIn("tags", pickle.loads(pickle.dumps(exercise)))
+
+    def test_pickle(self):
+        import pickle
+        exercise = Exercise.fromXMLString(validXML.encode("utf-8"))
+        copy = pickle.loads(pickle.dumps(exercise))
+        self.assertEqual(copy, exercise)
+        self.assertEqual(copy.schemaversion, exercise.schemaversion)
@@ -14,6 +14,7 @@ from os.path import exists, join
 import shutil, glob
 
 from . import dataPath, makeTestRepoEnv
+from exdb import repo
 from exdb.repo import repoPath
 import exdb
 from exdb.exercise import Exercise
@@ -50,6 +51,29 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(history[1]["action"], "ADD")
 
 
+    def testUpdateTagTree(self):
+        """Renames and deletes tags in the tag tree."""
+        from copy import deepcopy
+        with exdb.sql.conditionalConnect(None) as conn:
+            old = exdb.tags.readTreeFromTable(conn)
+        new = deepcopy(old)
+        new.find(".//tag[@name='Analysis']").set("name", "Calculus")
+        simplex = new.find(".//tag[@name='Revised Simplex']")
+        simplex.getparent().remove(simplex)
+        self.assertTrue(exdb.updateTagTree(old, new, "jensmander"))
+        self.assertEqual(exdb.sql.exercise("jensmander", 1).tags,
+                         ["Linear Optimization", "Calculus"])
+        self.assertEqual(exdb.sql.exercise("foobar", 1).tags, ["aabc"])
+        self.assertEqual(repo.loadFromXML("jensmander", 1).tags,
+                         ["Linear Optimization", "Calculus"])
+        self.assertEqual(repo.loadFromXML("foobar", 1).tags, ["aabc"])
+        with exdb.sql.conditionalConnect(None) as conn:
+            tree = exdb.tags.readTreeFromTable(conn)
+            self.assertEqual(tree.find(".//tag[@name='Calculus']").get("id"),
+                             old.find(".//tag[@name='Analysis']").get("id"))
+            self.assertIsNone(tree.find(".//tag[@name='Revised Simplex']"))
+
+
 class TestCloneInit(unittest.TestCase):
     """Initializes an instance by cloning a HG repository."""
     
@@ -60,3 +84,88 @@ class TestCloneInit(unittest.TestCase):
             for filename in ("foobar1.xml", "example.cpp", "solution_EN.png",
                              "solution_DE.png", "exercise_DE.png"):
                 self.assertTrue(exists(join(repoPath(), "exercises", "foobar1", filename)), "{} missing".format(filename))
+
+
+class TestPreviewRefresh(unittest.TestCase):
+    """Checks that template changes invalidate exactly the affected previews."""
+
+    def testTemplateChange(self):
+        from exdb import cache, tex
+        with makeTestRepoEnv("clone"):
+            previewCache = cache.previewCache()
+            revision = tex.templateRevision()
+            self.assertEqual(previewCache.outdatedOfficial(revision), [])
+            self.assertIn(("foobar", 1, "solution", "EN"), previewCache.officialSnippets())
+            image = tex.makePreview("$x$")
+            with open(join(repo.templatePath(), "preamble.tex"), "at") as preamble:
+                preamble.write("\\newcommand\\foo{foo}\n")
+            newRevision = tex.templateRevision()
+            self.assertNotEqual(revision, newRevision)
+            self.assertEqual(len(previewCache.outdatedOfficial(newRevision)),
+                             len(previewCache.officialSnippets()))
+            exdb.refreshPreviews(background=False)
+            self.assertFalse(exists(image))
+            self.assertEqual(previewCache.outdatedOfficial(newRevision), [])
+
+    def testBackgroundStop(self):
+        import threading
+        from unittest import mock
+        installed, started, proceed = [], threading.Event(), threading.Event()
+
+        def install(*args):
+            installed.append(args)
+            started.set()
+            proceed.wait(10)
+        with makeTestRepoEnv("clone"):
+            with open(join(repo.templatePath(), "preamble.tex"), "at") as preamble:
+                preamble.write("\\newcommand\\foo{foo}\n")
+            with mock.patch.object(repo, "installPreview", install):
+                thread = exdb.refreshPreviews(workers=1)
+                self.assertTrue(started.wait(60), "no preview was installed")
+                # the rebuild is stopped while it installs its first preview
+                release = threading.Timer(0.2, proceed.set)
+                release.start()
+                exdb.stopRefresh()
+                self.assertFalse(thread.is_alive())
+                self.assertEqual(len(installed), 1)
+                proceed.clear()
+                thread = exdb.refreshPreviews(workers=1)
+                proceed.set()
+        # leaving the instance stops the rebuild of the new call
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(exdb._refresh)
+
+
+class TestSync(unittest.TestCase):
+    """Checks that syncDatabase applies changes made to the repository outside of exdb."""
+
+    def testSync(self):
+        with makeTestRepoEnv("copy"):
+            self.assertEqual(exdb.syncDatabase(), (0, 0, 0))
+            exercise = repo.loadFromXML("foobar", 1)
+            exercise.description = "changed by hand"
+            repo.storeExerciseXML(exercise)
+            self.assertEqual(exdb.syncDatabase(), (0, 1, 0))
+            self.assertEqual(exdb.sql.exercise("foobar", 1).description, "changed by hand")
+            backup = join(exdb.instancePath, "jensmander1")
+            shutil.move(repo.exercisePath(creator="jensmander", number=1), backup)
+            self.assertEqual(exdb.syncDatabase(), (0, 0, 1))
+            self.assertEqual(len(exdb.sql.exercises()), 1)
+            shutil.move(backup, repo.exercisePath(creator="jensmander", number=1))
+            self.assertEqual(exdb.syncDatabase(), (1, 0, 0))
+            self.assertEqual(exdb.syncDatabase(), (0, 0, 0))
+
+    def testRebuild(self):
+        with makeTestRepoEnv("copy"):
+            before = sorted(exdb.sql.exercises(), key=Exercise.identifier)
+            conn = exdb.sql.connect()
+            conn.execute("DELETE FROM exercises")
+            conn.execute("DELETE FROM repository_files")
+            conn.commit()
+            minimum, repo.PARALLEL_PARSE_MIN = repo.PARALLEL_PARSE_MIN, 1
+            try:
+                self.assertEqual(exdb.syncDatabase(conn, workers=2), (2, 0, 0))
+            finally:
+                repo.PARALLEL_PARSE_MIN = minimum
+                conn.close()
+            self.assertEqual(sorted(exdb.sql.exercises(), key=Exercise.identifier), before)
@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Michael Helmling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+from __future__ import unicode_literals
+
+import json
+import sqlite3
+import threading
+import unittest
+from unittest import mock
+from os.path import dirname, join
+
+from . import dataPath, makeTestRepoEnv
+from exdb import sql, tags
+from exdb.exercise import Exercise
+
+
+class TestSearch(unittest.TestCase):
+    
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+    
+    def tearDown(self):
+        self.cm.__exit__(None, None, None)
+
+    def search(self, **kwargs):
+        count, exercises = sql.searchExercises(**kwargs)
+        self.assertEqual(count, len(exercises))
+        return [exercise.identifier() for exercise in exercises]
+
+    def test_fullText(self):
+        self.assertEqual(self.search(description="dem"), ["foobar1"])
+        self.assertEqual(self.search(description="AUFG"), ["jensmander1"])
+        self.assertEqual(self.search(description="aufgabe demo"), [])
+        self.assertEqual(self.search(description="x"), [])
+        self.assertEqual(self.search(text="lstinput"), ["foobar1"])
+        self.assertEqual(self.search(text="x", langs=["EN"]), ["jensmander1"])
+        # filters without searchable terms match nothing, empty ones are ignored
+        self.assertEqual(self.search(description="-"), [])
+        self.assertEqual(self.search(text="? ", langs=["EN"]), [])
+        self.assertEqual(self.search(description="dem", text="-"), [])
+        self.assertEqual(len(self.search(description=" ")), 2)
+
+    def test_fullTextUpdate(self):
+        exercise = sql.exercise("foobar", 1)
+        exercise.description = "Übung"
+        exercise.tex_solution = {"DE": r"\int_0^1 \mathrm{d}t"}
+        sql.updateExercise(exercise)
+        self.assertEqual(self.search(description="ubung"), ["foobar1"])
+        self.assertEqual(self.search(text="mathrm", pagination={"orderby": "rank"}),
+                         ["foobar1"])
+        sql.removeExercise("foobar", 1)
+        self.assertEqual(self.search(text="mathrm"), [])
+
+
+class TestTags(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+
+    def tearDown(self):
+        self.cm.__exit__(None, None, None)
+
+    def search(self, **kwargs):
+        return sorted(exercise.identifier() for exercise in sql.searchExercises(**kwargs)[1])
+
+    def test_search(self):
+        self.assertEqual(self.search(tags=["Analysis"]), ["jensmander1"])
+        self.assertEqual(self.search(tags=["Linear Optimization", "Analysis"]), ["jensmander1"])
+        self.assertEqual(self.search(tags=["Analysis", "aabc"]), [])
+        self.assertEqual(self.search(tags=["Analysis", "unknown"]), [])
+        with sql.conditionalConnect(None) as conn:
+            tree = tags.readTreeFromTable(conn)
+        cats = {cat.get("name"): (cat.get("id"), cat.get("mat_path"))
+                for cat in tree.iter("category")}
+        self.assertEqual(self.search(cats=[cats["Test"]]), ["jensmander1"])
+        self.assertEqual(self.search(cats=[cats["uncategorized"]]), ["foobar1", "jensmander1"])
+        self.assertEqual(self.search(cats=[cats["Test"]], description="dem"),
+                         ["foobar1", "jensmander1"])
+        self.assertEqual(self.search(tags=["Analysis"], description="-"), ["jensmander1"])
+
+    def test_ids(self):
+        with sql.conditionalConnect(None) as conn:
+            ids = sql.tagIdsByName(conn)
+            tags.initTagsTable(conn)
+            self.assertEqual(sql.tagIdsByName(conn), ids)
+        affected = sql.updateTags({ids["aabc"]: "Analysis"}, [ids["Linear Optimization"]])
+        self.assertEqual(len(affected), 2)
+        self.assertEqual(sql.exercise("foobar", 1).tags, ["Analysis", "Revised Simplex"])
+        self.assertEqual(sql.exercise("jensmander", 1).tags, ["Analysis"])
+        self.assertEqual(self.search(tags=["Analysis"]), ["foobar1", "jensmander1"])
+
+    def test_index(self):
+        self.assertEqual(sql.bitmapIds(sql.bitmap([64, 0, 9, 3])), [0, 3, 9, 64])
+        self.assertEqual(sql.bitmapIds(0), [])
+        index = sql.tagIndex()
+        self.assertIs(sql.tagIndex(), index)
+        with sql.conditionalConnect(None) as conn:
+            ids = sql.tagIdsByName(conn)
+        foobar = sql.bitmapIds(index.query(allOf=[ids["aabc"]]))
+        self.assertEqual(len(foobar), 1)
+        self.assertEqual(sql.bitmapIds(index.query(noneOf=[ids["Analysis"]])), foobar)
+        self.assertEqual(index.query(anyOf=[ids["aabc"], ids["Analysis"]]), index.all)
+        sql.removeExercise("foobar", 1)
+        self.assertIsNot(sql.tagIndex(), index)
+        self.assertEqual(sql.tagIndex().query(allOf=[ids["aabc"]]), 0)
+
+    def test_incremental(self):
+        TagIndex = sql.TagIndex
+
+        def check():
+            with sql.conditionalConnect(None, readonly=True) as conn:
+                fresh = TagIndex(conn)
+            index = sql.tagIndex()
+            self.assertEqual((index.bitmaps, index.all), (fresh.bitmaps, fresh.all))
+        check()
+        with mock.patch.object(sql, "TagIndex", wraps=TagIndex) as factory:
+            sql.addExercise(Exercise(creator="foobar", description="new", tags=["aabc", "new"],
+                                     tex_exercise={"DE": "Neu"}))
+            check()
+            exercise = sql.exercise("foobar", 1)
+            exercise.tags = ["new"]
+            sql.updateExercise(exercise)
+            check()
+            with sql.conditionalConnect(None) as conn:
+                ids = sql.tagIdsByName(conn)
+            sql.updateTags({ids["aabc"]: "new"}, [ids["Analysis"]])
+            check()
+            sql.removeExercise("foobar", 1)
+            check()
+            self.assertEqual(factory.call_count, 0)
+            # commits of other connections keep the index unless they change the tags
+            conn = sqlite3.connect(sql.sqlPath())
+            conn.execute("UPDATE exercises SET description='other'")
+            conn.commit()
+            check()
+            self.assertEqual(factory.call_count, 0)
+            conn.execute("DELETE FROM exercises_tags")
+            conn.execute("UPDATE tags_generation SET generation = generation + 1")
+            conn.commit()
+            conn.close()
+            check()
+            self.assertEqual(factory.call_count, 1)
+        self.assertEqual(sql.tagIndex().bitmaps, {})
+
+    def test_closure(self):
+        def closure(conn):
+            return sorted(tuple(row) for row in conn.execute(
+                "SELECT a.name, d.name, depth FROM tags_closure "
+                "JOIN tags AS a ON a.id = ancestor JOIN tags AS d ON d.id = descendant"))
+        with sql.conditionalConnect(None) as conn:
+            before = closure(conn)
+            tags.initTagsTable(conn)
+            self.assertEqual(closure(conn), before)
+            self.assertIn(("Test", "Linear Optimization", 1), before)
+            self.assertIn(("Analysis", "Analysis", 0), before)
+            uncat = conn.execute("SELECT id FROM tags WHERE name='uncategorized'").fetchone()[0]
+            new = sql.tagIds(["Topology"], conn.cursor())["Topology"]
+            self.assertEqual([tuple(row) for row in conn.execute(
+                "SELECT ancestor, depth FROM tags_closure WHERE descendant=? ORDER BY depth",
+                (new,))], [(new, 0), (uncat, 1)])
+            self.assertEqual(sql.subtreeTags(conn, [uncat]),
+                             {"Analysis", "aabc", "Revised Simplex", "Topology"})
+            tree = tags.readTreeFromTable(conn)
+        self.assertEqual([(cat.get("name"), [tag.get("name") for tag in cat])
+                          for cat in tree],
+                         [("uncategorized", ["Analysis", "aabc", "Revised Simplex", "Topology"]),
+                          ("Test", ["Linear Optimization"])])
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+
+    def tearDown(self):
+        self.cm.__exit__(None, None, None)
+
+    def test_cache(self):
+        cache = sql.searchCache
+        start = cache.stats()
+        count, page = sql.searchExercises(description="demo ")
+        self.assertEqual(sql.searchExercises(description=" demo"), (count, page))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (start["hits"] + 1,
+                                                           start["misses"] + 1))
+        exercise = sql.exercise("foobar", 1)
+        exercise.description = "Übung"
+        sql.updateExercise(exercise)
+        self.assertEqual(sql.searchExercises(description="demo"), (0, []))
+        # commits of other connections are noticed as well
+        conn = sqlite3.connect(sql.sqlPath())
+        conn.execute("UPDATE exercises SET description='Demo' WHERE creator='foobar'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(sql.searchExercises(description="demo")[0], 1)
+        self.assertEqual(cache.stats()["misses"], start["misses"] + 3)
+
+    def test_copies(self):
+        for fields in None, sql.LISTING_FIELDS:
+            exercise = sql.searchExercises(description="demo", fields=fields)[1][0]
+            expected = exercise.toDict()
+            exercise.tags.append("mutated")
+            exercise.tex_exercise["DE"] = "mutated"
+            exercise.description = "mutated"
+            again = sql.searchExercises(description="demo", fields=fields)[1][0]
+            self.assertIsNot(again, exercise)
+            self.assertNotIn("mutated", again.tags)
+            self.assertNotEqual(again.tex_exercise.get("DE"), "mutated")
+            self.assertEqual(again.description, expected["description"])
+
+    def test_lru(self):
+        cache = sql.SearchCache(maxSize=2)
+        generation = cache.generation()
+        for key in "abc":
+            cache.store(key, generation, key.upper())
+        self.assertEqual(cache.lookup("a"), None)
+        self.assertEqual(cache.lookup("b"), "B")
+        cache.store("d", generation, "D")
+        self.assertEqual(cache.lookup("c"), None)
+        self.assertEqual(cache.lookup("b"), "B")
+        cache.bump()
+        self.assertEqual(cache.lookup("b"), None)
+        cache.store("b", generation, "B")
+        self.assertEqual(cache.stats(), dict(hits=2, misses=3, entries=0, maxSize=2,
+                                             generation=generation + 1))
+        cache.reset()
+
+
+class TestPagination(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+        for number, description in enumerate(["b", None, "a", None, "b"]):
+            sql.addExercise(Exercise(creator="page", number=number, description=description,
+                                     tags=["page{}".format(number)],
+                                     tex_exercise={"DE": "Seite {}".format(number)}))
+
+    def tearDown(self):
+        self.cm.__exit__(None, None, None)
+
+    def pages(self, ids=None, **pagination):
+        result = []
+        pagination["limit"] = 2
+        while True:
+            page, cursor = sql.exercisePage(ids, pagination)
+            self.assertLessEqual(len(page), 2)
+            result.extend(exercise.identifier() for exercise in page)
+            if cursor is None:
+                return result
+            pagination["after"] = cursor
+
+    def test_cursor(self):
+        for orderby in sql.ORDER_COLUMNS:
+            for descending in False, True:
+                pagination = dict(orderby=orderby, descending=descending)
+                self.assertEqual(self.pages(**pagination),
+                                 [ex.identifier() for ex in sql.exercises(pagination=pagination)])
+        self.assertEqual(self.pages(ids=[1, 3, 5], orderby="id"),
+                         ["foobar1", "page0", "page2"])
+        page = sql.exercises(pagination=dict(orderby="number", limit=1, offset=4))[0]
+        self.assertEqual(page.tags, ["page2"])
+        self.assertEqual(page.tex_exercise, {"DE": "Seite 2"})
+        cursor = sql.exercisePage(pagination=dict(limit=1))[1]
+        self.assertRaises(ValueError, sql.exercisePage,
+                          pagination=dict(orderby="id", after=cursor))
+        self.assertRaises(ValueError, sql.exercisePage, pagination=dict(after="garbage"))
+        self.assertRaises(ValueError, sql.exercisePage, pagination=dict(orderby="id; DROP"))
+
+    def test_emptyLimit(self):
+        self.assertEqual(sql.exercisePage(pagination=dict(limit=0)), ([], None))
+        self.assertEqual(sql.searchPage(pagination=dict(limit=0)), (7, [], None))
+        self.assertEqual(sql.searchPage(text="seite", pagination=dict(orderby="rank", limit=0)),
+                         (5, [], None))
+
+    def test_rank(self):
+        pagination = dict(orderby="rank", limit=3)
+        count, page, cursor = sql.searchPage(text="seite", pagination=pagination)
+        self.assertEqual((count, len(page)), (5, 3))
+        pagination["after"] = cursor
+        count, rest, cursor = sql.searchPage(text="seite", pagination=pagination)
+        self.assertEqual((len(rest), cursor), (2, None))
+        self.assertEqual(sorted(ex.identifier() for ex in page + rest),
+                         ["page{}".format(number) for number in range(5)])
+
+
+    def test_projection(self):
+        pagination = dict(orderby="id")
+        full = sql.exercises(pagination=pagination)
+        page = sql.exercises(pagination=pagination, fields=sql.LISTING_FIELDS)
+        self.assertEqual([ex.tags for ex in page], [ex.tags for ex in full])
+        self.assertNotIn("tex_exercise", page[0])
+        self.assertNotIn("data_files", page[0].toJSON())
+        self.assertEqual([ex.languages() for ex in page], [ex.languages() for ex in full])
+        self.assertNotIn("tex_exercise", page[0])
+        self.assertEqual(page[0].data_files, ["example.cpp"])
+        self.assertEqual(page[-1]["data_files"], [])
+        self.assertEqual(page[1].tex_exercise, full[1].tex_exercise)
+        self.assertIn("tex_exercise", page[-1])
+        self.assertNotIn("tex_solution", page[-1])
+        for field in "tex_solution", "tex_preamble":
+            self.assertEqual([ex[field] for ex in page], [ex[field] for ex in full])
+        self.assertEqual(page, full)
+
+    def test_loaderConnection(self):
+        def dataFiles(exercise):
+            return sorted(exercise.data_files)
+        with sql.conditionalConnect(None) as conn:
+            conn.execute("INSERT INTO exercises_files(exercise, filename) VALUES (1, 'new.png')")
+            first, second, third = (sql.exercises(ids=[1], connection=conn,
+                                                  fields=sql.LISTING_FIELDS)[0]
+                                    for _ in range(3))
+            # the originating connection is used while it is open, in its thread only
+            self.assertEqual(dataFiles(first), ["example.cpp", "new.png"])
+            result = []
+            other = threading.Thread(target=lambda: result.append(dataFiles(second)))
+            other.start()
+            other.join()
+            self.assertEqual(result, [["example.cpp"]])
+        self.assertEqual(dataFiles(third), ["example.cpp"])
+
+    def test_identifiers(self):
+        identifiers = [("page", 3), ("jensmander", 1), ("nobody", 1), ("page", 0), ("page", 3)]
+        batch = sql.exercisesByIdentifiers(identifiers)
+        self.assertEqual([ex.identifier() for ex in batch], ["page3", "jensmander1", "page0"])
+        self.assertEqual(batch, [sql.exercise(creator, number)
+                                 for creator, number in identifiers[:2] + identifiers[3:4]])
+        self.assertEqual(batch[-1].tex_exercise, {"DE": "Seite 0"})
+        self.assertEqual(sql.exercisesByIdentifiers([]), [])
+        self.assertRaises(KeyError, sql.exercise, "nobody", 1)
+
+    def test_iterate(self):
+        full = sql.exercises(pagination=dict(orderby="id"))
+        self.assertEqual(list(sql.iterExercises()), full)
+        self.assertEqual(list(sql.iterExercises(chunkSize=1)), full)
+        self.assertEqual(list(sql.iterExercises(ids=[1, 4, 6], chunkSize=2)),
+                         [full[0], full[3], full[5]])
+        self.assertEqual(list(sql.iterExercises(ids=[])), [])
+        # a suspended iteration keeps no read transaction open, which would block checkpoints
+        iterator = sql.iterExercises(chunkSize=2)
+        self.assertEqual(next(iterator), full[0])
+        sql.removeExercise(full[3].creator, full[3].number)
+        with sql.conditionalConnect(None) as conn:
+            self.assertEqual(conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0], 0)
+        sql.closeConnections()
+        self.assertEqual(list(iterator), full[1:3] + full[4:])
+
+
+class TestConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+
+    def tearDown(self):
+        self.cm.__exit__(None, None, None)
+
+    def test_pool(self):
+        with sql.conditionalConnect(None) as conn:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            with sql.conditionalConnect(None) as inner:
+                self.assertIs(inner, conn)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(sql.pooledConnection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], conn)
+        thread = threading.Thread(target=sql.pooledConnection)
+        thread.start()
+        thread.join()
+        self.assertRaises(sqlite3.ProgrammingError, other[0].execute, "SELECT 1")
+        with sql.conditionalConnect(None, readonly=True) as reader:
+            self.assertIsNot(reader, conn)
+            self.assertRaises(sqlite3.OperationalError, reader.execute,
+                              "DELETE FROM exercises")
+        sql.closeConnections()
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, "SELECT 1")
+        self.assertIsNot(sql.pooledConnection(), conn)
+
+    def test_closeOtherThreads(self):
+        opened, closed = threading.Event(), threading.Event()
+        counts = []
+
+        def worker():
+            counts.append(sql.searchExercises()[0])
+            opened.set()
+            closed.wait()
+            counts.append(sql.searchExercises()[0])
+            with sql.conditionalConnect(None) as conn:
+                counts.append(conn.execute("SELECT COUNT(*) FROM exercises").fetchone()[0])
+        thread = threading.Thread(target=worker)
+        thread.start()
+        opened.wait()
+        sql.closeConnections()
+        closed.set()
+        thread.join()
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(len(set(counts)), 1)
+
+    def test_rollback(self):
+        with sql.conditionalConnect(None) as conn:
+            conn.execute("DELETE FROM exercises WHERE creator='foobar'")
+        self.assertFalse(conn.in_transaction)
+        self.assertEqual(sql.exercise("foobar", 1).identifier(), "foobar1")
+        sql.removeExercise("foobar", 1)
+        with sql.conditionalConnect(None, readonly=True) as reader:
+            self.assertEqual(reader.execute("SELECT COUNT(*) FROM exercises "
+                                            "WHERE creator='foobar'").fetchone()[0], 0)
+
+    def test_numbers(self):
+        def add():
+            for _ in range(5):
+                sql.addExercise(Exercise(creator="foobar", description="concurrent"))
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with sql.conditionalConnect(None, readonly=True) as conn:
+            numbers = [row[0] for row in conn.execute("SELECT number FROM exercises "
+                                                      "WHERE creator='foobar' ORDER BY number")]
+        self.assertEqual(numbers, list(range(1, 22)))
+        self.assertRaises(sqlite3.IntegrityError, sql.addExercise,
+                          Exercise(creator="foobar", number=3))
+        sql.addExercise(Exercise(creator="foobar", number=30))
+        sql.removeExercise("foobar", 30)
+        exercise = Exercise(creator="foobar")
+        sql.addExercise(exercise)
+        self.assertEqual(exercise.number, 31)
+
+
+class TestMigration(unittest.TestCase):
+
+    def test_schema(self):
+        def schema(conn):
+            entries = {}
+            for type, name, table, statement in conn.execute(
+                    "SELECT type, name, tbl_name, sql FROM sqlite_master"):
+                if type == "table":
+                    entries[type, name] = [tuple(row) for pragma in ("table_xinfo",
+                                                                     "foreign_key_list")
+                                           for row in conn.execute("PRAGMA {}('{}')"
+                                                                   .format(pragma, name))]
+                else:
+                    entries[type, name] = table, statement and " ".join(
+                        statement.replace("IF NOT EXISTS ", "").split())
+            return entries
+        migrated = sqlite3.connect(":memory:")
+        with open(dataPath("dbschema-v0.sql")) as v0:
+            migrated.executescript(v0.read())
+        sql.migrate(migrated)
+        created = sqlite3.connect(":memory:")
+        with open(join(dirname(sql.__file__), "dbschema.sql")) as dbschema:
+            created.executescript(dbschema.read())
+        self.assertEqual(schema(created), schema(migrated))
+        migrated.close()
+        created.close()
+
+    def test_sqliteVersion(self):
+        sql.checkSQLite()
+        with mock.patch.object(sqlite3, "sqlite_version_info", (3, 31, 1)):
+            self.assertRaisesRegex(RuntimeError, "requires SQLite 3.35.0", sql.initDatabase)
+
+    def test_texTable(self):
+        conn = sqlite3.connect(":memory:")
+        with open(dataPath("dbschema-v0.sql")) as schema:
+            conn.executescript(schema.read())
+        for script in sql.MIGRATIONS[:2]:
+            conn.executescript(script)
+        conn.execute("PRAGMA user_version = 2")
+        conn.execute("INSERT INTO exercises(creator, number, description, modified, tex_exercise, "
+                     "tex_solution) VALUES ('a', 1, 'old', '2014-01-01', ?, ?)",
+                     (json.dumps({"DE": "Integral", "EN": "integral"}),
+                      json.dumps({"DE": "Lösung"}, ensure_ascii=False)))
+        self.assertEqual(sql.migrate(conn), len(sql.MIGRATIONS) - 2)
+        self.assertEqual(sql.readTex(conn), {1: dict(tex_exercise={"DE": "Integral",
+                                                                   "EN": "integral"},
+                                                     tex_solution={"DE": "Lösung"})})
+        self.assertEqual(conn.execute("SELECT rowid FROM exercises_fts WHERE exercises_fts "
+                                      "MATCH 'losung'").fetchall(), [(1,)])
+        conn.close()
+
+    def test_tagIds(self):
+        conn = sqlite3.connect(":memory:")
+        with open(dataPath("dbschema-v0.sql")) as schema:
+            conn.executescript(schema.read())
+        for script in sql.MIGRATIONS[:4]:
+            conn.executescript(script)
+        conn.execute("PRAGMA user_version = 4")
+        conn.executescript("""
+            INSERT INTO tags(id, name, is_tag, mat_path) VALUES (1, 'uncategorized', 0, '.'),
+                (2, 'Analysis', 1, '.1.');
+            INSERT INTO exercises(id, creator, number, modified) VALUES (1, 'a', 1, '2014-01-01');
+            INSERT INTO exercises_tags(exercise, tag) VALUES (1, 'Topology'), (1, 'Analysis');
+        """)
+        sql.migrate(conn)
+        self.assertEqual(conn.execute("SELECT id, name, mat_path, position FROM tags "
+                                      "ORDER BY position").fetchall(),
+                         [(1, "uncategorized", ".", 1), (2, "Analysis", ".1.", 2),
+                          (3, "Topology", ".1.", 3)])
+        self.assertEqual(conn.execute("SELECT exercise, tag FROM exercises_tags "
+                                      "ORDER BY rowid").fetchall(), [(1, 3), (1, 2)])
+        self.assertEqual(conn.execute("SELECT ancestor, descendant, depth FROM tags_closure "
+                                      "ORDER BY 1, 2").fetchall(),
+                         [(1, 1, 0), (1, 2, 1), (1, 3, 1), (2, 2, 0), (3, 3, 0)])
+        conn.close()
+
+    def test_identifiers(self):
+        conn = sqlite3.connect(":memory:")
+        with open(dataPath("dbschema-v0.sql")) as schema:
+            conn.executescript(schema.read())
+        sql.migrate(conn)
+        conn.execute("PRAGMA user_version = 6")
+        conn.executescript("""
+            DROP TABLE exercise_numbers;
+            DROP INDEX idxIdentifier;
+            INSERT INTO exercises(id, creator, number, modified) VALUES (1, 'a', 1, '2014-01-01'),
+                (2, 'a', 2, '2014-01-01'), (3, 'a', 2, '2014-01-01'), (4, 'b', 7, '2014-01-01');
+            INSERT INTO exercises_files(exercise, filename) VALUES (2, 'x.png'), (3, 'y.png');
+        """)
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(sql.migrate(conn), len(sql.MIGRATIONS) - 6)
+        self.assertEqual(logs.output, ["WARNING:root:Migration 7: exercise 3 duplicated the "
+                                       "identifier a2 and was renumbered to a3"])
+        self.assertEqual(conn.execute("SELECT id, creator, number FROM exercises").fetchall(),
+                         [(1, "a", 1), (2, "a", 2), (3, "a", 3), (4, "b", 7)])
+        self.assertEqual(conn.execute("SELECT * FROM exercises_files").fetchall(),
+                         [(2, "x.png"), (3, "y.png")])
+        self.assertEqual(conn.execute("SELECT * FROM exercise_numbers").fetchall(),
+                         [("a", 3), ("b", 7)])
+        self.assertEqual(sql.allocateNumber("b", conn.cursor()), 8)
+        self.assertRaises(sqlite3.IntegrityError, conn.execute, "INSERT INTO exercises"
+                          "(creator, number, modified) VALUES ('a', 1, '2014-01-01')")
+        conn.close()
@@ -7,10 +7,11 @@
 
 from __future__ import unicode_literals
 
-from exdb.tex import makePreview, CompilationError
+from exdb.tex import makePreview, makePreviewAsync, makePreviews, makeBatchPreview, \
+    CompilationError, FileReference
 from . import makeTestRepoEnv
-import os.path, shutil
-import unittest
+import asyncio, os.path, shutil, threading, time
+import unittest, unittest.mock
 
 class TestCompilation(unittest.TestCase):
     
@@ -35,4 +36,204 @@ class TestCompilation(unittest.TestCase):
     def test_previewPath(self):
         with makeTestRepoEnv("empty"):
             image = makePreview(self.tex_de, preambles=self.preambles)
-            self.assertTrue(os.path.exists(image))
\ No newline at end of file
+            self.assertTrue(os.path.exists(image))
+
+    def test_parallel(self):
+        jobs = [("de", self.tex_de, "DE", self.preambles, {}),
+                ("en", self.tex_en, "EN", self.preambles, {}),
+                ("invalid", self.tex_invalid, "DE", self.preambles, {})]
+        results = dict(makePreviews(jobs, workers=2))
+        self.assertEqual(set(results), set(("de", "en", "invalid")))
+        self.assertIsInstance(results["invalid"], CompilationError)
+        for key in "de", "en":
+            self.assertTrue(os.path.exists(results[key]))
+            shutil.rmtree(os.path.dirname(results[key]))
+
+    def test_format(self):
+        import exdb
+        with makeTestRepoEnv("empty"):
+            formatDir = os.path.join(exdb.instancePath, "formats")
+            makePreview(self.tex_de, preambles=self.preambles)
+            makePreview(self.tex_en, preambles=self.preambles)
+            self.assertEqual(len(os.listdir(formatDir)), 1)
+            self.assertRaises(CompilationError, makePreview, self.tex_invalid,
+                              preambles=self.preambles)
+            self.assertEqual(len(os.listdir(formatDir)), 1)
+            makePreview(self.tex_en, lang="EN", preambles=self.preambles)
+            self.assertEqual(len(os.listdir(formatDir)), 2)
+
+    def test_formatFailure(self):
+        import exdb
+        from exdb import tex
+        header = ["\\documentclass{article}\n"]
+        with makeTestRepoEnv("empty"):
+            formatDir = os.path.join(exdb.instancePath, "formats")
+            # errors that may be temporary do not mark the format as failed
+            with unittest.mock.patch.object(tex, "COMPILER", "exdb-missing-compiler"):
+                self.assertIsNone(tex.makeFormat(header, self.preambles))
+            self.assertEqual(os.listdir(formatDir), [])
+            fmt = tex.makeFormat(header, self.preambles)
+            self.assertTrue(os.path.exists(fmt))
+            tex.discardFormat(fmt)
+            self.assertIsNone(tex.makeFormat(header, self.preambles))
+            marker = fmt[:-len(".fmt")] + ".failed"
+            expired = time.time() - tex.FORMAT_RETRY - 1
+            os.utime(marker, (expired, expired))
+            self.assertEqual(tex.makeFormat(header, self.preambles), fmt)
+            self.assertEqual(os.listdir(formatDir), [os.path.basename(fmt)])
+
+    def test_batch(self):
+        with makeTestRepoEnv("empty"):
+            snippets = [(self.tex_de, "DE"), (self.tex_invalid, "DE"), (self.tex_en, "DE"),
+                        (self.tex_en, "EN")]
+            results = makeBatchPreview(snippets, self.preambles)
+            self.assertIsInstance(results[1], CompilationError)
+            for i in 0, 2, 3:
+                self.assertTrue(os.path.exists(results[i]))
+            self.assertEqual(len(set(results)), 4)
+            results = makeBatchPreview([(self.tex_de, "DE"), (self.tex_en, "DE")], self.preambles)
+            self.assertEqual(results[0], makePreview(self.tex_de, preambles=self.preambles))
+
+    def test_outputs(self):
+        from exdb import tex
+        image = makePreview(self.tex_de, preambles=self.preambles)
+        for name, _ in tex.OUTPUTS:
+            self.assertTrue(os.path.exists(os.path.join(os.path.dirname(image), name + ".png")))
+        shutil.rmtree(os.path.dirname(image))
+        self.assertTrue(tex.rasterizer().available())
+        # the backend is looked up once per setting of RASTERIZER
+        backend = tex.rasterizer()
+        with unittest.mock.patch.object(tex, "findRasterizer") as find:
+            self.assertIs(tex.rasterizer(), backend)
+            self.assertFalse(find.called)
+        with unittest.mock.patch.object(tex, "RASTERIZER", "imagemagick"):
+            self.assertIs(tex.rasterizer(), tex.RASTERIZERS[-1])
+        self.assertIs(tex.rasterizer(), backend)
+
+    def test_async(self):
+        async def compileAll():
+            return await asyncio.gather(
+                makePreviewAsync(self.tex_de, preambles=self.preambles),
+                makePreviewAsync(self.tex_de, preambles=self.preambles),
+                makePreviewAsync(self.tex_invalid, preambles=self.preambles),
+                return_exceptions=True)
+        with makeTestRepoEnv("empty"):
+            first, second, invalid = asyncio.run(compileAll())
+            self.assertEqual(first, second)
+            self.assertTrue(os.path.exists(first))
+            self.assertEqual(first, makePreview(self.tex_de, preambles=self.preambles))
+            self.assertIsInstance(invalid, CompilationError)
+            self.assertRegex(str(invalid), r"Missing \$ inserted")
+
+    def test_fileReference(self):
+        with makeTestRepoEnv("empty"):
+            import exdb
+            path = os.path.join(exdb.instancePath, "data.tex")
+            with open(path, "wb") as f:
+                f.write(b"referenced $x$")
+            code = r"\input{data.tex}"
+            image = makePreview(code, files={"data.tex": FileReference(path)})
+            staged = os.path.join(os.path.dirname(image), "data.tex")
+            self.assertEqual(os.stat(staged).st_nlink, 1)
+            self.assertEqual(image, makePreview(code, files={"data.tex": b"referenced $x$"}))
+            # rewriting the file in place leaves the cached preview alone
+            with open(path, "wb") as f:
+                f.write(b"changed")
+            with open(staged, "rb") as f:
+                self.assertEqual(f.read(), b"referenced $x$")
+
+    def test_timeout(self):
+        from exdb import tex
+        timeout, tex.TIMEOUT = tex.TIMEOUT, 2
+        try:
+            self.assertRaises(tex.CompilationTimeout, makePreview, r"\def\loop{\loop}\loop")
+        finally:
+            tex.TIMEOUT = timeout
+
+    def test_memoryLimit(self):
+        import sys, tempfile
+        from exdb import tex
+        code = "import resource; print(resource.getrlimit(resource.RLIMIT_AS)[0])"
+        command = tex.Command([sys.executable, "-c", code], tempfile.gettempdir())
+        self.assertEqual(int(command.run().stdout), tex.MEMORY_LIMIT)
+        result = asyncio.run(command.runAsync())
+        self.assertEqual(int(result.stdout), tex.MEMORY_LIMIT)
+
+    def test_scheduler(self):
+        from exdb import tex
+        scheduler = tex.Scheduler(workers=1)
+        finished = []
+        started, release = threading.Event(), threading.Event()
+        runJobs = tex.runJobs
+
+        def blockFirst(jobs, cancelled=None):
+            if jobs[0][0] == "first":
+                started.set()
+                release.wait(10)
+            return runJobs(jobs, cancelled)
+
+        def submit(name, priority, tag=None):
+            future = scheduler.submit([(name, self.tex_en, "EN", [name], {})], priority, tag)
+            future.add_done_callback(lambda f: finished.append(name))
+            return future
+        with unittest.mock.patch.object(tex, "runJobs", blockFirst):
+            first = submit("first", tex.PRIORITY_BULK)
+            self.assertTrue(started.wait(10), "first task did not start")
+            bulk = submit("bulk", tex.PRIORITY_BULK)
+            superseded = submit("superseded", tex.PRIORITY_INTERACTIVE, "tag")
+            interactive = submit("interactive", tex.PRIORITY_INTERACTIVE, "tag")
+            release.set()
+            self.assertTrue(superseded.cancelled())
+            self.assertEqual(scheduler.stats()["queued"], {tex.PRIORITY_INTERACTIVE: 1,
+                                                           tex.PRIORITY_BULK: 1})
+            for future in first, bulk, interactive:
+                future.result(60)
+        for future in first, bulk, interactive:
+            (key, image), = future.result()
+            self.assertTrue(os.path.exists(image))
+        self.assertEqual(finished, ["superseded", "first", "interactive", "bulk"])
+        stats = scheduler.stats()
+        self.assertEqual((stats["completed"], stats["cancelled"], stats["queueDepth"]), (3, 1, 0))
+
+    def test_sessions(self):
+        from exdb import tex
+        scheduler = tex.Scheduler(workers=1)
+        started, release = threading.Event(), threading.Event()
+        runJobs = tex.runJobs
+
+        def blockFirst(jobs, cancelled=None):
+            if jobs[0][0] == "first":
+                started.set()
+                release.wait(10)
+            return runJobs(jobs, cancelled)
+
+        def submit(name, session=None):
+            return scheduler.submit([(name, self.tex_en, "EN", [name], {})], tex.PRIORITY_BULK,
+                                    "tag", session)
+        old, new = tex.SchedulerSession(), tex.SchedulerSession()
+        with unittest.mock.patch.object(tex, "runJobs", blockFirst):
+            first = scheduler.submit([("first", self.tex_en, "EN", [], {})])
+            self.assertTrue(started.wait(10), "first task did not start")
+            tasks = [submit("a", old), submit("b", old)]
+            self.assertFalse(any(task.cancelled() for task in tasks))
+            # tasks of another session supersede all tasks of the tag, whatever their jobs
+            current = submit("c", new)
+            self.assertTrue(all(task.cancelled() for task in tasks))
+            self.assertTrue(submit("d", old).cancelled())
+            self.assertFalse(current.cancelled())
+            release.set()
+            for future in first, current:
+                future.result(60)
+        scheduler.endSession(old)
+        scheduler.endSession(new)
+        self.assertEqual(scheduler.stats()["cancelled"], 3)
+
+    def test_failureCache(self):
+        from exdb import cache
+        with makeTestRepoEnv("empty"):
+            with self.assertRaises(CompilationError) as first:
+                makePreview(self.tex_invalid, preambles=self.preambles)
+            with self.assertRaises(CompilationError) as second:
+                makePreview(self.tex_invalid, preambles=self.preambles)
+            self.assertEqual(first.exception.log, second.exception.log)
+            self.assertEqual(cache.previewCache().stats()["failureHits"], 1)
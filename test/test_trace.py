@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Michael Helmling
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation
+
+from __future__ import unicode_literals
+
+import logging
+import sqlite3
+import unittest
+
+from . import makeTestRepoEnv
+from exdb import sql, trace
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = makeTestRepoEnv("copy")
+        self.cm.__enter__()
+        self.statements = []
+
+    def tearDown(self):
+        trace.disable()
+        self.cm.__exit__(None, None, None)
+
+    def test_disabled(self):
+        self.assertIs(type(sql.connect(readonly=True)), sqlite3.Connection)
+        with sql.conditionalConnect(None, readonly=True) as conn:
+            self.assertIs(type(conn), sqlite3.Connection)
+
+    def test_statements(self):
+        histogram = trace.Histogram()
+        trace.enable(self.statements.append, histogram)
+        sql.searchExercises(description="de")
+        statements = [st for st in self.statements if "exercises_fts MATCH" in st.sql]
+        self.assertEqual(len(statements), 1)
+        statement = statements[0]
+        self.assertEqual((statement.caller, statement.rows), ("exdb.sql.searchExercises", 1))
+        self.assertFalse(statement.slow)
+        self.assertIsNone(statement.plan)
+        entry = [entry for entry in histogram.stats() if entry["sql"] == statement.sql][0]
+        self.assertEqual((entry["count"], entry["rows"], sum(entry["buckets"])), (1, 1, 1))
+
+        del self.statements[:]
+        with sql.conditionalConnect(None, readonly=True) as conn:
+            self.assertIsInstance(conn, trace.TracedConnection)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM exercises").fetchone()[0], 2)
+            for _ in conn.execute("SELECT id FROM exercises WHERE description REGEXP 'e'"):
+                pass
+        self.assertEqual([(st.rows, st.caller) for st in self.statements],
+                         [(1, None), (2, None)])
+        self.assertEqual(self.statements[1].functions["REGEXP"][0], 2)
+        self.assertEqual(histogram.functions["REGEXP"][0], 2)
+        trace.disable()
+        sql.exercise("foobar", 1)
+        self.assertEqual(len(self.statements), 2)
+        with sql.conditionalConnect(None, readonly=True) as conn:
+            self.assertIs(type(conn), sqlite3.Connection)
+
+    def test_slowLog(self):
+        trace.enable(self.statements.append, trace.LoggingSink(), threshold=0, explain=True)
+        with self.assertLogs(level=logging.WARNING) as log:
+            sql.exercise("foobar", 1)
+        self.assertTrue(all(statement.slow for statement in self.statements))
+        self.assertEqual(len(log.records), len(self.statements))
+        plan = [statement.plan for statement in self.statements if "json_each" in statement.sql][0]
+        self.assertTrue(plan)
+        self.assertTrue(any(plan[-1] in output for output in log.output))